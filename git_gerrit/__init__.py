@@ -23,40 +23,56 @@ Git helpers for the Gerrit code review system, with an emphasis on the Gerrit
 old-style numeric identifiers.
 """
 
+import importlib
+
 from git_gerrit.__version__ import VERSION
-from git_gerrit.git import Git
 from git_gerrit.error import (
     GitGerritError,
     GitGerritConfigError,
     GitGerritFormatError,
     GitGerritNotFoundError,
 )
-from git_gerrit.core import (
-    CHANGE_FIELDS,
-    LOG_FIELDS,
-    cherry_pick,
-    fetch,
-    get_current_change,
-    log,
-    query,
-    sync,
-    update,
-)
+
+# The git and core modules are imported on first use, so the command line
+# client can forward a command to a running daemon without paying for them.
+_LAZY_NAMES = {
+    'Git': 'git_gerrit.git',
+    'CACHE_TTL': 'git_gerrit.rest',
+    'CHANGE_FIELDS': 'git_gerrit.core',
+    'DETAILS_CONCURRENCY': 'git_gerrit.core',
+    'GREP_FIELDS': 'git_gerrit.core',
+    'LOG_FIELDS': 'git_gerrit.core',
+    'cherry_pick': 'git_gerrit.core',
+    'fetch': 'git_gerrit.core',
+    'fetch_changes': 'git_gerrit.core',
+    'get_current_change': 'git_gerrit.core',
+    'grep': 'git_gerrit.core',
+    'log': 'git_gerrit.core',
+    'query': 'git_gerrit.core',
+    'sync': 'git_gerrit.core',
+    'update': 'git_gerrit.core',
+    'update_changes': 'git_gerrit.core',
+    'update_changes_rest': 'git_gerrit.core',
+}
+
+
+def __getattr__(name):
+    module = _LAZY_NAMES.get(name)
+    if module is None:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    value = getattr(importlib.import_module(module), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(list(globals()) + list(_LAZY_NAMES))
+
 
 _hush_linter = [
     VERSION,
-    CHANGE_FIELDS,
-    LOG_FIELDS,
-    Git,
     GitGerritError,
     GitGerritConfigError,
     GitGerritFormatError,
     GitGerritNotFoundError,
-    cherry_pick,
-    fetch,
-    get_current_change,
-    log,
-    query,
-    sync,
-    update,
 ]
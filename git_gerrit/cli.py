@@ -21,17 +21,129 @@
 """git-gerrit command line interface"""
 
 import argparse
+import functools
 import pprint
+import re
+import string
 import sys
 import textwrap
 import json
 
 import git_gerrit
-from git_gerrit.git import Git
+from git_gerrit import daemon
 from git_gerrit.spinner import Spinner
 from git_gerrit.error import GitGerritError, GitGerritFormatError
 
 
+def forwarded(main):
+    """Forward the command to a running daemon when run from the command line."""
+    command = main.__name__.replace('main_git_gerrit_', '')
+
+    @functools.wraps(main)
+    def wrapper(argv=None):
+        if argv is None:
+            argv = sys.argv[1:]
+            exit_code = daemon.forward(command, argv)
+            if exit_code is not None:
+                return exit_code
+        return main(argv)
+
+    return wrapper
+
+
+def add_cache_arguments(parser):
+    """Add the REST API response cache options."""
+    parser.add_argument(
+        '--no-cache',
+        dest='cache',
+        action='store_false',
+        help='do not use the cached gerrit responses',
+    )
+    parser.add_argument(
+        '--cache-ttl',
+        metavar='<seconds>',
+        type=float,
+        default=git_gerrit.CACHE_TTL,
+        help='seconds to use a cached response before checking if it changed '
+        f'(default: {git_gerrit.CACHE_TTL})',
+    )
+
+
+def add_verbose_argument(parser):
+    """Add the option to print the REST API connection counters."""
+    parser.add_argument(
+        '-v',
+        '--verbose',
+        action='store_true',
+        help='print the number of gerrit REST API requests and connections',
+    )
+
+
+def print_rest_stats():
+    """Print the REST API connection counters to stderr."""
+    from git_gerrit import rest
+
+    stats = rest.stats()
+    print(
+        f"REST API requests: {stats['requests']}, "
+        f"new connections: {stats['new_connections']}, "
+        f"reused connections: {stats['reused_connections']}",
+        file=sys.stderr,
+    )
+
+
+def add_change_arguments(parser):
+    """Add the change numbers and --query options of the fetch commands."""
+    parser.add_argument(
+        '--query',
+        metavar='<search>',
+        help='fetch the changes matching the gerrit search terms',
+    )
+    parser.add_argument(
+        '--offline',
+        action='store_true',
+        help='use only the refs and metadata stored by git gerrit-sync',
+    )
+    parser.add_argument(
+        'number', metavar='<number>', type=int, nargs='*', help='legacy change number'
+    )
+
+
+def check_change_arguments(parser, number, search):
+    """Exit with a usage error unless either numbers or --query were given."""
+    if number and search:
+        parser.error('specify <number> or --query, not both')
+    if not number and not search:
+        parser.error('specify <number> or --query')
+
+
+def template_fields(template, valid_fields):
+    """
+    Return the names of the fields referenced by a --format template.
+
+    When valid_fields is None, only the template syntax is checked, since the
+    fields are not known ahead, e.g., the keys of the gerrit change info.
+
+    raises:
+        GitGerritFormatError if the template is malformed or references
+        an unknown field
+    """
+    names = set()
+    try:
+        for _, name, spec, _ in string.Formatter().parse(template):
+            if name is None:
+                continue
+            root = re.match(r'[^.\[]*', name).group(0)
+            if valid_fields is not None and root not in valid_fields:
+                raise GitGerritFormatError(f"unknown field '{root}'")
+            names.add(root)
+            if spec:
+                names.update(template_fields(spec, valid_fields))
+    except ValueError as e:
+        raise GitGerritFormatError(e)
+    return names
+
+
 def format_change(template, change):
     try:
         return template.format(**change)
@@ -60,7 +172,7 @@ def main_git_gerrit_checkout(argv=None):
     if argv is None:
         argv = sys.argv[1:]
 
-    git = Git()
+    git = git_gerrit.Git.shared()
     branch = git.config('checkoutbranch')
     if not branch:
         branch_desc = "[do not create a branch]"
@@ -77,6 +189,9 @@ git config options:
   gerrit.host            Specifies the gerrit hostname (required).
   gerrit.project         Specifies the gerrit project name (required).
   gerrit.checkoutbranch  Default git-gerrit-checkout --branch value (optional).
+  gerrit.syncmaxage      Use the refs mirrored by git gerrit-sync, without
+                         contacting gerrit, when the last sync is at most this
+                         many seconds old (default: 0, never).
 """,
     )
     group = parser.add_mutually_exclusive_group()
@@ -91,18 +206,24 @@ git config options:
         action='store_true',
         help='do not create a local branch',
     )
-    parser.add_argument(
-        'number', metavar='<number>', type=int, help='legacy change number'
-    )
+    add_change_arguments(parser)
     args = vars(parser.parse_args(argv))
     number = args.pop('number')
+    search = args.pop('query')
+    check_change_arguments(parser, number, search)
     args['checkout'] = True
     no_branch = args.pop('no_branch')
     if no_branch:
         args['branch'] = None
 
     try:
-        git_gerrit.fetch(number, **args)
+        if search:
+            offline = args.pop('offline')
+            changes = git_gerrit.query(search, offline=offline)
+            remote = '.' if offline else None
+            git_gerrit.fetch_changes(changes, remote=remote, **args)
+        else:
+            git_gerrit.fetch(number, **args)
     except GitGerritError as e:
         print(str(e), file=sys.stderr)
         return 1
@@ -167,12 +288,68 @@ Example:
     return 0
 
 
+def main_git_gerrit_daemon(argv=None):
+    """Run a resident process to speed up the lookup commands."""
+    if argv is None:
+        argv = sys.argv[1:]
+    commands = ', '.join(f"git gerrit-{c}" for c in daemon.FORWARDED_COMMANDS)
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        prog='git-gerrit-daemon',
+        description=main_git_gerrit_daemon.__doc__.strip(),
+        epilog=f"""
+While the daemon is running, the {commands}
+commands run in the daemon process, which keeps the git config values and the
+database open between commands. The daemon listens on a unix socket in the
+.git directory. Set GIT_GERRIT_NO_DAEMON=1 to run the commands without it.
+""",
+    )
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument(
+        '--detach', action='store_true', help='run the daemon in the background'
+    )
+    group.add_argument('--stop', action='store_true', help='stop the daemon')
+    group.add_argument(
+        '--status', action='store_true', help='show whether the daemon is running'
+    )
+    parser.add_argument(
+        '--idle-timeout',
+        metavar='<seconds>',
+        default=0,
+        type=float,
+        help='exit after being idle for this many seconds (default: no timeout)',
+    )
+    args = parser.parse_args(argv)
+
+    try:
+        git_dir = git_gerrit.Git.shared().git_dir()
+        if args.status:
+            pid = daemon.status(git_dir)
+            if pid is None:
+                print("The daemon is not running.")
+                return 1
+            print(f"The daemon is running (pid {pid}).")
+        elif args.stop:
+            if not daemon.stop(git_dir):
+                print("The daemon is not running.", file=sys.stderr)
+                return 1
+        else:
+            daemon.serve(idle_timeout=args.idle_timeout, detach=args.detach)
+    except GitGerritError as e:
+        print(str(e), file=sys.stderr)
+        return 1
+    except (KeyboardInterrupt, BrokenPipeError):
+        return 1
+
+    return 0
+
+
 def main_git_gerrit_fetch(argv=None):
     """Fetch by gerrit number."""
     if argv is None:
         argv = sys.argv[1:]
 
-    git = Git()
+    git = git_gerrit.Git.shared()
     branch = git.config('fetchbranch')
     if not branch:
         branch_desc = "[do not create a branch]"
@@ -189,6 +366,18 @@ git config options:
   gerrit.host           Specifies the gerrit hostname (required).
   gerrit.project        Specifies the gerrit project name (required).
   gerrit.fetchbranch    Default git-gerrit-fetch --branch value (optional).
+  gerrit.syncmaxage     Use the refs mirrored by git gerrit-sync, without
+                        contacting gerrit, when the last sync is at most this
+                        many seconds old (default: 0, never).
+
+Several changes, given by number or with --query, are fetched with one git
+fetch. The --branch value is a template formatted with the fields of each
+change.
+
+Examples:
+
+  $ git gerrit-fetch --branch='gerrit/{number}' 12977 12978 12979
+  $ git gerrit-fetch --branch='gerrit/{number}' --query='is:open topic:foo'
 """,
     )
     parser.add_argument(
@@ -206,17 +395,94 @@ git config options:
         action='store_true',
         help='do not create a local branch',
     )
-    parser.add_argument(
-        'number', metavar='<number>', type=int, help='legacy change number'
-    )
+    add_cache_arguments(parser)
+    add_change_arguments(parser)
     args = vars(parser.parse_args(argv))
     number = args.pop('number')
+    search = args.pop('query')
+    check_change_arguments(parser, number, search)
     no_branch = args.pop('no_branch')
     if no_branch:
         args['branch'] = None
 
     try:
-        git_gerrit.fetch(number, **args)
+        if search:
+            offline = args.pop('offline')
+            cache = args.pop('cache')
+            cache_ttl = args.pop('cache_ttl')
+            changes = git_gerrit.query(
+                search, cache=cache, cache_ttl=cache_ttl, offline=offline
+            )
+            remote = '.' if offline else None
+            git_gerrit.fetch_changes(changes, remote=remote, **args)
+        else:
+            git_gerrit.fetch(number, **args)
+    except GitGerritError as e:
+        print(str(e), file=sys.stderr)
+        return 1
+    except (KeyboardInterrupt, BrokenPipeError):
+        return 1
+
+    return 0
+
+
+@forwarded
+def main_git_gerrit_grep(argv=None):
+    """Search the commit messages of the synced changes."""
+    if argv is None:
+        argv = sys.argv[1:]
+    git = git_gerrit.Git.shared()
+    template = git.config('grepformat')
+    fields_help = textwrap.fill(', '.join(sorted(git_gerrit.GREP_FIELDS)))
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        prog='git-gerrit-grep',
+        description=main_git_gerrit_grep.__doc__.strip(),
+        epilog=f"""
+The commit messages are indexed by git gerrit-sync. Each phrase is matched
+against whole words, ignoring case and punctuation, and the changes with all
+of the phrases are shown. End a phrase with '*' to match words by prefix.
+
+Available --format template fields:
+
+{fields_help}
+
+git config options:
+
+  gerrit.grepformat     Default git-gerrit-grep --format value (optional).
+  gerrit.remote         Remote name of the localref --format field (default: origin)
+
+Example:
+
+  $ git gerrit-grep 'fix the frob*'
+  1234 fix the frobnicator
+""",
+    )
+    parser.add_argument(
+        '-n',
+        '--limit',
+        dest='limit',
+        metavar='<number>',
+        type=int,
+        help='limit the number of results',
+    )
+    parser.add_argument(
+        '-f',
+        '--format',
+        metavar='<format>',
+        default=template,
+        help='output format template (default: "' + template + '")',
+    )
+    parser.add_argument(
+        'phrases', metavar='<phrase>', nargs='+', help='words to search for'
+    )
+    args = vars(parser.parse_args(argv))
+    template = args.pop('format')
+
+    try:
+        template_fields(template, git_gerrit.GREP_FIELDS)
+        for change in git_gerrit.grep(**args):
+            print(format_change(template, change))
     except GitGerritError as e:
         print(str(e), file=sys.stderr)
         return 1
@@ -259,7 +525,7 @@ def main_git_gerrit_install_hooks(argv=None):
     """Install git hooks to create gerrit change-ids."""
     if argv is None:
         argv = sys.argv[1:]
-    git = Git()
+    git = git_gerrit.Git.shared()
     parser = argparse.ArgumentParser(
         formatter_class=argparse.RawDescriptionHelpFormatter,
         prog='git-gerrit-install-hooks',
@@ -286,11 +552,12 @@ git config options:
     return 0
 
 
+@forwarded
 def main_git_gerrit_log(argv=None):
     """Show oneline log with gerrit numbers."""
     if argv is None:
         argv = sys.argv[1:]
-    git = Git()
+    git = git_gerrit.Git.shared()
     template = git.config('logformat')
     fields_help = textwrap.fill(', '.join(sorted(git_gerrit.LOG_FIELDS)))
     parser = argparse.ArgumentParser(
@@ -333,7 +600,8 @@ git config options:
     template = args.pop('format')
 
     try:
-        for commit in git_gerrit.log(**args):
+        fields = template_fields(template, git_gerrit.LOG_FIELDS)
+        for commit in git_gerrit.log(fields=fields, **args):
             print(format_change(template, commit))
     except GitGerritError as e:
         print(str(e), file=sys.stderr)
@@ -344,11 +612,12 @@ git config options:
     return 0
 
 
+@forwarded
 def main_git_gerrit_query(argv=None):
     """Search gerrit."""
     if argv is None:
         argv = sys.argv[1:]
-    git = Git()
+    git = git_gerrit.Git.shared()
     template = git.config('queryformat')
     fields_help = textwrap.fill(', '.join(sorted(git_gerrit.CHANGE_FIELDS)))
     parser = argparse.ArgumentParser(
@@ -366,6 +635,7 @@ git config options:
   gerrit.project        Specifies the gerrit project name (required).
   gerrit.queryformat    Default git-gerrit-query --format value (optional).
   gerrit.remote         Remote name of the localref --format field (default: origin)
+  gerrit.poolsize       Maximum number of open REST API connections (default: 10)
 """,
     )
 
@@ -388,14 +658,55 @@ git config options:
     parser.add_argument(
         '--details', help='get extra details for debug --dump', action='store_true'
     )
+    parser.add_argument(
+        '--page-size',
+        metavar='<number>',
+        type=int,
+        help='number of results to request at a time (default: server limit)',
+    )
+    parser.add_argument(
+        '--concurrency',
+        metavar='<number>',
+        type=int,
+        default=git_gerrit.DETAILS_CONCURRENCY,
+        help='number of --details requests to run at a time '
+        f'(default: {git_gerrit.DETAILS_CONCURRENCY})',
+    )
+    add_cache_arguments(parser)
+    add_verbose_argument(parser)
+    parser.add_argument(
+        '--offline',
+        action='store_true',
+        help='search the change metadata stored by git gerrit-sync --metadata; '
+        'supports the status:, branch:, topic:, owner:, change:, and project: '
+        'operators, and free text',
+    )
     parser.add_argument('term', metavar='<term>', nargs='+', help='search term')
     args = vars(parser.parse_args(argv))
     search = ' '.join(args.pop('term'))
     template = args.pop('format')
     dump = args.pop('dump')
+    verbose = args.pop('verbose')
+    if args['concurrency'] < 1:
+        parser.error('--concurrency must be at least 1')
+    if args['page_size'] is not None and args['page_size'] < 1:
+        parser.error('--page-size must be at least 1')
 
+    exit_code = 0
     try:
+        if not dump:
+            # The online changes have all of the gerrit change info keys, so
+            # only the offline fields are known ahead.
+            offline_fields = git_gerrit.CHANGE_FIELDS if args['offline'] else None
+            template_fields(template, offline_fields)
         for change in git_gerrit.query(search, **args):
+            if '_detail_error' in change:
+                print(
+                    f"Unable to get details of change {change['number']}: "
+                    f"{change['_detail_error']}",
+                    file=sys.stderr,
+                )
+                exit_code = 1
             if dump:
                 pprint.pprint(change)
             else:
@@ -405,15 +716,19 @@ git config options:
         return 1
     except (KeyboardInterrupt, BrokenPipeError):
         return 1
+    finally:
+        if verbose:
+            print_rest_stats()
 
-    return 0
+    return exit_code
 
 
+@forwarded
 def main_git_gerrit_number(argv=None):
     """Show info for a gerrit change number."""
     if argv is None:
         argv = sys.argv[1:]
-    git = Git()
+    git = git_gerrit.Git.shared()
     parser = argparse.ArgumentParser(
         formatter_class=argparse.RawDescriptionHelpFormatter,
         prog='git-gerrit-number',
@@ -495,9 +810,38 @@ git config options:
         metavar='<number>',
         default=1000,
         type=int,
-        help='limit the number of commits to scan',
+        help='limit the number of commits to scan (0 for no limit)',
+    )
+    parser.add_argument(
+        '-j',
+        '--jobs',
+        dest='jobs',
+        metavar='<number>',
+        default=1,
+        type=int,
+        help='number of parallel commit scanning jobs (default: 1)',
     )
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument(
+        '-i',
+        '--incremental',
+        action='store_true',
+        help='fetch only the changes which are new or moved since the last sync',
+    )
+    group.add_argument(
+        '--rest',
+        action='store_true',
+        help='fetch only the changes the gerrit REST API reports as updated '
+        'since the last sync',
+    )
+    parser.add_argument(
+        '--metadata',
+        action='store_true',
+        help='also store the change metadata for git gerrit-query --offline',
+    )
+    add_verbose_argument(parser)
     args = vars(parser.parse_args(argv))
+    verbose = args.pop('verbose')
 
     try:
         git_gerrit.sync(**args)
@@ -506,6 +850,9 @@ git config options:
         return 1
     except (KeyboardInterrupt, BrokenPipeError):
         return 1
+    finally:
+        if verbose:
+            print_rest_stats()
 
     return 0
 
@@ -521,7 +868,8 @@ def main_git_gerrit_update(argv=None):
         epilog="""
 authentication required:
 
-  gerrit account and associated ssh key
+  gerrit account and associated ssh key, or with --rest, the gerrit host and
+  HTTP credentials in ~/.netrc
 
 git config options:
 
@@ -533,6 +881,7 @@ examples:
   $ git gerrit-update --message="Good Job" --code-review="+1" change:12345
   $ git gerrit-update --add-reviewer="ty@example.com" is:open topic:foobar
   $ git gerrit-update --abandon --message="nevermind" branch:master topic:baz
+  $ git gerrit-update --rest --jobs=8 --verified="+1" topic:ci-passed
 """,
     )
     parser.add_argument(
@@ -564,24 +913,55 @@ examples:
         action='append',
         help='Invite reviewer (this option may be given more than once)',
     )
+    parser.add_argument(
+        '--rest',
+        action='store_true',
+        help='update the changes with the gerrit REST API instead of ssh',
+    )
+    parser.add_argument(
+        '-j',
+        '--jobs',
+        metavar='<number>',
+        type=int,
+        default=1,
+        help='number of changes to update at a time with --rest (default: 1)',
+    )
     parser.add_argument('term', metavar='<term>', nargs='+', help='search term')
     args = vars(parser.parse_args(argv))
     dryrun = args.pop('dryrun')
+    use_rest = args.pop('rest')
+    jobs = args.pop('jobs')
     search = ' '.join(args.pop('term'))
+    if jobs < 1:
+        parser.error('--jobs must be at least 1')
 
+    # Never vote on a cached (possibly superseded) patchset.
+    exit_code = 0
     try:
-        for change in git_gerrit.query(search):
-            number = change['number']
-            subject = change['subject']
-            if dryrun:
-                print(f"Skipping (dry-run): {number} {subject}")
-            else:
-                print(f"Updating: {number} {subject}")
-                git_gerrit.update(number, **args)
+        if dryrun:
+            for change in git_gerrit.query(search, cache=False):
+                print(f"Skipping (dry-run): {change['number']} {change['subject']}")
+        elif use_rest:
+            changes = git_gerrit.query(search, cache=False)
+            results = git_gerrit.update_changes_rest(changes, jobs=jobs, **args)
+            for change, error in results:
+                number = change['number']
+                subject = change['subject']
+                if error:
+                    print(f"Failed: {number} {subject}: {error}", file=sys.stderr)
+                    exit_code = 1
+                else:
+                    print(f"Updated: {number} {subject}")
+        else:
+            changes = []
+            for change in git_gerrit.query(search, cache=False):
+                print(f"Updating: {change['number']} {change['subject']}")
+                changes.append(change)
+            git_gerrit.update_changes(changes, **args)
     except GitGerritError as e:
         print(str(e), file=sys.stderr)
         return 1
     except (KeyboardInterrupt, BrokenPipeError):
         return 1
 
-    return 0
+    return exit_code
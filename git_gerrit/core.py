@@ -23,14 +23,18 @@ Git helpers for the Gerrit code review system, with an emphasis on the Gerrit
 old-style numeric identifiers.
 """
 
-import re
+import collections
+import contextlib
 import subprocess
+import threading
+import concurrent.futures
+import datetime
+import json
+import shlex
+import sqlite3
 
-import pygerrit2.rest
-import urllib.parse
-import sh
-
-from git_gerrit.git import Git
+from git_gerrit import rest, ssh
+from git_gerrit.git import Git, parse_trailers
 from git_gerrit.db import GitGerritDB
 from git_gerrit.spinner import Spinner
 from git_gerrit.error import (
@@ -66,6 +70,34 @@ CHANGE_FIELDS = [
     'url',
 ]
 
+# Overlap of REST delta syncs, to allow for clock skew between the local
+# system and the gerrit server.
+SYNC_OVERLAP = datetime.timedelta(minutes=10)
+SYNC_TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+# Number of commits to lookup in the database at a time.
+LOG_CHUNK_SIZE = 500
+
+# The gerrit status values matched by the status: search operator offline.
+OFFLINE_STATUS = {
+    'open': ['NEW'],
+    'new': ['NEW'],
+    'pending': ['NEW'],
+    'merged': ['MERGED'],
+    'abandoned': ['ABANDONED'],
+    'closed': ['MERGED', 'ABANDONED'],
+}
+
+# Maximum length of the ssh command lines run by update_changes().
+SSH_COMMAND_LENGTH = 32768
+
+# Number of change details to fetch at a time with query(details=True).
+DETAILS_CONCURRENCY = 8
+
+# Separators of the git log --pretty fields and trailer values.
+FIELD_SEPARATOR = "\x1f"
+VALUE_SEPARATOR = "\x00"
+
 LOG_FIELDS = (
     'author',
     'change_id',
@@ -80,6 +112,27 @@ LOG_FIELDS = (
     'subject',
 )
 
+GREP_FIELDS = (
+    'change_id',
+    'hash',
+    'host',
+    'localref',
+    'number',
+    'patchset',
+    'ref',
+    'subject',
+    'url',
+)
+
+# LOG_FIELDS which are looked up in the local database.
+LOG_DB_FIELDS = {
+    'change_id',
+    'number',
+    'patchset',
+    'picked_from',
+    'ref',
+}
+
 
 def cherry_pick(number, branch='origin/master'):
     """
@@ -92,10 +145,10 @@ def cherry_pick(number, branch='origin/master'):
     returns:
         non-zero on error
     """
-    git = Git()
+    git = Git.shared()
 
     sha1 = None
-    for commit in log(revision=branch, shorthash=False):
+    for commit in log(revision=branch, shorthash=False, fields=('number', 'hash')):
         if commit['number'] == number:
             sha1 = commit['hash']
             break
@@ -106,16 +159,26 @@ def cherry_pick(number, branch='origin/master'):
     git.cherry_pick(sha1)
 
 
-def current_change(number):
+def current_change(number, cache=True, cache_ttl=rest.CACHE_TTL):
     """
     Look up the current change in gerrit.
 
     args:
         number (int):  the gerrit change number
+        cache (bool): use the cached responses
+        cache_ttl (float): seconds to use a cached response before revalidating
     returns:
         a current change dictionary (including the current patchset number)
     """
-    changes = list(query(f"change:{number}", limit=1, current_revision=True))
+    changes = list(
+        query(
+            f"change:{number}",
+            limit=1,
+            current_revision=True,
+            cache=cache,
+            cache_ttl=cache_ttl,
+        )
+    )
     if not changes or len(changes) != 1:
         raise GitGerritNotFoundError(f"gerrit {format} not found")
     change = changes[0]
@@ -126,7 +189,7 @@ def get_current_change(number):
     """
     Lookup the current change in the local database.
     """
-    with GitGerritDB() as db:
+    with GitGerritDB.open() as db:
         change = db.get_current_patchset_by_number(number)
         if change is None:
             raise GitGerritNotFoundError(f"Change {number} not found.")
@@ -162,54 +225,213 @@ def get_current_change(number):
     return change
 
 
+def current_changes(numbers, cache=True, cache_ttl=rest.CACHE_TTL):
+    """
+    Look up the current changes in gerrit with one query.
+
+    args:
+        numbers (list):  the gerrit change numbers
+        cache (bool): use the cached responses
+        cache_ttl (float): seconds to use a cached response before revalidating
+    returns:
+        list of current change dictionaries, in the order of the numbers
+    raises:
+        GitGerritNotFoundError if a change is not found
+    """
+    numbers = list(dict.fromkeys(numbers))
+    search = ' OR '.join(f"change:{number}" for number in numbers)
+    found = {}
+    for change in query(
+        f"({search})",
+        limit=len(numbers),
+        current_revision=True,
+        cache=cache,
+        cache_ttl=cache_ttl,
+    ):
+        found[change['number']] = change
+    missing = [str(number) for number in numbers if number not in found]
+    if missing:
+        raise GitGerritNotFoundError(f"gerrit {', '.join(missing)} not found")
+    return [found[number] for number in numbers]
+
+
+def local_changes(numbers, max_age=None):
+    """
+    Look up the current patchsets of changes in the refs mirrored by sync.
+
+    args:
+        numbers (list):  the gerrit change numbers
+        max_age (float): maximum age of the last sync in seconds, or None for
+                         any age
+    returns:
+        list of change dicts with the number, patchset, ref, hash, and
+        change_id fields, in the order of the numbers, or None if the last
+        sync is too old, or a change or its ref is not found locally
+    """
+    git = Git.shared()
+    changes = []
+    with GitGerritDB.open() as db:
+        last_sync = db.get_property('last_sync')
+        if not last_sync:
+            return None
+        if max_age is not None:
+            synced = datetime.datetime.strptime(last_sync, SYNC_TIME_FORMAT)
+            synced = synced.replace(tzinfo=datetime.timezone.utc)
+            age = datetime.datetime.now(datetime.timezone.utc) - synced
+            if age.total_seconds() > max_age:
+                return None
+        for number in numbers:
+            current = db.get_current_patchset_by_number(number)
+            if current is None:
+                return None
+            patchset = current['current_patchset']
+            changes.append(
+                {
+                    'number': number,
+                    'patchset': patchset,
+                    'ref': f"refs/changes/{number % 100:02}/{number}/{patchset}",
+                    'hash': current['commit_id'],
+                    'change_id': current['change_id'] or "",
+                }
+            )
+    for change in changes:
+        if not git.does_ref_exist(change['ref']):
+            return None
+    return changes
+
+
 def fetch(
     number,
     branch=None,
     checkout=False,
+    cache=True,
+    cache_ttl=rest.CACHE_TTL,
+    offline=False,
+    max_age=None,
 ):
     """
-    Fetch a gerrit by the legacy change number.
+    Fetch gerrits by the legacy change numbers.
+
+    When the changes were mirrored by a sync at most `max_age` seconds ago, or
+    when offline, the branch is created from the local refs without
+    contacting the gerrit server.
 
     args:
-        number (int):     legacy gerrit number
-        branch (str):     local branch name to fetch to.
+        number (int):     legacy gerrit number, or a list of numbers
+        branch (str):     local branch name template to fetch to.
         checkout (bool):  checkout after fetch
+        cache (bool):     use the cached responses to find the current patchset
+        cache_ttl (float): seconds to use a cached response before revalidating
+        offline (bool):   use only the local refs mirrored by sync
+        max_age (float):  maximum age in seconds of the last sync for the local
+                          refs to be used (default: gerrit.syncmaxage, 0 never)
     returns:
-        None
+        None, or 1 if a branch already exists
     raises:
         GitGerritNotFoundError
     """
-    git = Git()
+    numbers = [number] if isinstance(number, int) else list(number)
+    if checkout and len(numbers) > 1:
+        raise GitGerritError("Specify only one change to checkout.")
+    if max_age is None:
+        max_age = Git.shared().config('syncmaxage')
+
+    if len(numbers) == 1:
+        print(f"searching for gerrit {numbers[0]}")
+    else:
+        print(f"searching for gerrits {', '.join(str(n) for n in numbers)}")
+
+    if offline or max_age > 0:
+        changes = local_changes(numbers, None if offline else max_age)
+        if changes and branch:
+            try:
+                for change in changes:
+                    branch.format(**change)
+            except (KeyError, IndexError) as e:
+                # The template needs fields which are only known by gerrit.
+                if offline:
+                    raise GitGerritError(f"Unknown offline branch field {e}.")
+                changes = None
+        if changes:
+            found = ' '.join(f"{c['number']},{c['patchset']}" for c in changes)
+            print(f"found {found} in the local refs")
+            return fetch_changes(changes, branch=branch, checkout=checkout, remote='.')
+        if offline:
+            raise GitGerritNotFoundError(
+                f"gerrit {', '.join(str(n) for n in numbers)} not found in the "
+                "local refs; run git gerrit-sync"
+            )
+
+    if len(numbers) == 1:
+        changes = [current_change(numbers[0], cache=cache, cache_ttl=cache_ttl)]
+        print(f"found patchset number {changes[0]['patchset']}")
+    else:
+        changes = current_changes(numbers, cache=cache, cache_ttl=cache_ttl)
+        found = ' '.join(f"{c['number']},{c['patchset']}" for c in changes)
+        print(f"found patchsets {found}")
+    return fetch_changes(changes, branch=branch, checkout=checkout)
+
+
+def fetch_changes(changes, branch=None, checkout=False, remote=None):
+    """
+    Fetch the current patchsets of changes with one git fetch.
+
+    args:
+        changes (list):   change dicts, e.g., the query() results
+        branch (str):     local branch name template to fetch to, formatted
+                          with the fields of each change
+        checkout (bool):  checkout after fetch (only one change)
+        remote (str):     remote to fetch from (default: the gerrit remote),
+                          e.g., "." for the local refs
+    returns:
+        None, or 1 if a branch already exists; the other changes are fetched
+    """
+    git = Git.shared()
 
-    print(f"searching for gerrit {number}")
-    change = current_change(number)
-    patchset = change['patchset']
-    print(f"found patchset number {patchset}")
+    changes = list(changes)
+    if checkout and len(changes) > 1:
+        raise GitGerritError("Specify only one change to checkout.")
+    if not changes:
+        print("no gerrits to fetch")
+        return None
 
     if not branch:
-        refs = str(change['ref'])
-        print(f"fetching {number},{patchset}")
-        git.fetch(refs)
-        print(f"fetched {number},{patchset} to FETCH_HEAD")
+        revisions = ' '.join(f"{c['number']},{c['patchset']}" for c in changes)
+        refspecs = [str(c['ref']) for c in changes]
+        print(f"fetching {revisions}")
+        git.fetch(refspecs[0] if len(refspecs) == 1 else refspecs, remote=remote)
+        print(f"fetched {revisions} to FETCH_HEAD")
         if checkout:
             git.checkout("FETCH_HEAD")
             print("checked out FETCH_HEAD")
-    else:
-        branch = branch.format(**change)
-        if git.does_branch_exist(branch):
-            print(f"branch {branch} already exists")
-            return 1
-        ref = change['ref']
-        refs = f"{ref}:{branch}"
-        print(f"fetching {number},{patchset} to branch {branch}")
-        git.fetch(refs)
-        print(f"fetched {number},{patchset} to branch {branch}")
-        if checkout:
-            git.checkout(branch)
-            print(f"checked out branch {branch}")
+        return None
+
+    result = None
+    fetches = []
+    for change in changes:
+        name = branch.format(**change)
+        if git.does_branch_exist(name):
+            print(f"branch {name} already exists")
+            result = 1
+            continue
+        fetches.append((change, name))
+    if not fetches:
+        return result
+
+    refspecs = []
+    for change, name in fetches:
+        print(f"fetching {change['number']},{change['patchset']} to branch {name}")
+        refspecs.append(f"{change['ref']}:{name}")
+    git.fetch(refspecs[0] if len(refspecs) == 1 else refspecs, remote=remote)
+    for change, name in fetches:
+        print(f"fetched {change['number']},{change['patchset']} to branch {name}")
+    if checkout:
+        git.checkout(fetches[0][1])
+        print(f"checked out branch {fetches[0][1]}")
+    return result
 
 
-def log(number=None, reverse=False, shorthash=True, revision=None):
+def log(number=None, reverse=False, shorthash=True, revision=None, fields=None):
     """
     Retrieve log entries with gerrit numbers (extracted from the commit
     messages) from the local git repository.
@@ -219,104 +441,122 @@ def log(number=None, reverse=False, shorthash=True, revision=None):
         reverse (bool):   reverse log order
         shorthash (bool): short sha1
         revision (str):   git revision to log (default is HEAD)
+        fields (iterable): LOG_FIELDS names to populate (default is all) [optional]
     yields:
-        dictionary with keys LOG_FIELDS
+        dictionary with keys LOG_FIELDS; fields not requested are empty strings
     """
-    git = Git()
+    git = Git.shared()
+
+    if fields is None:
+        fields = LOG_FIELDS
+    fields = set(fields)
+    unknown = fields.difference(LOG_FIELDS)
+    if unknown:
+        raise ValueError(f"Unknown log fields: {', '.join(sorted(unknown))}")
+
+    # Determine the database lookups needed for the requested fields.
+    lookup_changes = bool(fields & LOG_DB_FIELDS)
+    lookup_picked_from = 'picked_from' in fields
+    lookup_picked_to = 'picked_to' in fields
 
     def blank():
         return {name: "" for name in LOG_FIELDS}
 
-    def populate_gerrit_fields(db, fields, commit_id):
-        change = db.get_change_by_commit(commit_id)
-        if change:
-            number = int(change['number'])
-            patchset = int(change['patchset'])
-            fields['number'] = number
-            fields['patchset'] = patchset
-            fields['ref'] = f"refs/changes/{number % 100:02}/{number}/{patchset}"
-            if change['change_id']:
-                fields['change_id'] = change['change_id']
-                if change['cherry_picked_from']:
-                    cpf = db.get_change_by_commit(change['cherry_picked_from'])
-                    if cpf:
-                        fields['picked_from'] = cpf['number']
-        picks = set()
-        for commit in db.get_cherry_picks_by_commit(commit_id):
-            change = db.get_change_by_commit(commit['commit_id'])
+    def populate_gerrit_fields(db, commits):
+        # Lookup the gerrit fields of a chunk of commits with a few queries.
+        oids = [oid for oid, _ in commits]
+        changes = {}
+        picks = {}
+        if lookup_changes:
+            changes = db.get_changes_by_commits(oids, picked_from=lookup_picked_from)
+        if lookup_picked_to:
+            picks = db.get_cherry_pick_numbers_by_commits(oids)
+        for oid, entry in commits:
+            change = changes.get(oid)
             if change:
-                picks.add(change['number'])
-        if picks:
-            picked_to = [str(p) for p in sorted(picks)]
-            fields['picked_to'] = ",".join(picked_to)
+                number = int(change['number'])
+                patchset = int(change['patchset'])
+                entry['number'] = number
+                entry['patchset'] = patchset
+                entry['ref'] = f"refs/changes/{number % 100:02}/{number}/{patchset}"
+                if change['change_id']:
+                    entry['change_id'] = change['change_id']
+                    if change['cherry_picked_from_number']:
+                        entry['picked_from'] = change['cherry_picked_from_number']
+            if oid in picks:
+                entry['picked_to'] = ",".join(str(p) for p in picks[oid])
+            # Fallback to the reviewed-on trailer if the change
+            # was not found in the database.
+            if not entry['number']:
+                entry['number'] = entry['reviewed_on']
+            for name in LOG_FIELDS:
+                if name not in fields:
+                    entry[name] = ""
+            yield entry
 
-    # Assemble the --pretty format template.
+    # Assemble the --pretty format template, with just the placeholders needed
+    # for the requested fields. Each commit is printed on one line, with the
+    # fields separated by the ASCII unit separator, and the trailer values
+    # separated by NUL characters. Only the trailers are requested, not the
+    # whole commit message body.
     tags = {
         "oid": "%H",
         "hash": "%h" if shorthash else "%H",
         "subject": "%s",
         "author": "%an",
         "email": "%ae",
-        "body": "%n%b",
+        "reviewed_on": "%(trailers:key=Reviewed-on,valueonly,separator=%x00)",
+        "change_id": "%(trailers:key=Change-Id,valueonly,separator=%x00)",
     }
-    terms = []
-    for k, v in tags.items():
-        terms.append(f"{k}:{v}")
-    terms.append("%%%%")  # End of body marker
+    needed = set(fields)
+    needed.add("oid")
+    if "number" in fields:
+        needed.add("reviewed_on")  # Fallback when not in the database.
+    tags = {k: v for k, v in tags.items() if k in needed}
     options = {
-        'pretty': "%n".join(terms),
+        'pretty': "%x1f".join(tags.values()),
         'reverse': reverse,
     }
     if number:
         options['max-count'] = number
 
-    with GitGerritDB() as db:
-        fields = blank()
+    if lookup_changes or lookup_picked_to:
+        context = GitGerritDB.open()
+    else:
+        context = contextlib.nullcontext()
+
+    with context as db:
+        commits = []
         for line in git.log(revision, **options):
-            m = re.match(r'^oid:(.*)', line)
-            if m:
-                populate_gerrit_fields(db, fields, m.group(1))
-                continue
-            m = re.match(r'^hash:(.*)', line)
-            if m:
-                fields['hash'] = m.group(1)
-                continue
-            m = re.match(r'^subject:(.*)', line)
-            if m:
-                fields['subject'] = m.group(1)
-                continue
-            m = re.match(r'^author:(.*)', line)
-            if m:
-                fields['author'] = m.group(1)
-                continue
-            m = re.match(r'^email:(.*)', line)
-            if m:
-                fields['email'] = m.group(1)
-                continue
-            m = re.match(r'^body:', line)  # Start of body.
-            if m:
-                continue
-            m = re.match(r'^Reviewed-on: .*/([0-9]+)$', line)
-            if m:
-                # Save the last Reviewed-on one seen in the body,
-                # there can be more than one in backported commits.
-                fields['reviewed_on'] = int(m.group(1))
-                continue
-            m = re.match(r'^Change-Id: (I[0-9a-fA-F]+)$', line)
-            if m:
-                # Save the first one seen. Normally each commit has zero or one
-                # change-id trailers.
-                if fields['change_id']:
-                    fields['change_id'] = m.group(1)
-                continue
-            m = re.match(r'^%%$', line)  # End of body.
-            if m:
-                # Fallback to the reviewed-on trailer if the change
-                # was not found in the database.
-                if not fields['number']:
-                    fields['number'] = fields['reviewed_on']
-                yield fields
-                fields = blank()
+            values = line.split(FIELD_SEPARATOR)
+            if len(values) < len(tags):
+                # Trailing empty fields are stripped from the line.
+                values.extend([""] * (len(tags) - len(values)))
+            record = dict(zip(tags, values))
+            entry = blank()
+            for name in ('hash', 'subject', 'author', 'email'):
+                if name in record:
+                    entry[name] = record[name]
+            # Save the last Reviewed-on one seen in the trailers,
+            # there can be more than one in backported commits.
+            for url in reversed(record.get('reviewed_on', '').split(VALUE_SEPARATOR)):
+                _, _, reviewed_on = url.rstrip().rpartition('/')
+                if reviewed_on.isdigit():
+                    entry['reviewed_on'] = int(reviewed_on)
+                    break
+            # Save the first one seen. Normally each commit has zero or one
+            # change-id trailers.
+            change_id = record.get('change_id', '').split(VALUE_SEPARATOR)[0].strip()
+            if change_id.startswith('I'):
+                entry['change_id'] = change_id
+
+            # Buffer the commits to lookup the gerrit fields in chunks.
+            commits.append((record['oid'], entry))
+            if len(commits) >= LOG_CHUNK_SIZE:
+                yield from populate_gerrit_fields(db, commits)
+                commits = []
+        if commits:
+            yield from populate_gerrit_fields(db, commits)
 
 
 def _flatten_change(change, host, remote):
@@ -351,19 +591,50 @@ def _flatten_change(change, host, remote):
     return change
 
 
-def query(search, limit=None, details=False, **options):
+def query(
+    search,
+    limit=None,
+    details=False,
+    concurrency=DETAILS_CONCURRENCY,
+    page_size=None,
+    cache=True,
+    cache_ttl=rest.CACHE_TTL,
+    offline=False,
+    **options,
+):
     """Search gerrit for changes.
 
+    The change details are fetched concurrently, but the changes are yielded
+    in the order returned by gerrit. When the details of a change cannot be
+    retrieved, the '_detail' of the change is None and the '_detail_error'
+    is the error message.
+
     args:
         search (str): one or more Gerrit search terms
+        limit (int): maximum number of changes
+        details (bool): retrieve the change details
+        concurrency (int): number of change details to fetch at a time
+        page_size (int): number of changes per request (default: server limit)
+        cache (bool): use the cached responses, see rest.ResponseCache
+        cache_ttl (float): seconds to use a cached response before revalidating
+        offline (bool): search the change metadata stored by sync(metadata=True)
+            instead of the gerrit server, see query_offline()
         options (dict): zero or more Gerrit search options
     returns:
         list of change info dicts
     """
-    git = Git()
+    if offline:
+        if details:
+            raise GitGerritError("Change details are not available offline.")
+        yield from query_offline(search, limit)
+        return
+
+    import urllib.parse
+
+    git = Git.shared()
     remote = git.config('remote')
     host = git.config('host')
-    gerrit = pygerrit2.rest.GerritRestAPI(f"https://{host}")
+    gerrit = rest.api(f"https://{host}", git.config('poolsize'))
 
     if 'project:' not in search:
         project = git.config('project')
@@ -372,37 +643,231 @@ def query(search, limit=None, details=False, **options):
     if 'current_revision' not in options:
         options['current_revision'] = True
 
-    # Gerrit limits the number of results per request, so loop to
-    # retrieve results in batches.
-    start = 0
-    more_changes = True
-    while more_changes:
+    if cache:
+        responses = rest.ResponseCache(cache_ttl)
+    else:
+        responses = contextlib.nullcontext()
+
+    def get(endpoint):
+        if cache:
+            return responses.get(gerrit, endpoint)
+        return gerrit.get(endpoint)
+
+    def get_page(start):
         # Setup query parameters.
         params = [('q', search)]
+        count = page_size
         if limit:
-            params.append(('n', (limit - start)))
+            count = min(count or limit, limit - start)
+        if count:
+            params.append(('n', count))
         if start:
             params.append(('S', start))
         for option in options:
             if options[option] is True:
                 params.append(('o', option.upper()))
         params = urllib.parse.urlencode(params)
+        return get(f"/changes/?{params}")
 
-        # Retrieve next batch.
-        for change in gerrit.get(f"/changes/?{params}"):
-            start += 1
-            more_changes = change.get('_more_changes', False)
-            change = _flatten_change(change, host, remote)
-            if details:
-                change_id = change['change_id']
-                change['_detail'] = gerrit.get(f"/changes/{change_id}/detail")
-            yield change
-            if limit and start >= limit:
-                more_changes = False
+    def search_changes():
+        # Gerrit limits the number of results per request, so retrieve the
+        # results in pages. The next page is requested in the background while
+        # the changes of the current page are yielded.
+        with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+            start = 0
+            page = executor.submit(get_page, start)
+            while page:
+                changes = page.result()
+                if limit:
+                    changes = changes[: limit - start]
+                start += len(changes)
+                page = None
+                more_changes = changes and changes[-1].get('_more_changes', False)
+                if more_changes and not (limit and start >= limit):
+                    page = executor.submit(get_page, start)
+                for change in changes:
+                    yield _flatten_change(change, host, remote)
 
+    with responses:
+        if details:
+            yield from _fetch_details(get, search_changes(), concurrency)
+        else:
+            yield from search_changes()
 
-def update(
-    number,
+
+def query_offline(search, limit=None):
+    """Search the change metadata stored in the local database.
+
+    Supports a subset of the Gerrit search operators: status:, branch:,
+    topic:, owner: (account id), change: (number or Change-Id), project:, and
+    free text, which is matched against the subjects. All of the terms must
+    match; OR, NOT, negated (-) terms, and parentheses are not supported.
+
+    args:
+        search (str): one or more search terms
+        limit (int): maximum number of changes
+    returns:
+        list of change info dicts, most recently updated first
+    raises:
+        GitGerritError if the search has unsupported terms
+    """
+    terms = []
+    text = []
+    try:
+        tokens = shlex.split(search)
+    except ValueError as e:
+        raise GitGerritError(f"Invalid search: {e}")
+    for token in tokens:
+        if token == 'AND':
+            continue
+        negated_or_grouped = token.startswith(('(', '-')) or token.endswith(')')
+        if ' ' not in token and (token in ('OR', 'NOT') or negated_or_grouped):
+            raise GitGerritError(
+                f"Unsupported offline search syntax '{token}'; "
+                "only terms joined by AND are supported."
+            )
+        name, sep, value = token.partition(':')
+        if not sep or ' ' in token:
+            text.append(token)  # Free text, or a quoted phrase.
+        elif name == 'status':
+            if value.lower() not in OFFLINE_STATUS:
+                raise GitGerritError(f"Unsupported offline search status '{value}'.")
+            terms.append(('status', OFFLINE_STATUS[value.lower()]))
+        elif name == 'change':
+            if value.isdigit():
+                terms.append(('number', [int(value)]))
+            else:
+                terms.append(('change_id', [value]))
+        elif name in ('branch', 'topic', 'owner', 'project'):
+            terms.append((name, [value]))
+        else:
+            raise GitGerritError(f"Unsupported offline search operator '{name}:'.")
+
+    if not any(name == 'project' for name, _ in terms):
+        terms.append(('project', [Git.shared().config('project')]))
+
+    with GitGerritDB.open() as db:
+        if not db.get_property('last_metadata_sync'):
+            raise GitGerritError(
+                "No change metadata. Run `git gerrit-sync --metadata` to store it."
+            )
+        yield from db.search_change_infos(terms, text, limit)
+
+
+def grep(phrases, limit=None):
+    """Search the commit messages indexed by sync.
+
+    The search is case insensitive and matches whole words. A phrase ending
+    with '*' also matches the words starting with the last word, e.g.,
+    'frob*' matches 'frobnicator'.
+
+    args:
+        phrases (list): one or more phrases, all of which must be found
+        limit (int): maximum number of changes
+    yields:
+        dictionary with keys GREP_FIELDS, highest change number first
+    """
+    git = Git.shared()
+    host = git.config('host')
+    remote = git.config('remote')
+
+    terms = []
+    for phrase in phrases:
+        prefix = phrase.endswith('*')
+        phrase = phrase.rstrip('*').replace('"', '""')
+        terms.append(f'"{phrase}"*' if prefix else f'"{phrase}"')
+    match = " AND ".join(terms)
+
+    with GitGerritDB.open() as db:
+        if not db.has_message_index:
+            raise GitGerritError(
+                "Searching commit messages requires SQLite with the FTS5 extension."
+            )
+        try:
+            for change in db.search_commit_messages(match, limit):
+                number = change['number']
+                ref = f"refs/changes/{number % 100:02}/{number}/{change['patchset']}"
+                yield {
+                    'change_id': change['change_id'] or "",
+                    'hash': change['commit_id'],
+                    'host': host,
+                    'localref': ref.replace('refs/', remote + '/'),
+                    'number': number,
+                    'patchset': change['patchset'],
+                    'ref': ref,
+                    'subject': change['subject'],
+                    'url': f"https://{host}/{number}",
+                }
+        except sqlite3.OperationalError as e:
+            raise GitGerritError(f"Invalid search: {e}")
+
+
+def _ordered_map(func, items, jobs, ahead=None):
+    """Call a function on each item with a pool of threads, in order.
+
+    At most `ahead` items (default: `jobs`) are submitted ahead of the one
+    being yielded, so the results are not all kept in memory.
+
+    args:
+        func (callable): function called with each item
+        items (iterable): the items
+        jobs (int): number of worker threads
+        ahead (int): number of items submitted ahead (optional)
+    yields:
+        (item, future) tuples in the order of the items, where the future
+        result is the return value of func(item)
+    """
+    ahead = ahead or jobs
+    pending = collections.deque()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        for item in items:
+            pending.append((item, executor.submit(func, item)))
+            if len(pending) >= ahead:
+                yield pending.popleft()
+        while pending:
+            yield pending.popleft()
+
+
+def _fetch_details(get, changes, concurrency):
+    """Fetch the change details concurrently, yielding the changes in order.
+
+    At most `concurrency` changes are read ahead of the one being yielded.
+    """
+    import requests
+
+    def get_detail(change):
+        return get(f"/changes/{change['change_id']}/detail")
+
+    def add_detail(change, future):
+        try:
+            change['_detail'] = future.result()
+        except (requests.RequestException, ValueError) as e:
+            change['_detail'] = None
+            change['_detail_error'] = str(e)
+        return change
+
+    for change, future in _ordered_map(get_detail, changes, concurrency):
+        yield add_detail(change, future)
+
+
+def _command_batches(base, items, max_length):
+    """Split the items into batches which fit on a command line after the base."""
+    base_length = len(' '.join(base))
+    batch = []
+    length = base_length
+    for item in items:
+        if batch and length + 1 + len(item) > max_length:
+            yield batch
+            batch = []
+            length = base_length
+        batch.append(item)
+        length += 1 + len(item)
+    if batch:
+        yield batch
+
+
+def update_changes(
+    changes,
     branch=None,
     message=None,
     code_review=None,
@@ -412,24 +877,36 @@ def update(
     add_reviewers=None,
     verbose=False,
 ):
-    """Submit review to gerrit using the ssh command line interface.
+    """Submit the same review to many changes using the ssh command line interface.
+
+    The changes are given to as few `gerrit review` and `gerrit set-reviewers`
+    commands as the SSH_COMMAND_LENGTH limit allows, run over the shared ssh
+    connection (see git_gerrit.ssh). The current patchset of a change is
+    looked up only when it is not given, so the query() results can be updated
+    without another request per change.
 
     Note: This method requires authentication. Create a gerrit account and
     import your ssh public key. See the Gerrit documentation.
 
     args:
-        number (int): gerrit id (requried)
+        changes (list): change dicts with the 'number' key, and optionally the
+            'patchset' key, e.g., the query() results (requried)
         branch (str): branch change is located (optional)
         message (str): review message to add (optional)
         code_review (str): code review vote to add (optional)
         verified (str): verication vote to add (optional)
         abandon (bool): set change status to abandoned
         restore (bool): set change status back to open if abandoned
+        add_reviewers (list): reviewers to invite (optional)
+        verbose (bool): print the ssh commands
     returns:
         None
+    raises:
+        GitGerritError if a gerrit command fails
     """
-    ssh = sh.Command('ssh')
-    git = Git()
+    import sh
+
+    git = Git.shared()
 
     if abandon and restore:
         raise ValueError('Specify only one of "abandon" or "restore".')
@@ -437,9 +914,11 @@ def update(
     if add_reviewers is None:
         add_reviewers = []
 
+    changes = list(changes)
     host = git.config('host')
     project = git.config('project')
     port = git.config('port')
+    session = ssh.session(host, port)
 
     def arg(name, value):
         if value is True:
@@ -448,52 +927,334 @@ def update(
             args.append('--' + name)
             args.append(subprocess.list2cmdline([value]))
 
+    def run(command, items):
+        base = ['-p', str(port), host, 'gerrit', command, *args]
+        for batch in _command_batches(['ssh', *base], items, SSH_COMMAND_LENGTH):
+            if verbose:
+                print('running: ssh', *base, *batch)
+            try:
+                session.run('gerrit', command, *args, *batch)
+            except sh.ErrorReturnCode as e:
+                stderr = e.stderr.decode(errors='replace').strip()
+                raise GitGerritError(f"gerrit {command} failed: {stderr}")
+
     args = []
     arg('message', message)
     arg('code-review', code_review)
     arg('verified', verified)
     arg('abandon', abandon)
     arg('restore', restore)
-    if args:
+    if args and changes:
         arg('project', project)
         arg('branch', branch)
-        change = current_change(number)
-        patchset = change['patchset']
-        changeid = f"{number},{patchset}"
-        args.append(changeid)
-        if verbose:
-            print('running: ssh', '-p', port, host, 'gerrit', 'review', *args)
-        ssh('-p', str(port), host, 'gerrit', 'review', *args)
+        revisions = []
+        for change in changes:
+            patchset = change.get('patchset')
+            if not patchset:
+                patchset = current_change(change['number'], cache=False)['patchset']
+            revisions.append(f"{change['number']},{patchset}")
+        run('review', revisions)
 
     args = []
     for reviewer in add_reviewers:
         arg('add', reviewer)
-    if args:
+    if args and changes:
         arg('project', project)
         arg('branch', branch)
-        args.append(number)
-        if verbose:
-            print('running: ssh', '-p', port, host, 'gerrit', 'set-reviewers', *args)
-        ssh('-p', str(port), host, 'gerrit', 'set-reviewers', *args)
+        run('set-reviewers', [str(change['number']) for change in changes])
 
     return 0
 
 
-def sync(limit=None):
-    git = Git()
+def _vote(label, value):
+    """Convert a vote, e.g., '+1', to an integer.
+
+    raises:
+        GitGerritError if the vote is not a number
+    """
+    try:
+        return int(value)
+    except ValueError:
+        raise GitGerritError(f"Invalid {label} vote: {value}")
+
+
+def update_changes_rest(
+    changes,
+    branch=None,
+    message=None,
+    code_review=None,
+    verified=None,
+    abandon=False,
+    restore=False,
+    add_reviewers=None,
+    verbose=False,
+    jobs=1,
+):
+    """Submit the same review to many changes using the Gerrit REST API.
+
+    The changes are updated by a pool of worker threads over the shared REST
+    session, and the results are yielded in the order of the changes. At most
+    `jobs` changes are updated ahead of the one being yielded.
+
+    Note: This method requires authentication. Add the gerrit host and your
+    HTTP credentials to ~/.netrc. See the Gerrit documentation.
+
+    args:
+        changes (iterable): change dicts with the 'number' key, and optionally
+            the 'current_revision' key, e.g., the query() results (requried)
+        branch (str): not used; the change numbers are unique
+        message (str): review message to add (optional)
+        code_review (str): code review vote to add (optional)
+        verified (str): verication vote to add (optional)
+        abandon (bool): set change status to abandoned
+        restore (bool): set change status back to open if abandoned
+        add_reviewers (list): reviewers to invite (optional)
+        verbose (bool): print the REST API requests
+        jobs (int): number of changes to update at a time
+    yields:
+        (change, error) tuples, where error is None when the change was updated
+    raises:
+        GitGerritError if a vote is not a number, or if there are no
+        credentials for the gerrit host
+    """
+    import requests
+
+    git = Git.shared()
+
+    if abandon and restore:
+        raise ValueError('Specify only one of "abandon" or "restore".')
+
+    if add_reviewers is None:
+        add_reviewers = []
+
+    labels = {}
+    if code_review:
+        labels['Code-Review'] = _vote('code-review', code_review)
+    if verified:
+        labels['Verified'] = _vote('verified', verified)
+
+    host = git.config('host')
+    gerrit = rest.api(f"https://{host}", git.config('poolsize'))
+    if not gerrit.auth:
+        raise GitGerritError(f"No credentials for {host} found in ~/.netrc.")
+
+    def post(endpoint, data):
+        if verbose:
+            print('posting:', endpoint, json.dumps(data))
+        gerrit.post(endpoint, json=data)
+
+    def update_change(change):
+        number = change['number']
+        revision = change.get('current_revision') or 'current'
+        status_message = message
+        if labels or (message and not (abandon or restore)):
+            review = {'labels': labels}
+            if message:
+                review['message'] = message
+            post(f"/changes/{number}/revisions/{revision}/review", review)
+            status_message = None
+        if abandon or restore:
+            action = 'abandon' if abandon else 'restore'
+            data = {'message': status_message} if status_message else {}
+            post(f"/changes/{number}/{action}", data)
+        for reviewer in add_reviewers:
+            post(f"/changes/{number}/reviewers", {'reviewer': reviewer})
+
+    def result(change, future):
+        try:
+            future.result()
+        except requests.HTTPError as e:
+            text = e.response.text.strip() if e.response is not None else ""
+            return change, text or str(e)
+        except (requests.RequestException, ValueError) as e:
+            return change, str(e)
+        return change, None
+
+    for change, future in _ordered_map(update_change, changes, jobs):
+        yield result(change, future)
+
+
+def update(number, rest=False, **kwargs):
+    """Submit review to gerrit.
+
+    Note: This method requires authentication. See update_changes() for the
+    ssh command line interface, and update_changes_rest() for the REST API.
+
+    args:
+        number (int): gerrit id (requried)
+        rest (bool): use the REST API instead of ssh
+        kwargs: the update_changes() review options
+    returns:
+        None
+    raises:
+        GitGerritError if the update failed
+    """
+    if rest:
+        for _, error in update_changes_rest([{'number': number}], **kwargs):
+            if error:
+                raise GitGerritError(f"Unable to update change {number}: {error}")
+        return 0
+    return update_changes([{'number': number}], **kwargs)
+
+
+def _scan_commits(git, commit_ids, jobs=1, chunk_size=100):
+    """
+    Read the messages and gerrit trailers of many commits.
+
+    When more than one job is given, the commits are read in chunks by a pool
+    of worker threads, each with its own git cat-file reader. The results are
+    yielded in the same order as the given commit ids, and at most 2 * jobs
+    chunks are read ahead of the one being yielded.
+
+    args:
+        git (Git):          git utility object
+        commit_ids (list):  commit ids to scan
+        jobs (int):         number of worker threads
+        chunk_size (int):   number of commits read by a worker at a time
+    yields:
+        (commit_id, change_id, picked_from, message) tuples
+    """
+
+    def read(reader, commit_id):
+        message = reader.message(commit_id)
+        return (commit_id, *parse_trailers(message), message)
+
+    if jobs <= 1:
+        with git.cat_file() as reader:
+            for commit_id in commit_ids:
+                yield read(reader, commit_id)
+        return
+
+    local = threading.local()
+    lock = threading.Lock()
+    readers = []
+
+    def scan(chunk):
+        reader = getattr(local, 'reader', None)
+        if reader is None:
+            reader = git.cat_file()
+            local.reader = reader
+            with lock:
+                readers.append(reader)
+        return [read(reader, commit_id) for commit_id in chunk]
+
+    chunks = (
+        commit_ids[i : i + chunk_size] for i in range(0, len(commit_ids), chunk_size)
+    )
+    # Read at most two chunks per worker ahead of the one being yielded, so
+    # the messages are not all kept in memory while the caller writes them.
+    try:
+        for _, future in _ordered_map(scan, chunks, jobs, ahead=jobs * 2):
+            yield from future.result()
+    finally:
+        for reader in readers:
+            reader.close()
+
+
+def _sync_changes(git, spinner):
+    """Fetch all of the change refs and return the local change refs."""
+    git.fetch("refs/changes/*:refs/changes/*", spinner)
+    return git.show_refs(r"refs/changes/\d\d/\d+/\d+", prefix="refs/changes/")
+
+
+def _fetch_new_refs(git, known, refs, spinner):
+    """Fetch the refs which are not known or point to a different commit."""
+    new_refs = []
+    for commit_id, refname in refs:
+        parts = refname.split("/")
+        if known.get((int(parts[3]), int(parts[4]))) != commit_id:
+            new_refs.append([commit_id, refname])
+        spinner.spin()
+    if new_refs:
+        git.fetch([f"+{refname}:{refname}" for _, refname in new_refs], spinner)
+    return new_refs
+
+
+def _sync_changes_incremental(git, spinner):
+    """Fetch only the new and moved change refs and return them."""
+    with GitGerritDB.open() as db:
+        known = db.get_change_commits()
+    if not known:
+        return _sync_changes(git, spinner)  # First sync; fetch everything.
+    refs = git.ls_remote(r"refs/changes/\d\d/\d+/\d+")
+    return _fetch_new_refs(git, known, refs, spinner)
+
+
+def _sync_changes_rest(git, spinner):
+    """Fetch the refs of the changes updated since the last sync."""
+    with GitGerritDB.open() as db:
+        known = db.get_change_commits()
+        last_sync = db.get_property('last_sync')
+    if not known or not last_sync:
+        return _sync_changes_incremental(git, spinner)
+
+    since = datetime.datetime.strptime(last_sync, SYNC_TIME_FORMAT) - SYNC_OVERLAP
+    search = f'after:"{since.strftime(SYNC_TIME_FORMAT)} +0000"'
+    refs = []
+    for change in query(search, all_revisions=True, cache=False):
+        for commit_id, revision in change['revisions'].items():
+            refs.append([commit_id, revision['ref']])
+        spinner.spin()
+    return _fetch_new_refs(git, known, refs, spinner)
+
+
+def _sync_metadata(spinner):
+    """Store the metadata of the changes updated since the last metadata sync."""
+    started = datetime.datetime.now(datetime.timezone.utc)
+    with GitGerritDB.open() as db:
+        last_sync = db.get_property('last_metadata_sync')
+
+    search = ""
+    if last_sync:
+        since = datetime.datetime.strptime(last_sync, SYNC_TIME_FORMAT) - SYNC_OVERLAP
+        search = f'after:"{since.strftime(SYNC_TIME_FORMAT)} +0000"'
+
+    def changes():
+        for change in query(search, cache=False):
+            yield {key: change[key] for key in CHANGE_FIELDS}
+            spinner.spin()
+
+    with GitGerritDB.open() as db:
+        db.add_change_infos(changes())
+        db.set_property('last_metadata_sync', started.strftime(SYNC_TIME_FORMAT))
+
+
+def sync(limit=None, jobs=1, incremental=False, rest=False, metadata=False):
+    """
+    Fetch all of the changes and update the local database.
+
+    args:
+        limit (int):          maximum number of commits to scan (0 or None for no limit)
+        jobs (int):           number of parallel commit scanning jobs
+        incremental (bool):   fetch only the changes not already in the database
+        rest (bool):          fetch only the changes updated since the last sync
+        metadata (bool):      store the change metadata for offline queries
+    returns:
+        0 on success
+    """
+    git = Git.shared()
+    started = datetime.datetime.now(datetime.timezone.utc)
 
     with Spinner(f"Fetching changes from {git.remote()}") as spinner:
-        git.fetch("refs/changes/*:refs/changes/*", spinner)
+        if rest:
+            refs = list(_sync_changes_rest(git, spinner))
+        elif incremental:
+            refs = list(_sync_changes_incremental(git, spinner))
+        else:
+            refs = _sync_changes(git, spinner)
+
+    def changes(spinner):
+        for commit_id, refname in refs:
+            parts = refname.split("/")
+            number = int(parts[3])
+            patchset = int(parts[4])
+            yield number, patchset, commit_id
+            spinner.spin()
 
     with Spinner("Updating local database") as spinner:
-        with GitGerritDB() as db:
-            pattern = r"refs/changes/\d\d/\d+/\d+"
-            for commit_id, refname in git.show_refs(pattern):
-                parts = refname.split("/")
-                number = int(parts[3])
-                patchset = int(parts[4])
-                db.add_change(number, patchset, commit_id)
-                spinner.spin()
+        with GitGerritDB.open() as db:
+            db.add_changes(changes(spinner))
+            db.set_property('last_sync', started.strftime(SYNC_TIME_FORMAT))
 
     # It is not practical to read every commit message, and normally, we only
     # care about the current patchsets, so scan just the current patchsets
@@ -502,15 +1263,24 @@ def sync(limit=None):
     # most recent numbers. This amoritizes the scanning, so the first
     # git-gerrit-sync will scan a reasonable number of changes, and later syncs
     # will process older changes.
+    def commits(spinner, commit_ids):
+        for commit_id, change_id, picked_from, message in _scan_commits(
+            git, commit_ids, jobs
+        ):
+            yield commit_id, change_id, picked_from, 1, message
+            spinner.spin()
+
+    if not limit:
+        limit = None  # Scan all of the unscanned patchsets.
     with Spinner("Scanning commit messages") as spinner:
-        with GitGerritDB() as db:
-            for c in db.get_current_patchsets(limit=limit):
-                if c['flags'] != 1:
-                    commit_id = c['commit_id']
-                    change_id = git.change_id(commit_id)
-                    picked_from = git.cherry_picked_from(commit_id)
-                    db.update_commit(commit_id, change_id, picked_from, 1)
-                    spinner.spin()
+        with GitGerritDB.open() as db:
+            unscanned = db.get_current_patchsets(limit=limit, unscanned=True)
+            commit_ids = [c['commit_id'] for c in unscanned]
+            db.update_commits(commits(spinner, commit_ids))
+
+    if metadata:
+        with Spinner("Updating change metadata") as spinner:
+            _sync_metadata(spinner)
 
     print("Done.")
     return 0
@@ -0,0 +1,455 @@
+# Copyright (c) 2018-2025 Sine Nomine Associates
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this
+#    list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# THE SOFTWARE IS PROVIDED 'AS IS' AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+"""
+Run the git-gerrit commands in a resident per-repository process.
+
+The daemon keeps the parsed git config, the database connection, the REST API
+session, and the imported modules warm, and runs the commands forwarded to it
+by the command line client over a unix socket in the .git directory.
+
+This module is imported on every command, so the git_gerrit modules needed
+only by the daemon are imported when the daemon runs.
+"""
+
+import contextlib
+import io
+import json
+import os
+import socket
+import socketserver
+import sys
+import traceback
+
+from git_gerrit.error import GitGerritError
+
+SOCKET = "git-gerrit.sock"
+
+# The lookup commands which are forwarded to a running daemon. The daemon runs
+# them with its own environment, so an online query talks to the gerrit server
+# with the netrc credentials of the process which started the daemon.
+FORWARDED_COMMANDS = ("grep", "log", "number", "query")
+
+# Options which change the working tree, so the command always runs in the
+# calling process.
+LOCAL_OPTIONS = {"number": ("--checkout",)}
+
+# The environment variables which change the git config, the repository, or the
+# credentials. A command runs in the calling process when these differ from
+# the environment of the daemon, e.g., for "git -c gerrit.logformat=... gerrit-log".
+ENVIRONMENT = (
+    "GIT_DIR",
+    "GIT_WORK_TREE",
+    "GIT_COMMON_DIR",
+    "HOME",
+    "XDG_CONFIG_HOME",
+    "NETRC",
+)
+
+# The number of characters of output sent to the client at a time.
+OUTPUT_CHUNK_SIZE = 8192
+
+
+def find_git_dir(path=None):
+    """Find the .git directory without running git.
+
+    args:
+        path (str): directory to start the search (default: current directory)
+    returns:
+        absolute path of the .git directory, or None if not found
+    """
+    git_dir = os.environ.get("GIT_DIR")
+    if git_dir:
+        return os.path.abspath(git_dir)
+    path = os.path.abspath(path or os.getcwd())
+    while True:
+        candidate = os.path.join(path, ".git")
+        if os.path.isdir(candidate):
+            return candidate
+        if os.path.isfile(candidate):
+            # Linked worktrees have a .git file with the path to the git dir.
+            with open(candidate) as f:
+                line = f.readline().strip()
+            if not line.startswith("gitdir:"):
+                return None
+            return os.path.normpath(os.path.join(path, line[7:].strip()))
+        parent = os.path.dirname(path)
+        if parent == path:
+            return None
+        path = parent
+
+
+def socket_path(git_dir):
+    """Return the path of the daemon socket for a .git directory."""
+    return os.path.join(git_dir, SOCKET)
+
+
+def environment():
+    """Return the environment variables which must match to forward a command."""
+    return {
+        name: value
+        for name, value in os.environ.items()
+        if name in ENVIRONMENT or name.startswith("GIT_CONFIG")
+    }
+
+
+def _responses(path, request):
+    """Send a request to the daemon and yield the response messages.
+
+    raises:
+        ConnectionError if the daemon is not running
+        OSError or ValueError if the daemon did not respond
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    with sock:
+        try:
+            sock.connect(path)
+        except OSError as e:
+            raise ConnectionError(e)
+        sock.sendall(json.dumps(request).encode() + b"\n")
+        sock.shutdown(socket.SHUT_WR)
+        with sock.makefile("rb") as f:
+            for line in f:
+                yield json.loads(line)
+
+
+def _request(path, request):
+    """Send a request to the daemon and return the final response message.
+
+    raises:
+        ConnectionError if the daemon is not running
+        OSError or ValueError if the daemon did not respond
+    """
+    for response in _responses(path, request):
+        if "exit_code" in response:
+            return response
+    raise ValueError("no response")
+
+
+def forward(command, argv):
+    """Run a command in the daemon for this repository, if one is running.
+
+    args:
+        command (str): the command name, e.g. "log"
+        argv (list): the command line arguments
+    returns:
+        the command exit code, or None if the command was not forwarded
+    """
+    if command not in FORWARDED_COMMANDS or os.environ.get("GIT_GERRIT_NO_DAEMON"):
+        return None
+    if _has_local_option(command, argv):
+        return None
+    git_dir = find_git_dir()
+    if git_dir is None:
+        return None
+    path = socket_path(git_dir)
+    if not os.path.exists(path):
+        return None
+    request = {
+        "command": command,
+        "argv": argv,
+        "cwd": os.getcwd(),
+        "env": environment(),
+    }
+    # Write the output as it arrives, outside of the error handling of the
+    # socket, so a closed stdout is reported by the caller.
+    stdout, stderr = sys.stdout, sys.stderr
+    with contextlib.closing(_responses(path, request)) as responses:
+        started = False
+        while True:
+            try:
+                response = next(responses)
+            except StopIteration:
+                print(
+                    "git-gerrit daemon did not respond: no exit code", file=sys.stderr
+                )
+                return 1
+            except ConnectionError:
+                if not started:
+                    return None  # A stale socket; run the command here.
+                print("git-gerrit daemon closed the connection", file=sys.stderr)
+                return 1
+            except (OSError, ValueError) as e:
+                print(f"git-gerrit daemon did not respond: {e}", file=sys.stderr)
+                return 1
+            if response.get("local"):
+                return None  # The environments differ; run the command here.
+            started = True
+            stdout.write(response.get("stdout", ""))
+            stderr.write(response.get("stderr", ""))
+            if "exit_code" in response:
+                return response["exit_code"]
+
+
+def _has_local_option(command, argv):
+    """Return True if the arguments contain an option which must run locally.
+
+    Abbreviated long options are matched too, since argparse accepts them.
+    """
+    for arg in argv:
+        if arg == "--":
+            break
+        name = arg.split("=", 1)[0]
+        if len(name) > 2 and any(
+            o.startswith(name) for o in LOCAL_OPTIONS.get(command, ())
+        ):
+            return True
+    return False
+
+
+def status(git_dir):
+    """Return the process id of the daemon for a .git directory, or None."""
+    try:
+        response = _request(socket_path(git_dir), {"command": "ping"})
+    except (OSError, ValueError):
+        return None
+    return response.get("pid")
+
+
+def stop(git_dir):
+    """Ask the daemon for a .git directory to exit.
+
+    returns:
+        True if a daemon was running
+    """
+    try:
+        _request(socket_path(git_dir), {"command": "stop"})
+    except (OSError, ValueError):
+        return False
+    return True
+
+
+def serve(idle_timeout=None, detach=False):
+    """Run the daemon for the current repository until stopped.
+
+    args:
+        idle_timeout (float): exit after this many idle seconds (optional)
+        detach (bool): run the daemon in the background
+    raises:
+        GitGerritError if a daemon is already running
+    """
+    from git_gerrit.git import Git
+
+    daemon = Daemon(Git.shared().git_dir(), idle_timeout)
+    if detach:
+        # Listen before forking, so the socket is ready when we return.
+        if os.fork() != 0:
+            daemon.socket.close()
+            return
+        os.setsid()
+        devnull = os.open(os.devnull, os.O_RDWR)
+        for fd in (0, 1, 2):
+            os.dup2(devnull, fd)
+        os.close(devnull)
+    with daemon:
+        daemon.serve()
+
+
+def _file_stamp(path):
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+
+
+class _Output(io.TextIOBase):
+    """A text stream which sends the command output to the client in chunks."""
+
+    def __init__(self, send, name, before=None):
+        """
+        args:
+            send (callable): sends a response message to the client
+            name (str): the message key, "stdout" or "stderr"
+            before (_Output): stream to flush before each write, which also
+                makes this stream unbuffered (optional)
+        """
+        self._send = send
+        self._name = name
+        self._before = before
+        self._buffer = []
+        self._size = 0
+
+    def writable(self):
+        return True
+
+    def write(self, text):
+        if not text:
+            return 0
+        self._buffer.append(text)
+        self._size += len(text)
+        if self._before:
+            self._before.flush()
+            self.flush()
+        elif self._size >= OUTPUT_CHUNK_SIZE:
+            self.flush()
+        return len(text)
+
+    def flush(self):
+        if self._buffer:
+            text = "".join(self._buffer)
+            self._buffer = []
+            self._size = 0
+            self._send({self._name: text})
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    def handle(self):
+        try:
+            request = json.loads(self.rfile.readline())
+        except ValueError:
+            return
+        try:
+            self.send(self.server.dispatch(request, self.send))
+        except OSError:
+            pass  # The client has gone away, e.g., "git gerrit-log | head".
+
+    def send(self, message):
+        self.wfile.write(json.dumps(message).encode() + b"\n")
+
+
+class Daemon(socketserver.UnixStreamServer):
+    """Serve the forwarded commands for one repository, one at a time."""
+
+    def __init__(self, git_dir, idle_timeout=None):
+        """
+        args:
+            git_dir (str): the absolute path of the .git directory
+            idle_timeout (float): exit after this many idle seconds (optional)
+        raises:
+            GitGerritError if a daemon is already running
+        """
+        self.git_dir = git_dir
+        self.path = socket_path(git_dir)
+        self.timeout = idle_timeout or None
+        self.running = False
+        self._config_stamp = None
+        self._db_stamp = None
+        self.environment = environment()
+        if os.path.exists(self.path):
+            if status(git_dir):
+                raise GitGerritError(f"A daemon is already running on {self.path}.")
+            os.unlink(self.path)  # Left by a daemon which did not exit cleanly.
+        umask = os.umask(0o077)  # Only the owner may connect.
+        try:
+            super().__init__(self.path, _Handler)
+        except OSError as e:
+            raise GitGerritError(f"Unable to listen on {self.path}: {e}")
+        finally:
+            os.umask(umask)
+
+    def serve(self):
+        """Handle requests until stopped or idle for too long."""
+        self.running = True
+        while self.running:
+            self.handle_request()
+
+    def handle_timeout(self):
+        self.running = False
+
+    def server_close(self):
+        from git_gerrit import rest
+        from git_gerrit.db import GitGerritDB
+
+        super().server_close()
+        GitGerritDB.release()
+        rest.close()
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+
+    def dispatch(self, request, send):
+        """Handle a decoded request and return the final response.
+
+        args:
+            request (dict): the decoded request
+            send (callable): sends the command output messages to the client
+        """
+        command = request.get("command")
+        if command == "ping":
+            return {"exit_code": 0, "pid": os.getpid()}
+        if command == "stop":
+            self.running = False
+            return {"exit_code": 0}
+        if command not in FORWARDED_COMMANDS:
+            return {"exit_code": 1, "stderr": f"Unknown command '{command}'.\n"}
+        if "env" in request and request["env"] != self.environment:
+            return {"local": True}
+        return self.run(command, request.get("argv", []), request.get("cwd"), send)
+
+    def run(self, command, argv, cwd, send):
+        """Run a command line entry point, sending the output as it is written."""
+        from git_gerrit import cli
+
+        main = getattr(cli, f"main_git_gerrit_{command}")
+        self.refresh()
+        stdout = _Output(send, "stdout")
+        stderr = _Output(send, "stderr", before=stdout)
+        old_cwd = os.getcwd()
+        try:
+            os.chdir(cwd or old_cwd)
+            with contextlib.redirect_stdout(stdout), contextlib.redirect_stderr(stderr):
+                try:
+                    exit_code = main(argv)
+                except SystemExit as e:  # argparse help and usage errors
+                    exit_code = 0 if e.code is None else e.code
+                    if not isinstance(exit_code, int):
+                        exit_code = 1
+                except Exception:
+                    traceback.print_exc()
+                    exit_code = 1
+        except OSError as e:
+            print(str(e), file=stderr)
+            exit_code = 1
+        finally:
+            os.chdir(old_cwd)
+        stdout.flush()
+        return {"exit_code": exit_code}
+
+    def refresh(self):
+        """Reload the config and reopen the database if changed on disk."""
+        from git_gerrit.git import Git
+        from git_gerrit.db import DATABASE, GitGerritDB
+        from git_gerrit.refs import RefReader
+
+        common_dir = RefReader(self.git_dir).common_dir
+        xdg_config_home = os.environ.get(
+            "XDG_CONFIG_HOME", os.path.expanduser("~/.config")
+        )
+        config_files = [
+            os.path.join(common_dir, "config"),
+            os.path.expanduser("~/.gitconfig"),
+            os.path.join(xdg_config_home, "git", "config"),
+        ]
+        config_stamp = [_file_stamp(path) for path in config_files]
+        if config_stamp != self._config_stamp:
+            self._config_stamp = config_stamp
+            Git.shared().reload_config()
+
+        # Keep the database open once it exists, and reopen it if replaced.
+        # The size and time change on every write, so compare only the inode.
+        db_stamp = _file_stamp(os.path.join(self.git_dir, DATABASE))
+        db_stamp = db_stamp[:2] if db_stamp else None
+        if db_stamp != self._db_stamp:
+            self._db_stamp = db_stamp
+            GitGerritDB.release()
+            if db_stamp:
+                GitGerritDB.keep_open()
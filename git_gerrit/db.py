@@ -20,12 +20,15 @@
 
 import sqlite3
 import os
+import itertools
+import json
 
 from git_gerrit.git import Git
 
 DATABASE = "git-gerrit.db"
 MAGIC = 0x67697467  # "gitg"
-SCHEMA_VERSION = 1
+SCHEMA_VERSION = 6
+BATCH_SIZE = 10000
 MIGRATION_SCRIPTS = [
     """
     CREATE TABLE changes (
@@ -42,8 +45,116 @@ MIGRATION_SCRIPTS = [
         FOREIGN KEY (commit_id) REFERENCES commits(change_commit_id)
     );
     """,
+    """
+    /* Covering indexes for the commit id and cherry-pick lookups. */
+    CREATE INDEX changes_by_commit_id
+        ON changes (change_commit_id, change_number, change_patchset);
+    CREATE INDEX commits_by_picked_from
+        ON commits (commit_picked_from, commit_id);
+    ANALYZE;
+    """,
+    """
+    /* The current (max) patchset of each change, maintained by add_change(). */
+    CREATE TABLE current_patchsets (
+        current_number INTEGER PRIMARY KEY,
+        current_patchset INTEGER NOT NULL,
+        current_commit_id TEXT NOT NULL
+    );
+    INSERT INTO current_patchsets
+        (current_number, current_patchset, current_commit_id)
+        SELECT change_number, MAX(change_patchset), change_commit_id
+        FROM changes
+        GROUP BY change_number;
+    ANALYZE;
+    """,
+    """
+    /* Named values, such as the time of the last sync. */
+    CREATE TABLE properties (
+        property_name TEXT PRIMARY KEY,
+        property_value TEXT
+    );
+    """,
+    """
+    /* Gerrit REST API responses, see git_gerrit.rest.ResponseCache. */
+    CREATE TABLE responses (
+        response_url TEXT PRIMARY KEY,
+        response_etag TEXT,            /* May be NULL */
+        response_body TEXT NOT NULL,   /* JSON */
+        response_fetched REAL NOT NULL, /* Unix time of the last validation */
+        response_used REAL NOT NULL    /* Unix time of the last use */
+    );
+    CREATE INDEX responses_by_used ON responses (response_used);
+    """,
+    """
+    /* Change metadata for offline queries, maintained by add_change_infos(). */
+    CREATE TABLE change_infos (
+        info_number INTEGER PRIMARY KEY,
+        info_change_id TEXT,
+        info_project TEXT,
+        info_branch TEXT,
+        info_status TEXT,
+        info_subject TEXT,
+        info_topic TEXT,
+        info_owner TEXT,
+        info_hashtags TEXT,
+        info_updated TEXT,
+        info_insertions INTEGER,
+        info_deletions INTEGER,
+        info_change TEXT NOT NULL  /* JSON of all of the change fields */
+    );
+    CREATE INDEX change_infos_by_change_id ON change_infos (info_change_id);
+    CREATE INDEX change_infos_by_branch ON change_infos (info_branch, info_status);
+    CREATE INDEX change_infos_by_status ON change_infos (info_status, info_updated);
+    CREATE INDEX change_infos_by_topic ON change_infos (info_topic);
+    CREATE INDEX change_infos_by_owner ON change_infos (info_owner);
+    CREATE INDEX change_infos_by_updated ON change_infos (info_updated);
+    """,
 ]
 
+# The full-text index of the commit messages. It is created outside of the
+# migrations, and only when SQLite has been built with the FTS5 extension, so
+# the other commands work without it. The existing commits are rescanned on
+# the next sync to index their messages.
+MESSAGE_INDEX_SCRIPT = """
+    CREATE VIRTUAL TABLE commit_messages USING fts5 (
+        message_subject,
+        message_body
+    );
+    /* The stable commit_messages rowid of each indexed commit. */
+    CREATE TABLE commit_message_keys (
+        key_id INTEGER PRIMARY KEY,
+        key_commit_id TEXT NOT NULL UNIQUE
+    );
+    UPDATE commits SET commit_flags = 0 WHERE commit_flags IS 1;
+"""
+
+# The change_infos columns which may be searched with search_change_infos().
+CHANGE_INFO_COLUMNS = {
+    "number": "info_number",
+    "change_id": "info_change_id",
+    "project": "info_project",
+    "branch": "info_branch",
+    "status": "info_status",
+    "topic": "info_topic",
+    "owner": "info_owner",
+}
+
+
+def _batches(iterable, size):
+    """Split an iterable into lists of at most size items."""
+    iterator = iter(iterable)
+    while True:
+        batch = list(itertools.islice(iterator, size))
+        if not batch:
+            break
+        yield batch
+
+
+def _split_message(message):
+    """Split a commit message into the subject and the body."""
+    subject, _, body = message.strip().partition("\n\n")
+    return " ".join(subject.split()), body.strip()
+
 
 class Cursor:
     """
@@ -77,19 +188,28 @@ class GitGerritDB:
         _database (str): The path to the SQLite database file.
         _exists (bool): True if the database file already exists.
         _conn (sqlite3.Connection): The SQLite database connection object.
+        _resident (GitGerritDB): The database kept open by keep_open().
     """
 
-    def __init__(self):
+    _resident = None
+
+    def __init__(self, check_same_thread=True):
         """
         Initializes the GitGerritDB object.
 
         This method sets up the database connection, creates the database and
         its schema if they don't exist, and handles schema migrations.
+
+        Args:
+            check_same_thread (bool, optional): False to allow the connection
+                to be used by other threads, which must serialize their use.
         """
         self._dirty = False
-        self._database = os.path.join(Git().git_dir(), DATABASE)
+        self._database = os.path.join(Git.shared().git_dir(), DATABASE)
         self._exists = os.path.exists(self._database)
-        self._conn = sqlite3.connect(self._database)
+        self._conn = sqlite3.connect(
+            self._database, check_same_thread=check_same_thread
+        )
 
         # Use a magic number to ensure we created the database.
         if not self._exists:
@@ -109,10 +229,77 @@ class GitGerritDB:
                     raise AssertionError(f"SQL migration error: {e}, {migrate}")
                 self._conn.commit()
                 self._bump_schema_version()
+        self.has_message_index = self._create_message_index()
 
         # Return rows as dictionaries (instead of tuples).
         self._conn.row_factory = sqlite3.Row
 
+    def _create_message_index(self):
+        """
+        Creates the full-text index of the commit messages, if needed.
+
+        Returns:
+            bool: True if the index exists, False if SQLite lacks FTS5.
+        """
+        cursor = self._conn.execute(
+            """
+            SELECT name FROM sqlite_master
+            WHERE type='table' AND name IN ('commit_messages', 'commit_message_keys')
+            """
+        )
+        names = {row[0] for row in cursor}
+        if "commit_message_keys" in names:
+            return True
+        try:
+            if names:
+                # Replace an index without the key table, which was keyed by
+                # the commits rowid or by an unindexed commit id column.
+                self._conn.execute("DROP TABLE commit_messages")
+            self._conn.executescript(MESSAGE_INDEX_SCRIPT)
+        except sqlite3.OperationalError:
+            self._conn.rollback()
+            return False
+        self._conn.commit()
+        return True
+
+    @classmethod
+    def open(cls):
+        """
+        Opens the database, or returns the database kept open by keep_open().
+
+        Returns:
+            GitGerritDB: The database, to be used as a context manager.
+        """
+        if cls._resident is not None:
+            return cls._resident
+        return cls()
+
+    @classmethod
+    def keep_open(cls):
+        """
+        Keeps a database connection open for the life of the process.
+
+        This is used by the daemon to avoid opening the database and checking
+        the schema for every command. The connection is not closed when the
+        'with' block exits, only by release().
+
+        Returns:
+            GitGerritDB: The resident database.
+        """
+        if cls._resident is None:
+            cls._resident = cls()
+        return cls._resident
+
+    @classmethod
+    def release(cls):
+        """
+        Closes the database kept open by keep_open(), if any.
+        """
+        if cls._resident is not None:
+            resident = cls._resident
+            cls._resident = None
+            resident.close()
+
     def __enter__(self):
         """
         Enables the use of the GitGerritDb class as a context manager.
@@ -124,7 +311,10 @@ class GitGerritDB:
         Called when exiting the 'with' block to ensure the database connection
         is properly closed.
         """
-        self.close()
+        if self is GitGerritDB._resident:
+            self._conn.commit()
+        else:
+            self.close()
 
     def close(self):
         """
@@ -163,9 +353,223 @@ class GitGerritDB:
             data = None
         return data
 
+    def get_property(self, name, default=None):
+        """
+        Retrieves a named value.
+
+        Args:
+            name (str): The property name.
+            default (str, optional): The value to return when not set.
+
+        Returns:
+            str: The property value.
+        """
+        with Cursor(self) as cursor:
+            cursor.execute(
+                "SELECT property_value FROM properties WHERE property_name = ?",
+                (name,),
+            )
+            row = cursor.fetchone()
+            if row:
+                return row[0]
+            return default
+
+    def set_property(self, name, value):
+        """
+        Sets a named value.
+
+        Args:
+            name (str): The property name.
+            value (str): The property value.
+        """
+        with Cursor(self) as cursor:
+            cursor.execute(
+                """
+                INSERT OR REPLACE INTO properties
+                (property_name, property_value)
+                VALUES (?, ?)
+                """,
+                (name, value),
+            )
+            self._dirty = True
+
+    def get_response(self, url):
+        """
+        Retrieves a cached REST API response.
+
+        Args:
+            url (str): The request url.
+
+        Returns:
+            dict: The 'etag', 'body', and 'fetched' time of the response, or
+                None if the response is not cached.
+        """
+        with Cursor(self) as cursor:
+            cursor.execute(
+                """
+                SELECT
+                    response_etag AS etag,
+                    response_body AS body,
+                    response_fetched AS fetched
+                FROM responses
+                WHERE response_url = ?
+                """,
+                (url,),
+            )
+            return self._as_dict(cursor.fetchone())
+
+    def set_response(self, url, etag, body, fetched, max_responses):
+        """
+        Caches a REST API response.
+
+        The least recently used responses are removed to keep at most
+        max_responses responses.
+
+        Args:
+            url (str): The request url.
+            etag (str): The ETag of the response, or None.
+            body (str): The JSON response body.
+            fetched (float): The time the response was retrieved.
+            max_responses (int): The maximum number of cached responses.
+        """
+        with self._conn:
+            self._conn.execute(
+                """
+                INSERT OR REPLACE INTO responses
+                (response_url, response_etag, response_body,
+                 response_fetched, response_used)
+                VALUES (?, ?, ?, ?, ?)
+                """,
+                (url, etag, body, fetched, fetched),
+            )
+            self._conn.execute(
+                """
+                DELETE FROM responses WHERE response_url NOT IN (
+                    SELECT response_url FROM responses
+                    ORDER BY response_used DESC
+                    LIMIT ?
+                )
+                """,
+                (max_responses,),
+            )
+
+    def touch_response(self, url, used, fetched=None):
+        """
+        Updates the last use time of a cached REST API response.
+
+        Args:
+            url (str): The request url.
+            used (float): The time the response was used.
+            fetched (float, optional): The time the response was revalidated.
+        """
+        with self._conn:
+            self._conn.execute(
+                """
+                UPDATE responses SET
+                    response_used = ?,
+                    response_fetched = COALESCE(?, response_fetched)
+                WHERE response_url = ?
+                """,
+                (used, fetched, url),
+            )
+
+    def add_change_infos(self, changes, batch_size=BATCH_SIZE):
+        """
+        Adds or replaces the metadata of changes.
+
+        Args:
+            changes (iterable): Change dictionaries, with at least the 'number'
+                key. The whole dictionary is stored to be returned by
+                search_change_infos().
+            batch_size (int, optional): The number of rows per transaction.
+
+        Returns:
+            int: The number of changes processed.
+        """
+
+        def row(change):
+            return (
+                change['number'],
+                change.get('change_id'),
+                change.get('project'),
+                change.get('branch'),
+                change.get('status'),
+                change.get('subject'),
+                change.get('topic'),
+                str(change.get('owner', '')),
+                change.get('hashtags'),
+                change.get('updated'),
+                change.get('insertions') or 0,
+                change.get('deletions') or 0,
+                json.dumps(change),
+            )
+
+        count = 0
+        for batch in _batches(changes, batch_size):
+            with self._conn:
+                self._conn.executemany(
+                    """
+                    INSERT OR REPLACE INTO change_infos
+                    (info_number, info_change_id, info_project, info_branch,
+                     info_status, info_subject, info_topic, info_owner,
+                     info_hashtags, info_updated, info_insertions,
+                     info_deletions, info_change)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                    """,
+                    [row(change) for change in batch],
+                )
+            count += len(batch)
+        return count
+
+    def search_change_infos(self, terms, text=None, limit=None):
+        """
+        Searches the change metadata, most recently updated first.
+
+        Args:
+            terms (list): (name, values) tuples, where name is a key of
+                CHANGE_INFO_COLUMNS. A change matches a term when its value is
+                one of the values, and matches when it matches all of the terms.
+            text (list, optional): Strings which the subject must contain.
+            limit (int, optional): The maximum number of changes.
+
+        Yields:
+            dict: The change dictionaries given to add_change_infos().
+        """
+        if self._dirty:
+            self._conn.commit()
+            self._dirty = False
+
+        conditions = []
+        params = []
+        for name, values in terms:
+            values = list(values)
+            column = CHANGE_INFO_COLUMNS[name]
+            conditions.append(f"{column} IN ({','.join('?' * len(values))})")
+            params.extend(values)
+        for string in text or []:
+            escaped = (
+                string.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+            )
+            conditions.append("info_subject LIKE ? ESCAPE '\\'")
+            params.append(f"%{escaped}%")
+        where = " AND ".join(conditions) or "1"
+        sql = f"""
+            SELECT info_change FROM change_infos
+            WHERE {where}
+            ORDER BY info_updated DESC, info_number DESC
+        """
+        if limit:
+            sql += " LIMIT ?"
+            params.append(limit)
+        with Cursor(self) as cursor:
+            cursor.execute(sql, params)
+            for row in cursor:
+                yield json.loads(row[0])
+
     def add_change(self, number, patchset, commit_id):
         """
-        Adds a new change to the database.
+        Adds a new change to the database, or updates the commit id of an
+        existing patchset.
 
         Args:
             number (int): The change number.
@@ -183,14 +587,102 @@ class GitGerritDB:
             )
             cursor.execute(
                 """
-                INSERT OR IGNORE INTO changes
+                INSERT INTO changes
                 (change_number, change_patchset, change_commit_id)
                 VALUES (?, ?, ?)
+                ON CONFLICT (change_number, change_patchset) DO UPDATE SET
+                    change_commit_id = excluded.change_commit_id
+                """,
+                (number, patchset, commit_id),
+            )
+            cursor.execute(
+                """
+                INSERT INTO current_patchsets
+                (current_number, current_patchset, current_commit_id)
+                VALUES (?, ?, ?)
+                ON CONFLICT (current_number) DO UPDATE SET
+                    current_patchset = excluded.current_patchset,
+                    current_commit_id = excluded.current_commit_id
+                WHERE excluded.current_patchset >= current_patchset
                 """,
                 (number, patchset, commit_id),
             )
             self._dirty = True
 
+    def add_changes(self, changes, batch_size=BATCH_SIZE):
+        """
+        Adds many changes to the database.
+
+        The rows are inserted in batches, each batch in a single transaction,
+        which is much faster than calling add_change() for each change.
+
+        Args:
+            changes (iterable): (number, patchset, commit_id) tuples.
+            batch_size (int, optional): The number of rows per transaction.
+
+        Returns:
+            int: The number of changes processed.
+        """
+        if self._dirty:
+            self._conn.commit()
+            self._dirty = False
+
+        count = 0
+        for batch in _batches(changes, batch_size):
+            with self._conn:
+                self._conn.executemany(
+                    """
+                    INSERT OR IGNORE INTO commits
+                    (commit_id, commit_flags)
+                    VALUES (?, 0)
+                    """,
+                    [(commit_id,) for _, _, commit_id in batch],
+                )
+                self._conn.executemany(
+                    """
+                    INSERT INTO changes
+                    (change_number, change_patchset, change_commit_id)
+                    VALUES (?, ?, ?)
+                    ON CONFLICT (change_number, change_patchset) DO UPDATE SET
+                        change_commit_id = excluded.change_commit_id
+                    """,
+                    batch,
+                )
+                self._conn.executemany(
+                    """
+                    INSERT INTO current_patchsets
+                    (current_number, current_patchset, current_commit_id)
+                    VALUES (?, ?, ?)
+                    ON CONFLICT (current_number) DO UPDATE SET
+                        current_patchset = excluded.current_patchset,
+                        current_commit_id = excluded.current_commit_id
+                    WHERE excluded.current_patchset >= current_patchset
+                    """,
+                    batch,
+                )
+            count += len(batch)
+        return count
+
+    def get_change_commits(self):
+        """
+        Retrieves the commit ids of all of the patchsets.
+
+        Returns:
+            dict: The commit ids keyed by (number, patchset) tuples.
+        """
+        if self._dirty:
+            self._conn.commit()
+            self._dirty = False
+
+        with Cursor(self) as cursor:
+            cursor.execute(
+                """
+                SELECT change_number, change_patchset, change_commit_id
+                FROM changes
+                """
+            )
+            return {(n, p): c for n, p, c in cursor}
+
     def update_commit(self, commit_id, change_id, picked_from, flags):
         """
         Updates the details of a commit.
@@ -212,12 +704,74 @@ class GitGerritDB:
             )
             self._dirty = True
 
-    def get_current_patchsets(self, limit=None):
+    def update_commits(self, commits, batch_size=BATCH_SIZE):
+        """
+        Updates the details of many commits.
+
+        The rows are updated in batches, each batch in a single transaction.
+        When a commit message is given, it is added to the full-text index
+        searched by search_commit_messages(), replacing the previous message of
+        the commit. The messages are ignored when SQLite lacks FTS5.
+
+        Args:
+            commits (iterable): (commit_id, change_id, picked_from, flags) or
+                (commit_id, change_id, picked_from, flags, message) tuples.
+            batch_size (int, optional): The number of rows per transaction.
+
+        Returns:
+            int: The number of commits processed.
+        """
+        if self._dirty:
+            self._conn.commit()
+            self._dirty = False
+
+        count = 0
+        for batch in _batches(commits, batch_size):
+            with self._conn:
+                self._conn.executemany(
+                    """
+                    UPDATE commits
+                    SET commit_change_id = ?, commit_picked_from = ?, commit_flags = ?
+                    WHERE commit_id == ?
+                    """,
+                    [(c, p, f, commit_id) for commit_id, c, p, f, *_ in batch],
+                )
+                messages = [
+                    (commit[0], *_split_message(commit[4]))
+                    for commit in batch
+                    if len(commit) > 4 and commit[4] is not None
+                ]
+                if messages and self.has_message_index:
+                    # Replace the previous message of a commit by reusing its
+                    # key, so no full-text table scan is needed.
+                    self._conn.executemany(
+                        "INSERT OR IGNORE INTO commit_message_keys (key_commit_id) "
+                        "VALUES (?)",
+                        [(commit_id,) for commit_id, *_ in messages],
+                    )
+                    self._conn.executemany(
+                        """
+                        INSERT OR REPLACE INTO commit_messages
+                        (rowid, message_subject, message_body)
+                        SELECT key_id, ?, ? FROM commit_message_keys
+                        WHERE key_commit_id == ?
+                        """,
+                        [
+                            (subject, body, commit_id)
+                            for commit_id, subject, body in messages
+                        ],
+                    )
+            count += len(batch)
+        return count
+
+    def get_current_patchsets(self, limit=None, unscanned=False):
         """
         Retrieves the current patchsets for all changes.
 
         Args:
             limit (int, optional): The maximum number of patchsets to retrieve.
+            unscanned (bool, optional): Retrieve only the patchsets which have
+                not been scanned yet.
 
         Yields:
             dict: A dictionary representing a patchset.
@@ -226,6 +780,11 @@ class GitGerritDB:
             self._conn.commit()
             self._dirty = False
 
+        if unscanned:
+            where_clause = "WHERE co.commit_flags IS NOT 1"
+        else:
+            where_clause = ""
+
         if limit is None:
             limit_clause = ""
         else:
@@ -235,16 +794,16 @@ class GitGerritDB:
             cursor.execute(
                 f"""
                 SELECT
-                    ch.change_number AS number,
-                    MAX(ch.change_patchset) AS current_patchset,
-                    ch.change_commit_id AS commit_id,
+                    cp.current_number AS number,
+                    cp.current_patchset AS current_patchset,
+                    cp.current_commit_id AS commit_id,
                     co.commit_change_id AS change_id,
                     co.commit_picked_from AS cherry_picked_from,
                     co.commit_flags AS flags
-                FROM changes AS ch
-                LEFT JOIN commits AS co ON co.commit_id = ch.change_commit_id
-                GROUP BY ch.change_number
-                ORDER BY ch.change_number DESC
+                FROM current_patchsets AS cp
+                LEFT JOIN commits AS co ON co.commit_id = cp.current_commit_id
+                {where_clause}
+                ORDER BY cp.current_number DESC
                 {limit_clause}
                 """
             )
@@ -269,18 +828,15 @@ class GitGerritDB:
             cursor.execute(
                 """
                 SELECT
-                    ch.change_number AS number,
-                    MAX(ch.change_patchset) AS current_patchset,
-                    ch.change_commit_id AS commit_id,
+                    cp.current_number AS number,
+                    cp.current_patchset AS current_patchset,
+                    cp.current_commit_id AS commit_id,
                     co.commit_change_id AS change_id,
                     co.commit_picked_from AS cherry_picked_from,
                     co.commit_flags AS flags
-                FROM changes AS ch
-                LEFT JOIN commits AS co ON co.commit_id = ch.change_commit_id
-                WHERE ch.change_number = ?
-                GROUP BY ch.change_number
-                ORDER BY ch.change_number DESC
-                LIMIT 1
+                FROM current_patchsets AS cp
+                LEFT JOIN commits AS co ON co.commit_id = cp.current_commit_id
+                WHERE cp.current_number = ?
                 """,
                 (number,),
             )
@@ -355,3 +911,140 @@ class GitGerritDB:
             )
             for row in cursor:
                 yield self._as_dict(row)
+
+    def get_changes_by_commits(self, commit_ids, picked_from=True):
+        """
+        Retrieves the change details of many commits.
+
+        This is the set-based version of get_change_by_commit(). The number of
+        the change the commit was cherry picked from is included, when known.
+
+        Args:
+            commit_ids (list): The commit IDs (SHA-1), at most 999 (the
+                SQLite host parameter limit).
+            picked_from (bool, optional): Lookup the cherry picked from change
+                numbers. When False, cherry_picked_from_number is always None.
+
+        Returns:
+            dict: Dictionaries representing the changes, keyed by commit ID.
+        """
+        if self._dirty:
+            self._conn.commit()
+            self._dirty = False
+
+        commit_ids = list(commit_ids)
+        if not commit_ids:
+            return {}
+        placeholders = ",".join("?" * len(commit_ids))
+        if picked_from:
+            picked_from_number = """
+                (
+                    SELECT pf.change_number
+                    FROM changes AS pf
+                    WHERE pf.change_commit_id = co.commit_picked_from
+                    LIMIT 1
+                )
+            """
+        else:
+            picked_from_number = "NULL"
+        with Cursor(self) as cursor:
+            # Select the first change that matches each commit hash. It is
+            # possible to have more than one, but not common.
+            cursor.execute(
+                f"""
+                SELECT
+                    MIN(ch.change_number) AS number,
+                    ch.change_patchset AS patchset,
+                    ch.change_commit_id AS commit_id,
+                    co.commit_change_id AS change_id,
+                    co.commit_picked_from AS cherry_picked_from,
+                    {picked_from_number} AS cherry_picked_from_number,
+                    co.commit_flags AS flags
+                FROM changes AS ch
+                LEFT JOIN commits AS co ON co.commit_id = ch.change_commit_id
+                WHERE ch.change_commit_id IN ({placeholders})
+                GROUP BY ch.change_commit_id
+                """,
+                commit_ids,
+            )
+            return {row['commit_id']: self._as_dict(row) for row in cursor}
+
+    def get_cherry_pick_numbers_by_commits(self, commit_ids):
+        """
+        Retrieves the change numbers of the cherry-picks of many commits.
+
+        Args:
+            commit_ids (list): The commit IDs of the original commits, at most
+                999 (the SQLite host parameter limit).
+
+        Returns:
+            dict: Sorted lists of change numbers, keyed by original commit ID.
+        """
+        if self._dirty:
+            self._conn.commit()
+            self._dirty = False
+
+        commit_ids = list(commit_ids)
+        if not commit_ids:
+            return {}
+        placeholders = ",".join("?" * len(commit_ids))
+        picks = {}
+        with Cursor(self) as cursor:
+            cursor.execute(
+                f"""
+                SELECT DISTINCT
+                    co.commit_picked_from AS commit_id,
+                    ch.change_number AS number
+                FROM commits AS co
+                JOIN changes AS ch ON ch.change_commit_id = co.commit_id
+                WHERE co.commit_picked_from IN ({placeholders})
+                ORDER BY co.commit_picked_from, ch.change_number
+                """,
+                commit_ids,
+            )
+            for row in cursor:
+                picks.setdefault(row['commit_id'], []).append(row['number'])
+        return picks
+
+    def search_commit_messages(self, match, limit=None):
+        """
+        Searches the full-text index of the commit messages.
+
+        Each change is listed once, with the newest patchset which matches.
+        The index is only available when has_message_index is True.
+
+        Args:
+            match (str): An SQLite FTS5 query, e.g., '"fix the frobnicator"'.
+            limit (int, optional): The maximum number of changes.
+
+        Yields:
+            dict: The number, patchset, commit_id, change_id, and subject of
+            the matching changes, highest change number first.
+        """
+        if self._dirty:
+            self._conn.commit()
+            self._dirty = False
+
+        sql = """
+            SELECT
+                ch.change_number AS number,
+                MAX(ch.change_patchset) AS patchset,
+                co.commit_id AS commit_id,
+                co.commit_change_id AS change_id,
+                m.message_subject AS subject
+            FROM commit_messages AS m
+            JOIN commit_message_keys AS k ON k.key_id = m.rowid
+            JOIN commits AS co ON co.commit_id = k.key_commit_id
+            JOIN changes AS ch ON ch.change_commit_id = co.commit_id
+            WHERE commit_messages MATCH ?
+            GROUP BY ch.change_number
+            ORDER BY ch.change_number DESC
+        """
+        params = [match]
+        if limit:
+            sql += " LIMIT ?"
+            params.append(limit)
+        with Cursor(self) as cursor:
+            cursor.execute(sql, params)
+            for row in cursor:
+                yield self._as_dict(row)
@@ -21,10 +21,10 @@
 
 import os
 import re
+import subprocess
 import sh
 
-import urllib.request
-
+from git_gerrit.refs import RefReader
 from git_gerrit.error import (
     GitGerritError,
     GitGerritNotFoundError,
@@ -51,6 +51,131 @@ sed -i '/^Change-Id:/d' "$1"
 }
 
 
+def decode(data):
+    """Convert bytes to a str.
+
+    `sh` returns bytes when it is unable to decode using the codec from the
+    current locale, and `git cat-file` always returns bytes.
+    """
+    try:
+        return data.decode('utf-8')
+    except UnicodeDecodeError:
+        pass
+    try:
+        return data.decode('cp1252')
+    except UnicodeDecodeError:
+        pass
+    # Last resort. latin-1 maps all byte values so will
+    # not fail, but may produce garbage text.
+    return data.decode('latin-1', errors='ignore')
+
+
+def parse_trailers(message):
+    """Extract the gerrit trailers from a commit message.
+
+    The Change-Id is taken from the last paragraph of the message (the trailer
+    block) and the cherry picked from commit is the last `git cherry-pick -x`
+    line found in the message.
+
+    args:
+        message (str): the commit message
+    returns:
+        (change_id, picked_from) tuple, either may be None
+    """
+    change_id = None
+    picked_from = None
+    paragraphs = message.strip().split("\n\n")
+    for line in paragraphs[-1].splitlines():
+        m = re.match(r'^Change-Id: (I[0-9a-fA-F]+)', line)
+        if m:
+            change_id = m.group(1)
+    for m in re.finditer(
+        r'^\(cherry picked from commit ([0-9a-fA-F]+)\)', message, re.MULTILINE
+    ):
+        picked_from = m.group(1)
+    return change_id, picked_from
+
+
+def _long_options(options):
+    """Convert keyword options to git long options, as sh does."""
+    args = []
+    for name, value in options.items():
+        name = name.replace("_", "-")
+        if value is True:
+            args.append(f"--{name}")
+        elif value is not False and value is not None:
+            args.append(f"--{name}={value}")
+    return args
+
+
+class CatFile:
+    """Read objects with a long running `git cat-file --batch` process.
+
+    This avoids running a git process for each object read. Use as a context
+    manager to ensure the process is stopped.
+    """
+
+    def __init__(self):
+        self._proc = subprocess.Popen(
+            ["git", "cat-file", "--batch"],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+        )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        """Stop the git cat-file process."""
+        if self._proc:
+            self._proc.stdin.close()
+            self._proc.wait()
+            self._proc.stdout.close()
+            self._proc = None
+
+    def read(self, name):
+        """Read an object.
+
+        args:
+            name (str): the object name, e.g., a commit id
+        returns:
+            (type, data) tuple, where data is the raw object contents (bytes)
+        raises:
+            GitGerritNotFoundError if the object does not exist
+        """
+        self._proc.stdin.write(f"{name}\n".encode())
+        self._proc.stdin.flush()
+        header = self._proc.stdout.readline().decode()
+        if not header:
+            raise GitGerritError("git cat-file exited unexpectedly")
+        fields = header.split()
+        if fields[-1] == "missing" or fields[-1] == "ambiguous":
+            raise GitGerritNotFoundError(f"Object {name} not found.")
+        type_, size = fields[1], int(fields[2])
+        data = self._proc.stdout.read(size)
+        self._proc.stdout.read(1)  # Trailing newline.
+        return type_, data
+
+    def message(self, name):
+        """Read the message of a commit object."""
+        type_, data = self.read(name)
+        if type_ != "commit":
+            raise GitGerritError(f"Object {name} is a {type_}, not a commit.")
+        _, _, message = data.partition(b"\n\n")
+        return decode(message)
+
+    def trailers(self, name):
+        """Read the gerrit trailers of a commit.
+
+        returns:
+            (change_id, picked_from) tuple, either may be None
+        """
+        return parse_trailers(self.message(name))
+
+
 class Git:
     """Git utilities"""
 
@@ -65,10 +190,18 @@ class Git:
             "type": "string",
             "default": "{number} {hash} {subject}",
         },
+        "grepformat": {
+            "type": "string",
+            "default": "{number} {subject}",
+        },
         "no-branch": {
             "type": "boolean",
             "default": "false",
         },
+        "poolsize": {
+            "type": "number",
+            "default": "10",
+        },
         "port": {
             "type": "number",
             "default": "29418",
@@ -93,11 +226,52 @@ class Git:
             "type": "string",
             "default": "",
         },
+        "syncmaxage": {
+            "type": "number",
+            "default": "0",
+        },
     }
 
+    _shared = None
+
     def __init__(self):
         """Initialize the Git utility object."""
         self.git = sh.Command('git').bake(_tty_out=False)
+        self._config = None
+        self._git_dir = None
+
+    @classmethod
+    def shared(cls):
+        """Return the Git utility object shared by the commands in this process.
+
+        The git config values and the .git directory path are cached in the
+        Git utility object, so sharing it avoids running git to look them up
+        again.
+        """
+        if cls._shared is None:
+            cls._shared = cls()
+        return cls._shared
+
+    def reload_config(self):
+        """Discard the cached config values, to read them again on next use."""
+        self._config = None
+
+    def _load_config(self):
+        """Load all of the gerrit.* config values with a single git config."""
+        try:
+            output = str(self.git.config("-z", "--get-regexp", r"^gerrit\."))
+        except sh.ErrorReturnCode_1:
+            output = ""  # No gerrit.* items are set.
+        config = {}
+        for item in output.split("\0"):
+            if not item:
+                continue
+            key, newline, value = item.partition("\n")
+            if not newline:
+                value = "true"  # A boolean without a value is true.
+            # Later values override earlier ones, like git config --get.
+            config[key[len("gerrit.") :]] = value
+        return config
 
     def config(self, name):
         """Return a git-gerrit config value."""
@@ -105,10 +279,12 @@ class Git:
         if name not in self.config_schema:
             raise ValueError(f"Unknown config item {name}")
 
-        try:
-            line = self.git.config("--get", f"gerrit.{name}").rstrip()
-            value = line.rstrip()
-        except sh.ErrorReturnCode_1:
+        if self._config is None:
+            self._config = self._load_config()
+
+        if name in self._config:
+            value = self._config[name]
+        else:
             if "default" in self.config_schema[name]:
                 value = self.config_schema[name]["default"]
             else:
@@ -144,6 +320,8 @@ class Git:
         Return the $GIT_DIR if defined, otherwise return the path to the .git
         directory.
         """
+        if self._git_dir:
+            return self._git_dir
         try:
             line = self.git("rev-parse", "--git-dir")
         except sh.ErrorReturnCode_128 as e:
@@ -151,7 +329,8 @@ class Git:
                 raise GitGerritNotFoundError(e.stderr)
             else:
                 raise GitGerritError(e)
-        return os.path.abspath(line.rstrip())
+        self._git_dir = os.path.abspath(line.rstrip())
+        return self._git_dir
 
     def remote(self):
         """Return the gerrit remote URL."""
@@ -160,9 +339,22 @@ class Git:
         remote = f"https://{host}/{project}"
         return remote
 
-    def fetch(self, refspec, spinner=None):
-        """Run git fetch."""
+    def fetch(self, refspec, spinner=None, remote=None):
+        """Run git fetch.
+
+        The refspec may be a single refspec string or a list of refspecs. A
+        list is passed to git on stdin to avoid command line length limits.
+        The refs are fetched from the gerrit remote, unless another remote is
+        given, e.g., "." to fetch from the local refs.
+        """
         errors = ""
+        options = {}
+        if isinstance(refspec, (list, tuple)):
+            options['stdin'] = True
+            options['_in'] = "".join(f"{r}\n" for r in refspec)
+            refspec = []
+        else:
+            refspec = [refspec]
 
         def handle_output(text):
             nonlocal errors
@@ -173,17 +365,38 @@ class Git:
 
         try:
             self.git.fetch(
-                self.remote(),
-                refspec,
+                remote or self.remote(),
+                *refspec,
                 progress=True,
                 verbose=True,
                 _out=handle_output,
                 _err=handle_output,
                 _tee=True,
+                **options,
             )
         except sh.ErrorReturnCode as e:
             raise GitGerritError(f"Command failed: git fetch: {e.exit_code}: {errors}")
 
+    def ls_remote(self, pattern=".*", refs="refs/changes/*"):
+        """List the refs advertised by the gerrit remote.
+
+        args:
+            pattern (str): regular expression the ref names must match
+            refs (str): ref pattern to request from the remote
+        yields:
+            [sha1, ref] lists
+        """
+        regex = re.compile(f"^([0-9a-fA-F]+)\t({pattern})$")
+        try:
+            lines = self.git("ls-remote", self.remote(), refs, _iter=True)
+            for line in lines:
+                if m := regex.match(line.rstrip()):
+                    sha1 = m.group(1)
+                    ref = m.group(2)
+                    yield [sha1, ref]
+        except sh.ErrorReturnCode as e:
+            raise GitGerritError(f"Command failed: git ls-remote: {e.exit_code}")
+
     def checkout(self, refname):
         """Run git checkout to checkout a change."""
         self.git.checkout(refname)
@@ -191,29 +404,40 @@ class Git:
     def log(self, refname=None, **options):
         """Run git log to show changes."""
 
-        def decode(line):
-            # Convert bytes to a str.  `sh` returns bytes when it is unable to
-            # decode using the codec from the current locale.
-            try:
-                return line.decode('utf-8')
-            except UnicodeDecodeError:
-                pass
-            try:
-                return line.decode('cp1252')
-            except UnicodeDecodeError:
-                pass
-            # Last resort. latin-1 maps all byte values so will
-            # not fail, but may produce garbage text.
-            return line.decode('latin-1', errors='ignore')
-
         if not refname:
             refname = "HEAD"
 
-        for line in self.git.log(refname, _iter=True, **options):
-            if isinstance(line, bytes):
-                line = decode(line)
+        for line in self.pipe("log", refname, *_long_options(options)):
             yield line.rstrip()
 
+    def pipe(self, *args):
+        """Run a git command and yield the output lines as they are read.
+
+        This reads the output from a pipe instead of with the sh _iter option,
+        since sh polls once a second to reap the process after the output ends,
+        which delays the last line by up to a second.
+
+        raises:
+            GitGerritError if the command fails
+        """
+        proc = subprocess.Popen(
+            ["git", *args],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+        )
+        try:
+            for line in proc.stdout:
+                yield decode(line)
+            stderr = proc.stderr.read()
+            if proc.wait() != 0:
+                raise GitGerritError(f"Command failed: git {args[0]}: {decode(stderr)}")
+        finally:
+            if proc.poll() is None:
+                proc.kill()  # The caller stopped reading.
+                proc.wait()
+            proc.stdout.close()
+            proc.stderr.close()
+
     def cherry_pick(self, refname):
         """Run git cherry-pick to cherry pick a change.
 
@@ -229,12 +453,40 @@ class Git:
         except sh.ErrorReturnCode:
             raise GitGerritError(f"Failed to cherry-pick {refname}")
 
-    def show_refs(self, pattern=".*", **options):
+    def ref_reader(self):
+        """Return a reader for the refs files, or None if not supported."""
+        reader = RefReader(self.git_dir())
+        if not reader.is_supported():
+            return None
+        return reader
+
+    def show_refs(self, pattern=".*", prefix="refs/", **options):
+        """List the local refs.
+
+        The refs are read directly from the packed-refs and loose ref files
+        when possible, otherwise git show-ref is run.
+
+        args:
+            pattern (str): regular expression the ref names must match
+            prefix (str): only list the refs starting with this prefix
+        yields:
+            [sha1, ref] lists
+        """
+        regex = re.compile(f"^({pattern})$")
+        reader = None if options else self.ref_reader()
+        if reader:
+            for sha1, ref in reader.refs(prefix):
+                if regex.match(ref):
+                    yield [sha1, ref]
+            return
+
+        regex = re.compile(f"^([0-9a-fA-F]+) ({pattern})$")
         for line in self.git("show-ref", _iter=True, **options):
-            if m := re.match(f"^([0-9a-fA-F]+) ({pattern})$", line.rstrip()):
+            if m := regex.match(line.rstrip()):
                 sha1 = m.group(1)
                 ref = m.group(2)
-                yield [sha1, ref]
+                if ref.startswith(prefix):
+                    yield [sha1, ref]
 
     #
     # Odds and ends.
@@ -242,8 +494,15 @@ class Git:
 
     def does_branch_exist(self, name):
         """Determine if the branch exists in the local repo."""
+        return self.does_ref_exist(f"refs/heads/{name}")
+
+    def does_ref_exist(self, name):
+        """Determine if the ref, e.g., "refs/changes/45/12345/7", exists locally."""
+        reader = self.ref_reader()
+        if reader:
+            return reader.resolve(name) is not None
         try:
-            self.git("show-ref", "--quiet", f"refs/heads/{name}")
+            self.git("show-ref", "--quiet", name)
             return True
         except sh.ErrorReturnCode:
             return False
@@ -257,6 +516,10 @@ class Git:
                 change_id = m.group(1)
         return change_id
 
+    def cat_file(self):
+        """Start a git cat-file reader for reading many objects."""
+        return CatFile()
+
     def cherry_picked_from(self, sha1):
         xsha1 = None
         for line in self.log(sha1, max_count=1, pretty="%B"):
@@ -275,6 +538,7 @@ class Git:
 
     def download_hook(self, name, spinner=None):
         """Download a script from the gerrit server into the git hooks directory."""
+        import urllib.request  # Deferred; only needed to install the hooks.
 
         def report_progress(block_num, block_size, total_size):
             if spinner:
@@ -0,0 +1,191 @@
+# Copyright (c) 2025 Sine Nomine Associates
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this
+#    list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# THE SOFTWARE IS PROVIDED 'AS IS' AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+"""
+Read git refs directly from the files backend, without running git.
+"""
+
+import mmap
+import os
+
+
+class RefReader:
+    """
+    Read refs from the packed-refs file and the loose ref files.
+
+    The packed-refs file is memory mapped, and when it is sorted (as written by
+    modern versions of git), the refs matching a prefix are found with a binary
+    search. Loose refs take precedence over packed refs.
+
+    Repositories using the reftable backend are not supported; check
+    is_supported() before reading refs.
+    """
+
+    def __init__(self, git_dir):
+        """
+        Args:
+            git_dir (str): The path to the .git directory.
+        """
+        self.common_dir = self._find_common_dir(git_dir)
+
+    @staticmethod
+    def _find_common_dir(git_dir):
+        # Linked worktrees keep the shared refs in the main .git directory.
+        path = os.path.join(git_dir, "commondir")
+        if os.path.exists(path):
+            with open(path) as f:
+                return os.path.normpath(os.path.join(git_dir, f.read().strip()))
+        return git_dir
+
+    def is_supported(self):
+        """Return True if the refs are stored in the files backend."""
+        return not os.path.isdir(os.path.join(self.common_dir, "reftable"))
+
+    def refs(self, prefix="refs/"):
+        """
+        Retrieve the refs starting with the prefix, sorted by name.
+
+        Args:
+            prefix (str): The ref name prefix, e.g., "refs/changes/".
+
+        Yields:
+            [sha1, ref] lists
+        """
+        refs = {ref: sha1 for sha1, ref in self._packed_refs(prefix)}
+        refs.update({ref: sha1 for sha1, ref in self._loose_refs(prefix)})
+        for name in sorted(refs):
+            yield [refs[name], name]
+
+    def resolve(self, name):
+        """
+        Retrieve the object id of a ref.
+
+        Args:
+            name (str): The full ref name, e.g., "refs/heads/master".
+
+        Returns:
+            str: The object id, or None if the ref does not exist.
+        """
+        sha1 = self._read_loose_ref(os.path.join(self.common_dir, name))
+        if sha1:
+            return sha1
+        for sha1, ref in self._packed_refs(name):
+            if ref == name:
+                return sha1
+        return None
+
+    def _packed_refs(self, prefix):
+        path = os.path.join(self.common_dir, "packed-refs")
+        try:
+            f = open(path, "rb")
+        except FileNotFoundError:
+            return
+        with f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                key = prefix.encode()
+                header = data.readline()
+                if header.startswith(b"# pack-refs with:") and b" sorted" in header:
+                    offset = _search(data, key)
+                    is_sorted = True
+                else:
+                    offset = 0
+                    is_sorted = False
+                for sha1, ref in _records(data, offset):
+                    if ref.startswith(key):
+                        yield sha1.decode(), ref.decode()
+                    elif is_sorted and ref > key:
+                        break
+
+    def _loose_refs(self, prefix):
+        # The prefix may end in the middle of a path component, so walk the
+        # directory containing the prefix.
+        top = os.path.join(self.common_dir, os.path.dirname(prefix))
+        for dirpath, _, filenames in os.walk(top):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                name = os.path.relpath(path, self.common_dir).replace(os.sep, "/")
+                if name.startswith(prefix) and not name.endswith(".lock"):
+                    sha1 = self._read_loose_ref(path)
+                    if sha1:
+                        yield sha1, name
+
+    @staticmethod
+    def _read_loose_ref(path):
+        try:
+            with open(path) as f:
+                value = f.read().strip()
+        except (FileNotFoundError, NotADirectoryError, IsADirectoryError):
+            return None
+        if value.startswith("ref:"):
+            return None  # Symbolic refs are not supported.
+        return value
+
+
+def _line(data, start):
+    """Return the line at the start offset and the offset of the next line."""
+    end = data.find(b"\n", start)
+    if end < 0:
+        end = len(data)
+    return data[start:end], end + 1
+
+
+def _records(data, offset):
+    """Yield the (sha1, ref) records from the offset, skipping peeled lines."""
+    size = len(data)
+    while offset < size:
+        line, offset = _line(data, offset)
+        if not line or line.startswith(b"#") or line.startswith(b"^"):
+            continue
+        sha1, _, ref = line.partition(b" ")
+        yield sha1, ref.rstrip(b"\r")
+
+
+def _search(data, key):
+    """
+    Binary search a sorted packed-refs file.
+
+    Returns the offset of the first record with a ref name greater than or
+    equal to the key.
+    """
+    lo = 0
+    hi = len(data)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        start = data.rfind(b"\n", lo, mid) + 1
+        if start <= lo:
+            start = lo
+        line, next_ = _line(data, start)
+        if line.startswith(b"^") and start > lo:
+            # A peeled line belongs to the record on the previous line.
+            start = data.rfind(b"\n", lo, start - 1) + 1
+            if start <= lo:
+                start = lo
+            line, _ = _line(data, start)
+        if line.startswith(b"#") or line.startswith(b"^"):
+            lo = next_
+            continue
+        _, _, ref = line.partition(b" ")
+        if ref < key:
+            lo = next_
+        else:
+            hi = start
+    return lo
@@ -0,0 +1,197 @@
+# Copyright (c) 2025 Sine Nomine Associates
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this
+#    list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# THE SOFTWARE IS PROVIDED 'AS IS' AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+"""
+Access the Gerrit REST API with one pooled, keep-alive HTTP session per server.
+
+The session is shared by all of the REST calls in the process, so a command
+which makes many calls (or a daemon which runs many commands) reuses the open
+connections instead of setting up a new TLS connection for each one.
+"""
+
+import json
+import sqlite3
+import threading
+import time
+
+from git_gerrit.error import GitGerritError
+
+POOL_SIZE = 10
+
+# Seconds to use a cached response before revalidating it with the server.
+CACHE_TTL = 60
+
+# Maximum number of cached responses.
+CACHE_SIZE = 1000
+
+_apis = {}
+
+
+def api(url, pool_size=POOL_SIZE):
+    """Return the shared Gerrit REST API object for a server.
+
+    args:
+        url (str): the gerrit server url, e.g., "https://gerrit.example.org"
+        pool_size (int): the maximum number of connections kept open
+    returns:
+        pygerrit2.rest.GerritRestAPI object
+    """
+    gerrit = _apis.get(url)
+    if gerrit is None:
+        # Deferred imports; requests is slow to import.
+        import pygerrit2.rest
+        import requests.adapters
+        import urllib3.util.retry
+
+        # Retry like the pygerrit2 default adapter.
+        retry = urllib3.util.retry.Retry(
+            total=5,
+            read=5,
+            connect=5,
+            backoff_factor=0.3,
+            status_forcelist=(500, 502, 504),
+        )
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=1,
+            pool_maxsize=pool_size,
+            max_retries=retry,
+        )
+        gerrit = pygerrit2.rest.GerritRestAPI(url, adapter=adapter)
+        _apis[url] = gerrit
+    return gerrit
+
+
+def stats():
+    """Return the connection counters of the shared sessions.
+
+    returns:
+        dict with the number of requests sent, and the number of new and
+        reused connections
+    """
+    requests = 0
+    connections = 0
+    for gerrit in _apis.values():
+        adapters = {id(a): a for a in gerrit.session.adapters.values()}
+        for adapter in adapters.values():
+            manager = getattr(adapter, "poolmanager", None)
+            if manager is None:
+                continue
+            for key in manager.pools.keys():
+                pool = manager.pools[key]
+                requests += pool.num_requests
+                connections += pool.num_connections
+    return {
+        "requests": requests,
+        "new_connections": connections,
+        "reused_connections": requests - connections,
+    }
+
+
+def close():
+    """Close the shared sessions."""
+    while _apis:
+        _, gerrit = _apis.popitem()
+        gerrit.session.close()
+
+
+class ResponseCache:
+    """
+    Cache the REST API responses in the git-gerrit database.
+
+    A response younger than the ttl is used without asking the server. An
+    older response is revalidated with its ETag, so when it has not changed the
+    server replies with a short 304 instead of the full JSON. The least
+    recently used responses are removed to keep at most `size` responses.
+
+    The cache may be used by several threads. Use as a context manager to
+    ensure the database is closed. When the database can not be opened, e.g.,
+    outside of a git repository, every request is sent to the server.
+    """
+
+    def __init__(self, ttl=CACHE_TTL, size=CACHE_SIZE):
+        from git_gerrit.db import GitGerritDB
+
+        self.ttl = ttl
+        self.size = size
+        self.hits = 0
+        self.revalidated = 0
+        self.misses = 0
+        try:
+            self._db = GitGerritDB(check_same_thread=False)
+        except (GitGerritError, sqlite3.Error, OSError, ValueError):
+            self._db = None
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        """Close the database."""
+        if self._db:
+            with self._lock:
+                self._db.close()
+                self._db = None
+
+    def get(self, gerrit, endpoint):
+        """Send a GET request, or use the cached response.
+
+        args:
+            gerrit (GerritRestAPI): the REST API object
+            endpoint (str): the endpoint, e.g. "/changes/12345/detail"
+        returns:
+            JSON decoded result
+        """
+        if self._db is None:
+            self.misses += 1
+            return gerrit.get(endpoint)
+        url = gerrit.make_url(endpoint)
+        now = time.time()
+        cached = self._call(self._db.get_response, url)
+        if cached and now - cached['fetched'] < self.ttl:
+            self.hits += 1
+            self._call(self._db.touch_response, url, now)
+            return json.loads(cached['body'])
+
+        headers = {}
+        if cached and cached['etag']:
+            headers['If-None-Match'] = cached['etag']
+        data, response = gerrit.get(endpoint, return_response=True, headers=headers)
+        if cached and response.status_code == 304:
+            self.revalidated += 1
+            self._call(self._db.touch_response, url, now, now)
+            return json.loads(cached['body'])
+
+        self.misses += 1
+        etag = response.headers.get('ETag')
+        body = json.dumps(data)
+        self._call(self._db.set_response, url, etag, body, now, self.size)
+        return data
+
+    def _call(self, method, *args):
+        # The cache is an optimization, so give up on database errors, such as
+        # the database being locked by a long running sync.
+        with self._lock:
+            try:
+                return method(*args)
+            except sqlite3.Error:
+                return None
@@ -0,0 +1,202 @@
+# Copyright (c) 2025 Sine Nomine Associates
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this
+#    list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# THE SOFTWARE IS PROVIDED 'AS IS' AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+"""
+Run the gerrit ssh commands over one shared OpenSSH connection per server.
+
+The first command starts an OpenSSH ControlMaster connection, and the later
+commands of the process are multiplexed over it, so only the first command pays
+for the key exchange and authentication. The master connection is closed when
+the process exits, or by close(). A master left behind by a killed process
+exits by itself once it has been idle for CONTROL_PERSIST seconds.
+"""
+
+import atexit
+import glob
+import os
+import shutil
+import tempfile
+import time
+
+# Seconds an idle master connection is kept after the last command.
+CONTROL_PERSIST = 60
+
+# Seconds between the keepalive messages of the master connection.
+SERVER_ALIVE_INTERVAL = 15
+
+# Seconds after which an empty control directory is considered abandoned.
+STALE_DIR_AGE = 3600
+
+_DIR_PREFIX = "git-gerrit-ssh-"
+
+_sessions = {}
+
+
+def session(host, port):
+    """Return the shared ssh session for a server.
+
+    args:
+        host (str): the gerrit ssh hostname
+        port (int): the gerrit ssh port
+    returns:
+        SshSession object
+    """
+    key = (host, str(port))
+    ssh = _sessions.get(key)
+    if ssh is None:
+        if not _sessions:
+            atexit.register(close)
+        ssh = SshSession(host, port)
+        _sessions[key] = ssh
+    return ssh
+
+
+def close():
+    """Close the shared ssh sessions."""
+    while _sessions:
+        _, ssh = _sessions.popitem()
+        ssh.close()
+
+
+class SshSession:
+    """
+    An OpenSSH connection to a gerrit server, shared with a ControlMaster socket.
+
+    The master connection is started by the first run(). When it can not be
+    started, the commands are run with separate connections, so the errors
+    are reported by the commands themselves.
+    """
+
+    def __init__(self, host, port):
+        """
+        args:
+            host (str): the gerrit ssh hostname
+            port (int): the gerrit ssh port
+        """
+        self.host = host
+        self.port = str(port)
+        self._started = False
+        self._dir = None
+        self._control_path = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def _start(self):
+        import sh
+
+        _remove_stale_dirs()
+        self._started = True
+        # Keep the socket path short; unix socket paths are limited to about
+        # 100 characters.
+        self._dir = tempfile.mkdtemp(prefix=_DIR_PREFIX)
+        control_path = os.path.join(self._dir, "master")
+        try:
+            # The master forks into the background after authenticating. Its
+            # output goes to /dev/null so no pipes are held open.
+            sh.Command("ssh")(
+                "-f",
+                "-N",
+                "-M",
+                "-S",
+                control_path,
+                "-o",
+                f"ControlPersist={CONTROL_PERSIST}",
+                "-o",
+                f"ServerAliveInterval={SERVER_ALIVE_INTERVAL}",
+                "-p",
+                self.port,
+                self.host,
+                _out=os.devnull,
+                _err=os.devnull,
+            )
+            self._control_path = control_path
+        except sh.ErrorReturnCode:
+            self._remove_dir()
+
+    def _remove_dir(self):
+        if self._dir:
+            shutil.rmtree(self._dir, ignore_errors=True)
+            self._dir = None
+
+    def run(self, *args, **kwargs):
+        """Run a command on the server.
+
+        args:
+            args: the remote command and arguments, e.g., 'gerrit', 'review'
+            kwargs: sh special keyword arguments
+        returns:
+            sh command result
+        raises:
+            sh.ErrorReturnCode if the command fails
+        """
+        import sh
+
+        if not self._started:
+            self._start()
+        elif self._control_path and not os.path.exists(self._control_path):
+            # The master has exited, or its temporary directory was removed;
+            # start a new one.
+            self._control_path = None
+            self._remove_dir()
+            self._start()
+        options = []
+        if self._control_path:
+            options = ["-S", self._control_path]
+        return sh.Command("ssh")(*options, "-p", self.port, self.host, *args, **kwargs)
+
+    def close(self):
+        """Stop the master connection."""
+        import sh
+
+        if self._control_path and os.path.exists(self._control_path):
+            try:
+                sh.Command("ssh")(
+                    "-S",
+                    self._control_path,
+                    "-O",
+                    "exit",
+                    self.host,
+                    _out=os.devnull,
+                    _err=os.devnull,
+                )
+            except sh.ErrorReturnCode:
+                pass
+        self._control_path = None
+        self._remove_dir()
+        self._started = False
+
+
+def _remove_stale_dirs():
+    """Remove the empty control directories left behind by killed processes.
+
+    A directory is only removed when it is empty, i.e., its master connection
+    has exited, and it is old enough to not belong to a master being started.
+    """
+    now = time.time()
+    for path in glob.glob(os.path.join(tempfile.gettempdir(), _DIR_PREFIX + "*")):
+        try:
+            if now - os.stat(path).st_mtime > STALE_DIR_AGE:
+                os.rmdir(path)
+        except OSError:
+            pass
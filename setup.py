@@ -32,7 +32,9 @@ setup(
         'console_scripts': [
             'git-gerrit-checkout=git_gerrit.cli:main_git_gerrit_checkout',
             'git-gerrit-cherry-pick=git_gerrit.cli:main_git_gerrit_cherry_pick',
+            'git-gerrit-daemon=git_gerrit.cli:main_git_gerrit_daemon',
             'git-gerrit-fetch=git_gerrit.cli:main_git_gerrit_fetch',
+            'git-gerrit-grep=git_gerrit.cli:main_git_gerrit_grep',
             'git-gerrit-help=git_gerrit.cli:main_git_gerrit_help',
             'git-gerrit-install-hooks=git_gerrit.cli:main_git_gerrit_install_hooks',
             'git-gerrit-log=git_gerrit.cli:main_git_gerrit_log',
@@ -1,8 +1,15 @@
 import pytest
 import os
 import sh
+import urllib.request
+
+import pygerrit2.rest
 
 import git_gerrit
+import git_gerrit.core
+import git_gerrit.git
+import git_gerrit.rest
+import git_gerrit.ssh
 
 
 class MockCommandBase:
@@ -18,6 +25,7 @@ class MockGitCommand(MockCommandBase):
     def __init__(self, log_test_data, *args, **kwargs):
         self._debug = False
         self._log_test_data = log_test_data
+        self.config_loads = 0
         super().__init__(*args, **kwargs)
 
     def __call__(self, *args, **kwargs):
@@ -40,6 +48,16 @@ class MockGitCommand(MockCommandBase):
                 f"{3:040} refs/changes/01/0001/3",
                 f"{4:040} refs/changes/02/0002/1",
             ]
+        if args == ('ls-remote', 'https://gerrit.example.org/mayhem', 'refs/changes/*'):
+            return [
+                f"{1:040}\trefs/changes/01/0001/1",
+                f"{2:040}\trefs/changes/01/0001/2",
+                f"{3:040}\trefs/changes/01/0001/3",
+                f"{5:040}\trefs/changes/01/0001/4",
+                f"{6:040}\trefs/changes/01/0001/meta",
+                f"{4:040}\trefs/changes/02/0002/1",
+                f"{7:040}\trefs/changes/03/0003/1",
+            ]
         raise NotImplementedError(f"MockGitCommand: git {args}")
 
     def _write_args(self, name, args):
@@ -48,24 +66,13 @@ class MockGitCommand(MockCommandBase):
             for arg in args:
                 f.write(f"{arg}\n")
 
-    def config(self, op, name, *args, **kwargs):
+    def config(self, *args, **kwargs):
         if self._debug:
-            print(
-                "\nMockGitCommand.config(): ",
-                f"op={op}, name={name}, args={args}, kwargs={kwargs}",
-            )
-        if op != "--get":
-            raise ValueError(f"Unexpected operation: {op}")
-        if name == "gerrit.project":
-            value = "mayhem"
-        elif name == "gerrit.host":
-            value = "gerrit.example.org"
-        else:
-            sh.ErrorReturnCode_1.exit_code = 1
-            raise sh.ErrorReturnCode_1(
-                f"git config --get gerrit.{name}", b"", b"not found"
-            )
-        return value
+            print(f"\nMockGitCommand.config(): args={args}, kwargs={kwargs}")
+        if args != ("-z", "--get-regexp", r"^gerrit\."):
+            raise ValueError(f"Unexpected arguments: {args}")
+        self.config_loads += 1
+        return "gerrit.project\nmayhem\0gerrit.host\ngerrit.example.org\0"
 
     def log(self, *args, **kwargs):
         if self._debug:
@@ -79,6 +86,12 @@ class MockGitCommand(MockCommandBase):
             # Check for unnhandled options.
             raise NotImplementedError(f"MockGitCommand: git log {args} {kwargs}")
 
+        if "%x1f" in pretty:
+            # Single line records with unit separated fields.
+            return [
+                format_log_record(pretty, record) for record in TESTDATA_LOG_RECORDS
+            ]
+
         try:
             log = self._log_test_data(pretty)
         except KeyError:
@@ -90,6 +103,8 @@ class MockGitCommand(MockCommandBase):
         if self._debug:
             print(f"\nMockGitCommand.fetch(): args={args}, kwargs={kwargs}")
         self._write_args("fetch", args)
+        if "_in" in kwargs:
+            self._write_args("fetch-stdin", kwargs["_in"].splitlines())
 
     def checkout(self, *args, **kwargs):
         if self._debug:
@@ -102,12 +117,61 @@ class MockGitCommand(MockCommandBase):
         self._write_args("cherry-pick", args)
 
 
+def format_log_record(pretty, record):
+    """Format a TESTDATA_LOG_RECORDS record like git log --pretty."""
+    placeholders = {
+        "%H": record["oid"],
+        "%h": record["oid"][:10],
+        "%s": record["subject"],
+        "%an": record["author"],
+        "%ae": record["email"],
+        "%(trailers:key=Reviewed-on,valueonly,separator=%x00)": "\x00".join(
+            record["reviewed_on"]
+        ),
+        "%(trailers:key=Change-Id,valueonly,separator=%x00)": "\x00".join(
+            record["change_id"]
+        ),
+    }
+    values = [placeholders[p] for p in pretty.split("%x1f")]
+    return "\x1f".join(values).rstrip()
+
+
+class MockCatFile:
+    def __init__(self, log_test_data):
+        self._log_test_data = log_test_data
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        pass
+
+    def read(self, name):
+        message = "\n".join(self._log_test_data("%B"))
+        data = f"tree {0:040}\nauthor Alice\n\n{message}"
+        return "commit", data.encode()
+
+    def message(self, name):
+        return "\n".join(self._log_test_data("%B"))
+
+    def trailers(self, name):
+        return git_gerrit.git.parse_trailers(self.message(name))
+
+
 class MockSshCommand(MockCommandBase):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
 
     def __call__(self, *args, **kwargs):
-        return
+        # Append the command line to a file to be checked by the tests.
+        with open("mock-ssh", "a") as f:
+            f.write(" ".join(str(arg) for arg in args) + "\n")
+        if "-M" in args:
+            # Create the control socket like the master connection does.
+            open(args[args.index("-S") + 1], "w").close()
 
 
 @pytest.fixture
@@ -133,6 +197,8 @@ def tmp_gitdir(tmp_path):
     old_cwd = os.getcwd()
     os.chdir(tmp_path)
     os.mkdir(".git")
+    with open(".git/packed-refs", "w") as f:
+        f.write(TESTDATA_PACKED_REFS)
     yield
     os.chdir(old_cwd)
 
@@ -149,18 +215,54 @@ def mock_sh(monkeypatch, tmp_gitdir, log_test_data):
             raise ValueError(f"Unexpected command: {name}")
         return command
 
-    monkeypatch.setattr(git_gerrit.git.sh, "Command", make_command)
-    monkeypatch.setattr(git_gerrit.core.sh, "Command", make_command)
+    def pipe(self, command, *args):
+        # Convert the long options back to sh style keyword arguments.
+        positional = [a for a in args if not a.startswith("--")]
+        options = {}
+        for arg in args:
+            if arg.startswith("--"):
+                name, _, value = arg[2:].partition("=")
+                options[name.replace("-", "_")] = value or True
+        yield from getattr(self.git, command)(*positional, **options)
+
+    monkeypatch.setattr(git_gerrit.git.Git, "_shared", None)
+    monkeypatch.setattr(git_gerrit.git.Git, "pipe", pipe)
+    monkeypatch.setattr(git_gerrit.ssh, "_sessions", {})
+    monkeypatch.setattr(sh, "Command", make_command)
+    monkeypatch.setattr(git_gerrit.git, "CatFile", lambda: MockCatFile(log_test_data))
+
+
+class MockResponse:
+    def __init__(self, status_code=200, headers=None):
+        self.status_code = status_code
+        self.headers = headers or {}
+
+
+@pytest.fixture
+def mock_rest_get(monkeypatch):
+    """Patch GerritRestAPI.get with a function which returns the decoded data."""
+
+    def install(get):
+        def wrapper(self, endpoint, return_response=False, **kwargs):
+            data = get(self, endpoint, **kwargs)
+            if return_response:
+                return data, MockResponse()
+            return data
+
+        monkeypatch.setattr(pygerrit2.rest.GerritRestAPI, "get", wrapper)
+
+    return install
 
 
 @pytest.fixture
-def mock_pygerrit2(monkeypatch, change_test_data):
+def mock_pygerrit2(monkeypatch, mock_rest_get, change_test_data):
 
-    def get(self, endpoint, return_response=False, **kwargs):
+    def get(self, endpoint, **kwargs):
         change = change_test_data("12345")
         return [change]
 
-    monkeypatch.setattr(git_gerrit.core.pygerrit2.GerritRestAPI, "get", get)
+    mock_rest_get(get)
+    monkeypatch.setattr(git_gerrit.rest, "_apis", {})
 
 
 @pytest.fixture
@@ -170,7 +272,7 @@ def mock_urlrequest(monkeypatch):
         with open(path, "w") as f:
             f.write("#!/bin/sh\n")
 
-    monkeypatch.setattr(git_gerrit.git.urllib.request, "urlretrieve", urlretrieve)
+    monkeypatch.setattr(urllib.request, "urlretrieve", urlretrieve)
 
 
 @pytest.fixture
@@ -178,6 +280,17 @@ def mock_modules(mock_sh, mock_pygerrit2, mock_urlrequest):
     return
 
 
+TESTDATA_PACKED_REFS = f"""\
+# pack-refs with: peeled fully-peeled sorted
+{1:040} refs/changes/01/0001/1
+{2:040} refs/changes/01/0001/2
+{3:040} refs/changes/01/0001/3
+{4:040} refs/changes/02/0002/1
+{5:040} refs/heads/branch-exists
+{6:040} refs/tags/v1.0
+^{7:040}
+"""
+
 TESTDATA_REST = {
     "12345": {
         "_number": 12345,
@@ -215,6 +328,44 @@ TESTDATA_REST = {
     },
 }
 
+TESTDATA_LOG_RECORDS = [
+    {
+        "oid": "103629bb91257ff5eba181fc82b81692e42e1954",
+        "subject": "Use wrapper",
+        "author": "Bob",
+        "email": "bob@example.com",
+        "reviewed_on": [],
+        "change_id": [],
+    },
+    {
+        "oid": "5b0775c48db9d89a2e570c0a3417b240c265df6f",
+        "subject": "config: Include afs/lock.h",
+        "author": "Alice",
+        "email": "alice@example.com",
+        "reviewed_on": ["https://gerrit.openafs.org/16549"],
+        "change_id": ["Id25480174c7fa8465357cc40f9a63e24c9271f95"],
+    },
+    {
+        "oid": "30c9bddef972ced072771b17554cf0e8cf572970",
+        "subject": "afs: Free dynamically allocated memory",
+        "author": "alice",
+        "email": "alice@example.com",
+        "reviewed_on": ["https://gerrit.openafs.org/16541"],
+        "change_id": ["I24dd9a04efe1f13432a8a1b1570a979c7a62d405"],
+    },
+    {
+        "oid": "84534b5cf468f93ff1e83c8148af90b011124815",
+        "subject": "Linux: Use a stable dentry name in d_revalidate",
+        "author": "Charles",
+        "email": "charles@example.com",
+        "reviewed_on": [
+            "https://gerrit.openafs.org/12345",
+            "https://gerrit.openafs.org/16528",
+        ],
+        "change_id": ["Ic99b1e5d7667f6841feea78ccf94db43ede40356"],
+    },
+]
+
 TESTDATA_LOG = {
     "": """\
 commit 5b0775c48db9d89a2e570c0a3417b240c265df6f
@@ -264,148 +415,6 @@ Date:   Wed Sep 10 15:03:14 2025 +0530
 103629bb91257ff5eba181fc82b81692e42e1954
 5b0775c48db9d89a2e570c0a3417b240c265df6f
 30c9bddef972ced072771b17554cf0e8cf572970
-""",
-    "oid:%H%nhash:%h%nsubject:%s%nauthor:%an%nemail:%ae%nbody:%n%b%n%%%%": """\
-oid:103629bb91257ff5eba181fc82b81692e42e1954
-hash:103629bb91
-subject:Use wrapper
-author:Bob
-email:bob@example.com
-body:
-Replace the single test-runner wrapper with per-binary wrappers so each
-%%
-oid:5b0775c48db9d89a2e570c0a3417b240c265df6f
-hash:5b0775c48d
-subject:config: Include afs/lock.h
-author:Alice
-email:alice@example.com
-body:
-Many source files #include either src/afs/lock.h for kernel code (aka
-<afs/lock.h>), or src/lwp/lock.h for userspace code (aka <lock.h>).
-
-This one file, src/config/icl.h, includes "lock.h" but refers to the
-kernel afs/lock.h. This works because of how we set our include paths
-while building kernel modules, but is confusing and unnecessary. Change
-this to include "afs/lock.h" instead, to be more consistent about how we
-include this header.
-
-Change-Id: Id25480174c7fa8465357cc40f9a63e24c9271f95
-Reviewed-on: https://gerrit.openafs.org/16549
-Tested-by: BuildBot <buildbot@example.com>
-%%
-oid:30c9bddef972ced072771b17554cf0e8cf572970
-hash:30c9bddef9
-subject:afs: Free dynamically allocated memory
-author:alice
-email:alice@example.com
-body:
-The function ktc_ListTokensEx() allocates memory for cellName,
-which was not being freed in token.c
-
-This commit frees the allocated memory.
-
-Change-Id: I24dd9a04efe1f13432a8a1b1570a979c7a62d405
-Reviewed-on: https://gerrit.openafs.org/16541
-%%
-""",
-    "oid:%H%nhash:%H%nsubject:%s%nauthor:%an%nemail:%ae%nbody:%n%b%n%%%%": """\
-oid:5b0775c48db9d89a2e570c0a3417b240c265df6f
-hash:5b0775c48db9d89a2e570c0a3417b240c265df6f
-subject:config: Include afs/lock.h, not lock.h
-author:Alice
-email:alice@example.com
-body:
-Many source files #include either src/afs/lock.h for kernel code (aka
-<afs/lock.h>), or src/lwp/lock.h for userspace code (aka <lock.h>).
-
-This one file, src/config/icl.h, includes "lock.h" but refers to the
-kernel afs/lock.h. This works because of how we set our include paths
-while building kernel modules, but is confusing and unnecessary. Change
-this to include "afs/lock.h" instead, to be more consistent about how we
-include this header.
-
-Change-Id: Id25480174c7fa8465357cc40f9a63e24c9271f95
-Reviewed-on: https://gerrit.openafs.org/16549
-Reviewed-by: Charles <charles@example.com>
-Reviewed-by: Bob <bob@example.com>
-Tested-by: BuildBot <buildbot@example.com>
-Reviewed-by: Alice <alice@example.com>
-%%
-oid:30c9bddef972ced072771b17554cf0e8cf572970
-hash:30c9bddef972ced072771b17554cf0e8cf572970
-subject:afs: Free dynamically allocated memory for cellName in token.c
-author:alice
-email:alice@example.com
-body:
-The function ktc_ListTokensEx() allocates memory for cellName,
-which was not being freed in token.c
-
-This commit frees the allocated memory.
-
-Co-authored-by: Bob bob@example.com
-Co-authored-by: Bob bob@example.com
-Change-Id: I24dd9a04efe1f13432a8a1b1570a979c7a62d405
-Reviewed-on: https://gerrit.openafs.org/16541
-Reviewed-by: Alice <alice@example.com>
-Reviewed-by: Charles <charles@example.com>
-Tested-by: Charles <charles@example.com>
-Reviewed-by: Charles <charles@example.com>
-%%
-oid:84534b5cf468f93ff1e83c8148af90b011124815
-hash:84534b5cf468f93ff1e83c8148af90b011124815
-subject:Linux: Use a stable dentry name in d_revalidate
-author:Charles
-email:charles@example.com
-body:
-Accessing a stable dentry name (dentry.d_name) directly requires taking
-the d_lock, which can only be held for a short periods of time and
-cannot be easily used in d_revalidate
-
-The Linux 4.13 commit:
-    dentry name snapshots (49d31c2f389ac)
-provides a utility function, take_dentry_name_snapshot(), that creates a
-safe copy of the dentry name.
-
-Update the d_revalidate function to obtain a stable dentry name instead
-of making multiple accesses to the dentry name directly in an unsafe
-manner.
-
-Create wrapper functions get_stable_dentry_name() and
-release_stable_dentry_name() for take_dentry_name_snapshot() and
-release_dentry_name_snapshot() to help deal with backward compatibility
-with Linux versions prior to the 49d31c2f389ac commit.
-
-For Linux versions where take_dentry_name_snapshot is available, use the
-take_dentry_sname_snapshot but also return a pointer to the name that
-was obtained (name_snapshot.name).
-
-For Linux versions prior that do not have the take_dentry_name_snapshot
-the wrapper function simply returns a pointer to the dentry's
-d_name.name, so the existing behavior of accessing the d_name remains
-the same.
-
-Add configure checks to determine if take_dentry_name_snapshot exists,
-and if so check the datatype used within the name_snapshot structure
-to see if it is a qstr or not.  (Some distributions backported the
-49d31c2f389ac commit for older Linux kernels, but the name_snapshot
-structure uses a char * instead of a qstr).
-
-Add a compile time check to ensure that Linux provides
-take_dentry_name_snapshot() after 4.13 so errors during 'configure'
-don't cause us to silently use the unsafe code path by mistake.
-
-Note: This commit doesn't address the issues of using an unstable d_name
-for Linux versions that do not provide the take_dentry_name_snapshot().
-For these versions of Linux, there are problems within the Linux code
-base itself surrounding the use of the dentry's name.
-
-Change-Id: Ic99b1e5d7667f6841feea78ccf94db43ede40356
-Reviewed-on: https://gerrit.openafs.org/16528
-Reviewed-by: Alice <alice@example.com>
-Reviewed-by: Charles <charles@example.com>
-Reviewed-by: Bob <bob@example.com>
-Tested-by: Bob <bob@example.com>
-%%
 """,
     "%(trailers:key=Change-Id)": """\
 Change-Id: I68fd140aab7e65bec1ac537d19de89f9d32443c1
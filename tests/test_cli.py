@@ -1,14 +1,19 @@
 import os
 import stat
 import re
+import subprocess
+import sys
 
 import pytest
 
+import git_gerrit
+import git_gerrit.rest
 from git_gerrit.cli import (
     main_git_gerrit_version,
     main_git_gerrit_checkout,
     main_git_gerrit_cherry_pick,
     main_git_gerrit_fetch,
+    main_git_gerrit_grep,
     main_git_gerrit_help,
     main_git_gerrit_install_hooks,
     main_git_gerrit_log,
@@ -28,7 +33,9 @@ Available commands:
 
     git gerrit-checkout          Fetch then checkout by gerrit number.
     git gerrit-cherry-pick       Cherry pick from upstream branch by gerrit number to make a new gerrit.
+    git gerrit-daemon            Run a resident process to speed up the lookup commands.
     git gerrit-fetch             Fetch by gerrit number.
+    git gerrit-grep              Search the commit messages of the synced changes.
     git gerrit-help              List commands.
     git gerrit-install-hooks     Install git hooks to create gerrit change-ids.
     git gerrit-log               Show oneline log with gerrit numbers.
@@ -97,6 +104,62 @@ def test_query__format_key(key, value, capsys, mock_modules):
     assert value == got
 
 
+def test_query__details_dump(capsys, mock_modules):
+    exit_code = main_git_gerrit_query(
+        ["--dump", "--details", "--concurrency=2", "12345"]
+    )
+    assert exit_code == 0
+    stdout = capsys.readouterr().out
+    assert "'_detail'" in stdout
+
+
+@pytest.fixture
+def rest_requests(mock_modules, mock_rest_get, change_test_data):
+    endpoints = []
+
+    def get(self, endpoint, **kwargs):
+        endpoints.append(endpoint)
+        return [change_test_data("12345")]
+
+    mock_rest_get(get)
+    return endpoints
+
+
+@pytest.mark.parametrize(
+    "options,expected",
+    [
+        ([], 1),
+        (["--cache-ttl=0"], 2),
+        (["--no-cache"], 2),
+    ],
+)
+def test_query__cache_options(options, expected, capsys, rest_requests):
+    for _ in range(2):
+        assert main_git_gerrit_query(options + ["12345"]) == 0
+    assert len(rest_requests) == expected
+
+
+def test_query__verbose_prints_rest_stats(capsys, monkeypatch, mock_modules):
+    stats = {"requests": 3, "new_connections": 1, "reused_connections": 2}
+    monkeypatch.setattr(git_gerrit.rest, "stats", lambda: stats)
+    assert main_git_gerrit_query(["--verbose", "12345"]) == 0
+    assert capsys.readouterr().err == (
+        "REST API requests: 3, new connections: 1, reused connections: 2\n"
+    )
+    assert main_git_gerrit_sync(["-v", "--rest"]) == 0
+    assert capsys.readouterr().err.endswith(
+        "REST API requests: 3, new connections: 1, reused connections: 2\n"
+    )
+
+
+def test_fetch__no_cache(capsys, rest_requests):
+    assert main_git_gerrit_fetch(["12345"]) == 0
+    assert main_git_gerrit_fetch(["12345"]) == 0
+    assert len(rest_requests) == 1
+    assert main_git_gerrit_fetch(["--no-cache", "12345"]) == 0
+    assert len(rest_requests) == 2
+
+
 def test_query__invalid_format_key_fails(capsys, mock_modules):
     exit_code = main_git_gerrit_query(["--format='{bogus}'", "12345"])
     assert exit_code == 1
@@ -113,6 +176,29 @@ def test_query__invalid_format_specifier_fails(capsys, mock_modules):
     assert "Invalid format specifier" in stderr
 
 
+def test_query__invalid_format_fails_before_query(capsys, monkeypatch, mock_modules):
+    def query(*args, **kwargs):
+        raise AssertionError("query() should not be called")
+
+    monkeypatch.setattr(git_gerrit, "query", query)
+    exit_code = main_git_gerrit_query(["--format={number} {subject", "12345"])
+    assert exit_code == 1
+    stderr = capsys.readouterr().err
+    assert "Invalid --format argument" in stderr
+    exit_code = main_git_gerrit_query(
+        ["--offline", "--format={number} {bogus.attr}", "12345"]
+    )
+    assert exit_code == 1
+    stderr = capsys.readouterr().err
+    assert "Invalid --format argument: unknown field 'bogus'" in stderr
+
+
+def test_query__format_accepts_gerrit_change_info_keys(capsys, mock_modules):
+    exit_code = main_git_gerrit_query(["--format={_number}", "12345"])
+    assert exit_code == 0
+    assert capsys.readouterr().out == "12345\n"
+
+
 def test_query__fails_when_no_terms_given(capsys, mock_modules):
     with pytest.raises(SystemExit) as e:
         main_git_gerrit_query([])
@@ -131,6 +217,29 @@ def test_sync(capsys, mock_modules):
     assert exit_code == 0
 
 
+def test_sync__with_jobs(capsys, mock_modules):
+    exit_code = main_git_gerrit_sync(["--jobs", "2", "--limit", "0"])
+    assert exit_code == 0
+
+
+def test_query__offline_after_sync_metadata(capsys, mock_modules):
+    assert main_git_gerrit_sync(["--metadata"]) == 0
+    capsys.readouterr()
+    exit_code = main_git_gerrit_query(["--offline", "frobnicator"])
+    assert exit_code == 0
+    stdout = capsys.readouterr().out
+    assert "12345 Transmogrify the frobnicator" in stdout
+
+
+def test_grep__formats_synced_changes(capsys, mock_modules):
+    assert main_git_gerrit_sync([]) == 0
+    capsys.readouterr()
+    exit_code = main_git_gerrit_grep(["--format={number},{patchset} {subject}", "foo"])
+    assert exit_code == 0
+    stdout = capsys.readouterr().out
+    assert stdout.splitlines() == ["2,1 Foo bar baz", "1,3 Foo bar baz"]
+
+
 def test_version__prints_a_version_string(capsys, mock_modules):
     exit_code = main_git_gerrit_version([])
     assert exit_code == 0
@@ -158,6 +267,13 @@ def test_checkout__to_branch_succeeds(capsys, mock_modules):
     assert mock_checkout == "gerrit/12345/7"
 
 
+def test_checkout__offline_fails_without_sync(capsys, mock_modules):
+    exit_code = main_git_gerrit_checkout(["--offline", "12345"])
+    assert exit_code == 1
+    assert "run git gerrit-sync" in capsys.readouterr().err
+    assert not os.path.exists("mock-fetch")
+
+
 def test_cherry_pick__fails_when_gerrit_is_not_found(capsys, mock_modules):
     exit_code = main_git_gerrit_cherry_pick(["12345"])
     assert exit_code == 1
@@ -187,6 +303,23 @@ def test_fetch__to_branch_succeeds(capsys, mock_modules):
     assert mock_fetch[1] == "refs/changes/45/12345/7:gerrit/12345/7"
 
 
+def test_fetch__query_fetches_matching_changes(capsys, rest_requests):
+    exit_code = main_git_gerrit_fetch(
+        ["--query", "topic:foo", "--branch", "g/{number}"]
+    )
+    assert exit_code == 0
+    assert len(rest_requests) == 1
+    with open("mock-fetch", "r") as f:
+        mock_fetch = f.read().splitlines()
+    assert mock_fetch[1] == "refs/changes/45/12345/7:g/12345"
+
+
+def test_fetch__requires_number_or_query(capsys, mock_modules):
+    with pytest.raises(SystemExit):
+        main_git_gerrit_fetch([])
+    assert "specify <number> or --query" in capsys.readouterr().err
+
+
 def test_install_hook(capsys, mock_modules):
     assert not os.path.exists(".git/hooks/commit-msg")
     assert not os.path.exists(".git/hooks/prepare-commit-msg")
@@ -216,6 +349,78 @@ def test_log__succeeeds(capsys, mock_modules):
     assert lines[2] == "16541 30c9bddef9 afs: Free dynamically allocated memory"
 
 
+def test_log__with_format(capsys, mock_modules):
+    exit_code = main_git_gerrit_log(["--format={hash} {author:>5}"])
+    assert exit_code == 0
+    lines = capsys.readouterr().out.splitlines()
+    assert lines[0] == "103629bb91   Bob"
+    assert not os.path.exists(".git/git-gerrit.db")
+
+
+def test_log__invalid_format_key_fails(capsys, mock_modules):
+    exit_code = main_git_gerrit_log(["--format={number:{bogus}}"])
+    assert exit_code == 1
+    stderr = capsys.readouterr().err
+    assert "unknown field 'bogus'" in stderr
+
+
 def test_update(capsys, mock_modules):
     exit_code = main_git_gerrit_update(["12345", "--message=test"])
     assert exit_code == 0
+    with open("mock-ssh", "r") as f:
+        mock_ssh = f.read().splitlines()
+    reviews = [line for line in mock_ssh if " gerrit review " in line]
+    assert len(reviews) == 1
+    assert reviews[0].endswith(" gerrit review --message test --project mayhem 12345,7")
+
+
+def test_update__does_not_use_cached_responses(capsys, rest_requests):
+    assert main_git_gerrit_query(["12345"]) == 0
+    assert len(rest_requests) == 1
+    assert main_git_gerrit_update(["12345", "--message=test"]) == 0
+    assert main_git_gerrit_update(["12345", "--message=test"]) == 0
+    assert len(rest_requests) == 3
+
+
+def test_update__rest_reports_each_change(capsys, monkeypatch, mock_modules):
+    def update_changes_rest(changes, jobs, **kwargs):
+        assert jobs == 4
+        for change in changes:
+            yield change, "change is closed"
+
+    monkeypatch.setattr(git_gerrit, "update_changes_rest", update_changes_rest)
+    exit_code = main_git_gerrit_update(["--rest", "--jobs=4", "--abandon", "12345"])
+    assert exit_code == 1
+    stderr = capsys.readouterr().err
+    assert "Failed: 12345 Transmogrify the frobnicator: change is closed" in stderr
+
+
+def test_cli__startup_defers_rest_modules():
+    # Local commands should not pay for importing the REST client. The import
+    # time budget is relative to the REST client, imported afterwards in the
+    # same process, so it holds on slow machines but fails when the REST
+    # client is imported by the command line module again.
+    result = subprocess.run(
+        [
+            sys.executable,
+            "-X",
+            "importtime",
+            "-c",
+            "import git_gerrit.cli; import pygerrit2",
+        ],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    imported = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line.split("|")
+        if cumulative.strip().isdigit():
+            imported[name.strip()] = int(cumulative)
+    names = list(imported)
+    cli_modules = names[: names.index("git_gerrit.cli")]
+    for module in ("pygerrit2", "requests", "urllib.request"):
+        assert module not in cli_modules
+    assert imported["git_gerrit.cli"] < imported["pygerrit2"]
@@ -1,16 +1,30 @@
 import os
+import re
+import threading
+import time
+import urllib.parse
+
 import pytest
+import pygerrit2.rest
+import requests
+
+import git_gerrit.core
+
 
 from git_gerrit.core import (
     cherry_pick,
     current_change,
     fetch,
+    fetch_changes,
     get_current_change,
+    grep,
     log,
     query,
     sync,
     update,
+    update_changes,
 )
+from git_gerrit.db import GitGerritDB
 from git_gerrit.error import GitGerritError, GitGerritNotFoundError
 
 
@@ -30,6 +44,82 @@ def test_query(mock_modules):
     assert "details" not in change
 
 
+@pytest.fixture
+def mock_details(mock_rest_get, mock_modules, change_test_data):
+    def get(self, endpoint, **kwargs):
+        if endpoint.startswith("/changes/?"):
+            changes = []
+            for number in range(1, 7):
+                change = change_test_data("12345")
+                change["_number"] = number
+                change["change_id"] = f"I{number}"
+                changes.append(change)
+            return changes
+        change_id = endpoint.split("/")[2]
+        if change_id == "I3":
+            raise requests.HTTPError("404 Client Error: Not Found")
+        # Finish the later requests first.
+        time.sleep(0.01 * (7 - int(change_id[1:])))
+        return {"change_id": change_id}
+
+    mock_rest_get(get)
+
+
+def test_query__with_details_yields_changes_in_order(mock_details):
+    changes = list(query("topic:foo", details=True, concurrency=4))
+    assert [c["number"] for c in changes] == [1, 2, 3, 4, 5, 6]
+    for change in changes:
+        if change["number"] == 3:
+            assert change["_detail"] is None
+            assert "404" in change["_detail_error"]
+        else:
+            assert change["_detail"] == {"change_id": change["change_id"]}
+            assert "_detail_error" not in change
+
+
+@pytest.fixture
+def mock_pages(mock_rest_get, mock_modules, change_test_data):
+    # Serve 7 changes in pages of the requested size.
+    requests = []
+    requested = threading.Event()
+
+    def get(self, endpoint, **kwargs):
+        params = urllib.parse.parse_qs(endpoint.split("?", 1)[1])
+        start = int(params.get("S", ["0"])[0])
+        count = int(params.get("n", ["3"])[0])
+        requests.append((start, count))
+        if start:
+            requested.set()
+        changes = []
+        for number in range(start + 1, min(start + count, 7) + 1):
+            change = change_test_data("12345")
+            change["_number"] = number
+            changes.append(change)
+        if changes and start + count < 7:
+            changes[-1]["_more_changes"] = True
+        return changes
+
+    mock_rest_get(get)
+    return requests, requested
+
+
+def test_query__requests_next_page_ahead(mock_pages):
+    requests, requested = mock_pages
+    changes = query("topic:foo", page_size=3)
+    assert next(changes)["number"] == 1
+    # The second page is requested while the first page is consumed.
+    assert requested.wait(timeout=10)
+    assert [c["number"] for c in changes] == [2, 3, 4, 5, 6, 7]
+    assert requests == [(0, 3), (3, 3), (6, 3)]
+
+
+def test_query__pages_respect_limit(mock_pages):
+    requests, _ = mock_pages
+    changes = list(query("topic:foo", limit=5, page_size=3))
+    assert [c["number"] for c in changes] == [1, 2, 3, 4, 5]
+    assert requests == [(0, 3), (3, 2)]
+
+
 def test_fetch__without_branch(capsys, mock_modules):
     fetch(12345)
     output = capsys.readouterr().out.splitlines()
@@ -58,8 +148,167 @@ def test_fetch__with_branch(capsys, mock_modules):
     assert mock_fetch[1] == "refs/changes/45/12345/7:gerrit/12345/7"
 
 
+@pytest.fixture
+def mock_series(mock_rest_get, mock_modules, change_test_data):
+    # Serve the changes 1 to 3, with patchset 2 as the current patchset.
+    endpoints = []
+
+    def get(self, endpoint, **kwargs):
+        endpoints.append(urllib.parse.unquote_plus(endpoint))
+        numbers = [int(n) for n in re.findall(r"change:(\d+)", endpoints[-1])]
+        changes = []
+        for number in numbers or range(1, 4):
+            if number > 3:
+                continue
+            change = change_test_data("12345")
+            change["_number"] = number
+            change["revisions"] = {
+                f"{number:040}": {
+                    "_number": 2,
+                    "ref": f"refs/changes/{number:02}/{number}/2",
+                }
+            }
+            change["current_revision"] = f"{number:040}"
+            changes.append(change)
+        return changes
+
+    mock_rest_get(get)
+    return endpoints
+
+
+def test_fetch__many_changes_with_one_request_and_one_fetch(capsys, mock_series):
+    fetch([3, 1], branch="gerrit/{number}")
+    assert len(mock_series) == 1
+    assert "q=(change:3 OR change:1) project:mayhem" in mock_series[0]
+    output = capsys.readouterr().out.splitlines()
+    assert output[:2] == ["searching for gerrits 3, 1", "found patchsets 3,2 1,2"]
+    with open("mock-fetch-stdin", "r") as f:
+        mock_fetch_stdin = f.read().splitlines()
+    assert mock_fetch_stdin == [
+        "refs/changes/03/3/2:gerrit/3",
+        "refs/changes/01/1/2:gerrit/1",
+    ]
+
+
+def test_fetch__many_changes_to_fetch_head(capsys, mock_series):
+    fetch([1, 2])
+    assert "fetched 1,2 2,2 to FETCH_HEAD" in capsys.readouterr().out
+    with open("mock-fetch-stdin", "r") as f:
+        assert f.read().splitlines() == ["refs/changes/01/1/2", "refs/changes/02/2/2"]
+
+
+def test_fetch__many_changes_raises_exception_when_change_is_not_found(mock_series):
+    with pytest.raises(GitGerritNotFoundError, match="gerrit 4 not found"):
+        fetch([1, 4])
+
+
+def test_fetch__many_changes_can_not_be_checked_out(mock_series):
+    with pytest.raises(GitGerritError, match="only one change"):
+        fetch([1, 2], checkout=True)
+
+
+def test_fetch_changes__skips_existing_branches(capsys, mock_series):
+    changes = query("topic:foo")
+    assert fetch_changes(changes, branch="branch-{number}") is None
+    with open("mock-fetch-stdin", "r") as f:
+        assert len(f.read().splitlines()) == 3
+    changes = list(query("topic:foo"))
+    changes[1]["number"] = "exists"
+    assert fetch_changes(changes, branch="branch-{number}") == 1
+    assert "branch branch-exists already exists" in capsys.readouterr().out
+    with open("mock-fetch-stdin", "r") as f:
+        assert f.read().splitlines() == [
+            "refs/changes/01/1/2:branch-1",
+            "refs/changes/03/3/2:branch-3",
+        ]
+
+
+@pytest.fixture
+def synced_refs(capsys, mock_modules, mock_rest_get):
+    sync()
+    # The mock git fetch does not create the refs.
+    os.makedirs(".git/refs/changes/01/1")
+    with open(".git/refs/changes/01/1/3", "w") as f:
+        f.write(f"{3:040}\n")
+    requests = []
+
+    def get(self, endpoint, **kwargs):
+        requests.append(endpoint)
+        return []
+
+    mock_rest_get(get)
+    capsys.readouterr()
+    return requests
+
+
+def test_fetch__offline_uses_local_refs(capsys, synced_refs):
+    fetch(1, branch="gerrit/{number}/{patchset}", offline=True)
+    assert synced_refs == []
+    assert "found 1,3 in the local refs" in capsys.readouterr().out
+    with open("mock-fetch", "r") as f:
+        assert f.read().splitlines() == [".", "refs/changes/01/1/3:gerrit/1/3"]
+
+
+def test_fetch__uses_local_refs_after_recent_sync(synced_refs):
+    fetch(1, max_age=3600)
+    assert synced_refs == []
+    with open("mock-fetch", "r") as f:
+        assert f.read().splitlines() == [".", "refs/changes/01/1/3"]
+
+
+def test_fetch__asks_gerrit_after_old_sync(synced_refs):
+    with GitGerritDB() as db:
+        db.set_property('last_sync', "2024-05-23 21:00:00")
+    with pytest.raises(GitGerritNotFoundError):
+        fetch(1, max_age=3600)
+    assert len(synced_refs) == 1
+
+
+def test_fetch__offline_raises_exception_when_ref_is_missing(synced_refs):
+    with pytest.raises(GitGerritNotFoundError, match="not found in the local refs"):
+        fetch(2, offline=True)
+    with pytest.raises(GitGerritError, match="Unknown offline branch field 'topic'"):
+        fetch(1, branch="{topic}", offline=True)
+    assert synced_refs == []
+
+
 def test_update(mock_modules):
     update(12345, message="test")
+    with open("mock-ssh", "r") as f:
+        mock_ssh = f.read().splitlines()
+    commands = [line[line.index("-p ") :] for line in mock_ssh if " gerrit " in line]
+    assert commands == [
+        "-p 29418 gerrit.example.org gerrit review --message test --project mayhem 12345,7"
+    ]
+    assert mock_ssh[0].startswith("-f -N -M -S ")
+
+
+def test_update__looks_up_patchset_without_cache(monkeypatch, mock_modules):
+    def response_cache(*args, **kwargs):
+        raise AssertionError("update() should not use the response cache")
+
+    monkeypatch.setattr(git_gerrit.core.rest, "ResponseCache", response_cache)
+    update(12345, message="test")
+    with open("mock-ssh", "r") as f:
+        assert f.read().splitlines()[-1].endswith(" 12345,7")
+
+
+def test_update_changes__batches_ssh_commands(monkeypatch, mock_modules):
+    monkeypatch.setattr(git_gerrit.core, "SSH_COMMAND_LENGTH", 90)
+    changes = [{"number": 100 + n, "patchset": 2} for n in range(5)]
+    update_changes(changes, abandon=True, add_reviewers=["ty@example.com"])
+    with open("mock-ssh", "r") as f:
+        mock_ssh = f.read().splitlines()
+    reviews = [line[line.index("-p ") :] for line in mock_ssh if " review " in line]
+    assert reviews == [
+        "-p 29418 gerrit.example.org gerrit review --abandon --project mayhem "
+        "100,2 101,2 102,2",
+        "-p 29418 gerrit.example.org gerrit review --abandon --project mayhem "
+        "103,2 104,2",
+    ]
+    reviewers = [line for line in mock_ssh if " gerrit set-reviewers " in line]
+    numbers = [line.partition(" mayhem ")[2] for line in reviewers]
+    assert numbers == ["100", "101", "102", "103", "104"]
 
 
 def test_cherry_pick__succeeds(mock_modules):
@@ -97,6 +346,57 @@ def test_log(mock_modules):
     assert got[1]["subject"] == "config: Include afs/lock.h"
 
 
+def test_log__parses_trailers(mock_modules):
+    got = list(log(shorthash=False))
+    assert got[1]["hash"] == "5b0775c48db9d89a2e570c0a3417b240c265df6f"
+    assert got[1]["change_id"] == "Id25480174c7fa8465357cc40f9a63e24c9271f95"
+    assert got[1]["reviewed_on"] == 16549
+    assert got[3]["subject"] == "Linux: Use a stable dentry name in d_revalidate"
+    assert got[3]["email"] == "charles@example.com"
+    assert got[3]["reviewed_on"] == 16528
+    assert got[3]["number"] == 16528
+
+
+def test_log__populates_only_requested_fields(mock_modules):
+    got = list(log(fields=("hash", "subject")))
+    assert got[1]["hash"] == "5b0775c48d"
+    assert got[1]["subject"] == "config: Include afs/lock.h"
+    assert got[1]["number"] == ""
+    assert got[1]["author"] == ""
+    assert not os.path.exists(".git/git-gerrit.db")
+
+
+def test_log__unknown_field_raises_exception(mock_modules):
+    with pytest.raises(ValueError):
+        list(log(fields=("bogus",)))
+
+
+def test_log__populates_gerrit_fields(mock_modules):
+    with GitGerritDB() as db:
+        db.add_change(16549, 3, "5b0775c48db9d89a2e570c0a3417b240c265df6f")
+        db.update_commit(
+            "5b0775c48db9d89a2e570c0a3417b240c265df6f",
+            "Id25480174c7fa8465357cc40f9a63e24c9271f95",
+            None,
+            1,
+        )
+        db.add_change(16541, 2, "30c9bddef972ced072771b17554cf0e8cf572970")
+        db.update_commit(
+            "30c9bddef972ced072771b17554cf0e8cf572970",
+            "I24dd9a04efe1f13432a8a1b1570a979c7a62d405",
+            "5b0775c48db9d89a2e570c0a3417b240c265df6f",
+            1,
+        )
+    got = list(log())
+    assert [c["number"] for c in got] == ["", 16549, 16541, 16528]
+    assert got[1]["patchset"] == 3
+    assert got[1]["ref"] == "refs/changes/49/16549/3"
+    assert got[1]["change_id"] == "Id25480174c7fa8465357cc40f9a63e24c9271f95"
+    assert got[1]["picked_to"] == "16541"
+    assert got[2]["picked_from"] == 16549
+    assert got[2]["picked_to"] == ""
+
+
 def test_get_current_change__not_found(mock_modules):
     expected = "Change 12345 not found."
     with pytest.raises(GitGerritNotFoundError, match=expected):
@@ -112,3 +412,181 @@ def test_sync(capsys, mock_modules):
         mock_fetch = f.read().splitlines()
     assert mock_fetch[0] == "https://gerrit.example.org/mayhem"
     assert mock_fetch[1] == "refs/changes/*:refs/changes/*"
+    with GitGerritDB() as db:
+        change = db.get_current_patchset_by_number(1)
+        assert change["current_patchset"] == 3
+        assert change["commit_id"] == f"{3:040}"
+        assert change["change_id"] == "Ibc6dab9f4a99d693ea03891ed7222fed9a07a85a"
+        assert (
+            change["cherry_picked_from"] == "75a3a91f5086c011e91bf638e2cc8c03ee373266"
+        )
+        assert change["flags"] == 1
+
+
+def test_sync__with_jobs(capsys, mock_modules):
+    sync(limit=0, jobs=4)
+    with GitGerritDB() as db:
+        changes = list(db.get_current_patchsets())
+        assert [c["number"] for c in changes] == [2, 1]
+        assert all(c["flags"] == 1 for c in changes)
+        assert not list(db.get_current_patchsets(unscanned=True))
+
+
+def test_sync__incremental_fetches_new_refs(capsys, mock_modules):
+    sync()
+    os.remove("mock-fetch")
+    sync(incremental=True)
+    with open("mock-fetch", "r") as f:
+        mock_fetch = f.read().splitlines()
+    assert mock_fetch == ["https://gerrit.example.org/mayhem"]
+    with open("mock-fetch-stdin", "r") as f:
+        mock_fetch_stdin = f.read().splitlines()
+    assert mock_fetch_stdin == [
+        "+refs/changes/01/0001/4:refs/changes/01/0001/4",
+        "+refs/changes/03/0003/1:refs/changes/03/0003/1",
+    ]
+    with GitGerritDB() as db:
+        change = db.get_current_patchset_by_number(1)
+        assert change["current_patchset"] == 4
+        assert change["commit_id"] == f"{5:040}"
+        change = db.get_current_patchset_by_number(3)
+        assert change["current_patchset"] == 1
+
+
+def test_sync__incremental_without_database_fetches_all_refs(capsys, mock_modules):
+    sync(incremental=True)
+    with open("mock-fetch", "r") as f:
+        mock_fetch = f.read().splitlines()
+    assert mock_fetch[1] == "refs/changes/*:refs/changes/*"
+
+
+def test_sync__records_last_sync_time(capsys, mock_modules):
+    sync()
+    with GitGerritDB() as db:
+        last_sync = db.get_property('last_sync')
+    assert re.match(r"^\d{4}-\d\d-\d\d \d\d:\d\d:\d\d$", last_sync)
+
+
+def test_sync__rest_fetches_updated_changes(capsys, monkeypatch, mock_modules):
+    sync()
+    with GitGerritDB() as db:
+        db.set_property('last_sync', "2024-05-23 21:00:00")
+    endpoints = []
+    get = pygerrit2.rest.GerritRestAPI.get
+
+    def mock_get(self, endpoint, **kwargs):
+        endpoints.append(urllib.parse.unquote_plus(endpoint))
+        return get(self, endpoint, **kwargs)
+
+    monkeypatch.setattr(pygerrit2.rest.GerritRestAPI, "get", mock_get)
+    sync(rest=True)
+    assert 'q=after:"2024-05-23 20:50:00 +0000" project:mayhem' in endpoints[0]
+    assert "o=ALL_REVISIONS" in endpoints[0]
+    with open("mock-fetch-stdin", "r") as f:
+        mock_fetch_stdin = f.read().splitlines()
+    assert mock_fetch_stdin == ["+refs/changes/45/12345/7:refs/changes/45/12345/7"]
+    with GitGerritDB() as db:
+        change = db.get_current_patchset_by_number(12345)
+        assert change["current_patchset"] == 7
+        assert change["commit_id"] == "0123456789abcdef0123456789abcdef01234567"
+
+
+def test_query__offline_searches_synced_metadata(capsys, mock_modules):
+    sync(metadata=True)
+    changes = list(query("status:open branch:master", offline=True))
+    assert [c["number"] for c in changes] == [12345]
+    assert changes[0]["subject"] == "Transmogrify the frobnicator"
+    assert list(query("frobnicator change:12345", offline=True))
+    assert not list(query("status:merged", offline=True))
+    assert not list(query("branch:master project:other", offline=True))
+
+
+def test_query__offline_rejects_unsupported_operators(capsys, mock_modules):
+    sync(metadata=True)
+    with pytest.raises(GitGerritError, match="Unsupported offline search operator"):
+        list(query("label:Code-Review=2", offline=True))
+
+
+@pytest.mark.parametrize(
+    "search",
+    [
+        "status:open OR status:merged",
+        "NOT status:merged",
+        "-status:merged",
+        "(status:open branch:master)",
+        "status:reviewed",
+    ],
+)
+def test_query__offline_rejects_unsupported_syntax(search, capsys, mock_modules):
+    sync(metadata=True)
+    with pytest.raises(GitGerritError, match="Unsupported offline search"):
+        list(query(search, offline=True))
+
+
+def test_query__offline_without_metadata_raises_exception(mock_modules):
+    with pytest.raises(GitGerritError, match="No change metadata"):
+        list(query("status:open", offline=True))
+
+
+def test_grep__finds_synced_commit_messages(capsys, mock_modules):
+    sync()
+    changes = list(grep(["Foo bar"]))
+    assert [c["number"] for c in changes] == [2, 1]
+    assert changes[1]["patchset"] == 3
+    assert changes[1]["ref"] == "refs/changes/01/1/3"
+    assert changes[1]["url"] == "https://gerrit.example.org/1"
+    assert changes[1]["subject"] == "Foo bar baz"
+    assert list(grep(["update", "the baz fil*"], limit=1)) == changes[:1]
+    assert not list(grep(["frobnicator"]))
+
+
+def test_grep__fails_without_fts5(monkeypatch, mock_modules):
+    monkeypatch.setattr(
+        "git_gerrit.db.MESSAGE_INDEX_SCRIPT",
+        "CREATE VIRTUAL TABLE commit_messages USING no_such_module (x);",
+    )
+    with pytest.raises(GitGerritError, match="FTS5"):
+        list(grep(["frobnicator"]))
+
+
+class CountingGit:
+    def __init__(self):
+        self.reads = []
+
+    def cat_file(self):
+        git = self
+
+        class Reader:
+            def message(self, commit_id):
+                git.reads.append(commit_id)
+                return f"Subject {commit_id}\n\nChange-Id: I{commit_id}\n"
+
+            def close(self):
+                pass
+
+        return Reader()
+
+
+def test_scan_commits__bounds_read_ahead():
+    git = CountingGit()
+    commit_ids = [f"{i:040x}" for i in range(100)]
+    scanned = git_gerrit.core._scan_commits(git, commit_ids, jobs=2, chunk_size=5)
+    first = next(scanned)
+    assert first[:2] == (commit_ids[0], f"I{commit_ids[0]}")
+    assert len(git.reads) <= 2 * 2 * 5
+    assert [c[0] for c in scanned] == commit_ids[1:]
+
+
+def test_ordered_map__yields_in_order_with_bounded_read_ahead():
+    submitted = []
+
+    def square(n):
+        submitted.append(n)
+        time.sleep(0.001 * (5 - n % 5))  # Finish out of order.
+        return n * n
+
+    results = git_gerrit.core._ordered_map(square, range(20), jobs=3)
+    item, future = next(results)
+    assert (item, future.result()) == (0, 0)
+    assert len(submitted) <= 3
+    assert [f.result() for _, f in results] == [n * n for n in range(1, 20)]
@@ -0,0 +1,117 @@
+import os
+import threading
+
+import pytest
+
+from git_gerrit import daemon
+from git_gerrit.error import GitGerritError
+
+
+def serve(server):
+    with server:
+        server.serve()
+
+
+@pytest.fixture
+def running_daemon(mock_modules):
+    server = daemon.Daemon(os.path.abspath(".git"))
+    server.thread = threading.Thread(target=serve, args=(server,))
+    server.thread.start()
+    yield server
+    if server.thread.is_alive():
+        daemon.stop(server.git_dir)
+        server.thread.join(timeout=10)
+
+
+def test_find_git_dir__finds_parent_git_dir(monkeypatch, tmp_path):
+    monkeypatch.delenv("GIT_DIR", raising=False)
+    (tmp_path / ".git").mkdir()
+    (tmp_path / "src").mkdir()
+    assert daemon.find_git_dir(tmp_path / "src") == str(tmp_path / ".git")
+
+
+def test_find_git_dir__reads_gitdir_file(monkeypatch, tmp_path):
+    monkeypatch.delenv("GIT_DIR", raising=False)
+    (tmp_path / "main" / ".git" / "worktrees" / "wt").mkdir(parents=True)
+    (tmp_path / "wt").mkdir()
+    (tmp_path / "wt" / ".git").write_text(
+        f"gitdir: {tmp_path}/main/.git/worktrees/wt\n"
+    )
+    expected = str(tmp_path / "main" / ".git" / "worktrees" / "wt")
+    assert daemon.find_git_dir(tmp_path / "wt") == expected
+
+
+def test_forward__returns_none_when_not_running(mock_modules):
+    assert daemon.forward("log", []) is None
+    assert daemon.status(os.path.abspath(".git")) is None
+
+
+def test_forward__runs_command_in_daemon(capsys, running_daemon):
+    assert daemon.status(running_daemon.git_dir) == os.getpid()
+    exit_code = daemon.forward("log", ["--format={number} {hash}"])
+    assert exit_code == 0
+    lines = capsys.readouterr().out.splitlines()
+    assert lines[1] == "16549 5b0775c48d"
+
+
+def test_forward__returns_usage_errors(capsys, running_daemon):
+    exit_code = daemon.forward("number", ["bogus"])
+    assert exit_code == 2
+    assert "invalid int value" in capsys.readouterr().err
+
+
+def test_forward__skips_other_commands(running_daemon):
+    assert daemon.forward("sync", []) is None
+
+
+@pytest.mark.parametrize("argv", [["--checkout", "12345"], ["12345", "--check"]])
+def test_forward__does_not_forward_checkout(argv, running_daemon):
+    assert daemon.forward("number", argv) is None
+
+
+def test_forward__runs_locally_with_other_git_config(monkeypatch, running_daemon):
+    # Set by "git -c gerrit.logformat={subject} gerrit-log".
+    monkeypatch.setenv("GIT_CONFIG_PARAMETERS", "'gerrit.logformat={subject}'")
+    assert daemon.forward("log", []) is None
+
+
+def test_forward__streams_output(monkeypatch, running_daemon):
+    monkeypatch.setattr(daemon, "OUTPUT_CHUNK_SIZE", 1)
+    request = {
+        "command": "log",
+        "argv": ["--format={number}"],
+        "cwd": os.getcwd(),
+        "env": daemon.environment(),
+    }
+    responses = list(
+        daemon._responses(daemon.socket_path(running_daemon.git_dir), request)
+    )
+    assert len(responses) > 2
+    assert all(list(r) == ["stdout"] for r in responses[:-1])
+    assert responses[-1] == {"exit_code": 0}
+
+
+def test_forward__disabled_by_environment(monkeypatch, running_daemon):
+    monkeypatch.setenv("GIT_GERRIT_NO_DAEMON", "1")
+    assert daemon.forward("log", []) is None
+
+
+def test_daemon__fails_when_already_running(running_daemon):
+    with pytest.raises(GitGerritError):
+        daemon.Daemon(running_daemon.git_dir)
+
+
+def test_daemon__replaces_stale_socket(mock_modules):
+    git_dir = os.path.abspath(".git")
+    with open(daemon.socket_path(git_dir), "w"):
+        pass
+    with daemon.Daemon(git_dir) as server:
+        assert os.path.exists(server.path)
+    assert not os.path.exists(daemon.socket_path(git_dir))
+
+
+def test_stop__stops_daemon(running_daemon):
+    assert daemon.stop(running_daemon.git_dir)
+    running_daemon.thread.join(timeout=10)
+    assert not os.path.exists(running_daemon.path)
+    assert not daemon.stop(running_daemon.git_dir)
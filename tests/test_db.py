@@ -1,6 +1,15 @@
+import sqlite3
+
 import pytest
 
-from git_gerrit.db import GitGerritDB, Cursor, SCHEMA_VERSION
+from git_gerrit.db import (
+    DATABASE,
+    MAGIC,
+    MIGRATION_SCRIPTS,
+    SCHEMA_VERSION,
+    GitGerritDB,
+    Cursor,
+)
 
 
 @pytest.fixture
@@ -35,6 +44,77 @@ def test_db_init__creates_tables(db):
     assert len(names) != 0
 
 
+def test_db_init__creates_indexes(db):
+    with Cursor(db) as cursor:
+        cursor.execute("SELECT name FROM sqlite_master WHERE type='index'")
+        names = [row['name'] for row in cursor.fetchall()]
+    assert "changes_by_commit_id" in names
+    assert "commits_by_picked_from" in names
+
+
+def test_db_init__upgrades_version_1_schema(mock_modules):
+    conn = sqlite3.connect(f".git/{DATABASE}")
+    conn.execute(f"PRAGMA application_id = {MAGIC}")
+    conn.executescript(MIGRATION_SCRIPTS[0])
+    conn.execute("PRAGMA user_version = 1")
+    conn.execute("INSERT INTO changes VALUES (101, 1, 'aaa')")
+    conn.commit()
+    conn.close()
+
+    with GitGerritDB() as db:
+        assert db._get_schema_version() == SCHEMA_VERSION
+        assert db.get_change_by_commit("aaa")["number"] == 101
+        assert db.get_current_patchset_by_number(101)["commit_id"] == "aaa"
+        with Cursor(db) as cursor:
+            cursor.execute("SELECT name FROM sqlite_master WHERE type='index'")
+            names = [row['name'] for row in cursor.fetchall()]
+        assert "changes_by_commit_id" in names
+
+
+def test_db_init__upgrade_rescans_commits_for_message_index(mock_modules):
+    conn = sqlite3.connect(f".git/{DATABASE}")
+    conn.execute(f"PRAGMA application_id = {MAGIC}")
+    for script in MIGRATION_SCRIPTS[:6]:
+        conn.executescript(script)
+    conn.execute("PRAGMA user_version = 6")
+    conn.execute("INSERT INTO commits VALUES ('aaa', 'I101', NULL, 1)")
+    conn.commit()
+    conn.close()
+
+    with GitGerritDB() as db:
+        with Cursor(db) as cursor:
+            cursor.execute("SELECT commit_flags FROM commits")
+            assert cursor.fetchone()["commit_flags"] == 0
+
+
+def test_db_init__replaces_message_index_keyed_by_rowid(mock_modules):
+    conn = sqlite3.connect(f".git/{DATABASE}")
+    conn.execute(f"PRAGMA application_id = {MAGIC}")
+    for script in MIGRATION_SCRIPTS:
+        conn.executescript(script)
+    conn.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+    conn.execute("CREATE VIRTUAL TABLE commit_messages USING fts5 (s, b)")
+    conn.execute("INSERT INTO commits VALUES ('aaa', 'I101', NULL, 1)")
+    conn.commit()
+    conn.close()
+
+    with GitGerritDB() as db:
+        assert db.has_message_index
+        with Cursor(db) as cursor:
+            cursor.execute("SELECT commit_flags FROM commits")
+            assert cursor.fetchone()["commit_flags"] == 0
+            cursor.execute("SELECT key_commit_id FROM commit_message_keys")
+
+
+def test_db_set_property__stores_value(db):
+    assert db.get_property("last_sync") is None
+    assert db.get_property("last_sync", "never") == "never"
+    db.set_property("last_sync", "2024-05-23 21:45:57")
+    assert db.get_property("last_sync") == "2024-05-23 21:45:57"
+    db.set_property("last_sync", "2024-05-24 00:00:00")
+    assert db.get_property("last_sync") == "2024-05-24 00:00:00"
+
+
 def test_db_add_change__inserts_into_tables(db):
     db.add_change(123, 1, "abc")
     with Cursor(db) as cursor:
@@ -50,6 +130,22 @@ def test_db_add_change__inserts_into_tables(db):
         assert commit["commit_flags"] == 0
 
 
+def test_db_add_changes__inserts_batches(db):
+    changes = [(200 + n // 3, n % 3 + 1, f"c{n}") for n in range(10)]
+    assert db.add_changes(changes, batch_size=4) == 10
+    with Cursor(db) as cursor:
+        cursor.execute("SELECT COUNT(*) AS count FROM changes")
+        assert cursor.fetchone()["count"] == 10
+        cursor.execute("SELECT COUNT(*) AS count FROM commits")
+        assert cursor.fetchone()["count"] == 10
+    change = db.get_current_patchset_by_number(202)
+    assert change["current_patchset"] == 3
+    assert change["commit_id"] == "c8"
+    change = db.get_current_patchset_by_number(203)
+    assert change["current_patchset"] == 1
+    assert change["commit_id"] == "c9"
+
+
 def test_db_update_commit__updates_commit_row(db):
     db.add_change(123, 1, "abc")
     db.update_commit("abc", "I123", "def", 1)
@@ -62,6 +158,63 @@ def test_db_update_commit__updates_commit_row(db):
         assert commit["commit_flags"] == 1
 
 
+def test_db_update_commits__updates_commit_rows(staged_db):
+    db = staged_db
+    commits = [("aaa", "I101", None, 1), ("eee", "I103", "hhh", 1)]
+    assert db.update_commits(commits, batch_size=1) == 2
+    with Cursor(db) as cursor:
+        cursor.execute("SELECT * FROM commits WHERE commit_flags=1 ORDER BY commit_id")
+        rows = [dict(row) for row in cursor.fetchall()]
+    assert [r["commit_id"] for r in rows] == ["aaa", "ccc", "eee"]
+    assert rows[2]["commit_change_id"] == "I103"
+    assert rows[2]["commit_picked_from"] == "hhh"
+
+
+def test_db_search_commit_messages__finds_newest_matching_patchset(staged_db):
+    db = staged_db
+    commits = [
+        ("bbb", "I101", None, 1, "Fix the frobnicator\n\nIt was broken.\n"),
+        ("ccc", "I102", None, 1, "Add a widget\n\nFor the frobnicator.\n"),
+        ("eee", "I103", None, 1, "Fix the frobnicator\n"),
+        ("fff", "I103", None, 1, "Fix the frobnicator again\n"),
+    ]
+    db.update_commits(commits)
+    db.update_commits([("fff", "I103", None, 1, "Fix the frobnicator (v3)\n")])
+
+    changes = list(db.search_commit_messages("frobnicator"))
+    assert [(c["number"], c["patchset"]) for c in changes] == [
+        (103, 3),
+        (102, 1),
+        (101, 2),
+    ]
+    assert changes[0]["subject"] == "Fix the frobnicator (v3)"
+    assert changes[0]["commit_id"] == "fff"
+    assert [c["number"] for c in db.search_commit_messages('"fix the"')] == [103, 101]
+    assert [c["number"] for c in db.search_commit_messages("broken")] == [101]
+    assert len(list(db.search_commit_messages("frobnicator", limit=1))) == 1
+
+
+def test_db_search_commit_messages__survives_renumbered_commits(staged_db):
+    db = staged_db
+    db.update_commits([("bbb", "I101", None, 1, "Fix the frobnicator\n")])
+    with db._conn:
+        # VACUUM may renumber the rowids of the commits table.
+        db._conn.execute("UPDATE commits SET rowid = rowid + 100")
+    assert [c["commit_id"] for c in db.search_commit_messages("frobnicator")] == ["bbb"]
+
+
+def test_db_update_commits__ignores_messages_without_fts5(monkeypatch, mock_modules):
+    monkeypatch.setattr(
+        "git_gerrit.db.MESSAGE_INDEX_SCRIPT",
+        "CREATE VIRTUAL TABLE commit_messages USING no_such_module (x);",
+    )
+    with GitGerritDB() as db:
+        assert not db.has_message_index
+        db.add_change(101, 1, "aaa")
+        db.update_commits([("aaa", "I101", None, 1, "Fix the frobnicator\n")])
+        assert db.get_change_by_commit("aaa")["flags"] == 1
+
+
 def test_db_get_current_patchsets__returns_latest_patchsets(staged_db):
     db = staged_db
 
@@ -93,6 +246,28 @@ def test_db_get_current_patchsets__returns_latest_patchsets(staged_db):
     assert changes[0]["number"] == 103
 
 
+def test_db_get_current_patchsets__returns_unscanned_patchsets(staged_db):
+    db = staged_db
+    changes = list(db.get_current_patchsets(unscanned=True))
+    assert [c["number"] for c in changes] == [103, 101]
+
+    changes = list(db.get_current_patchsets(limit=1, unscanned=True))
+    assert [c["number"] for c in changes] == [103]
+
+
+def test_db_add_change__keeps_newest_current_patchset(db):
+    db.add_change(104, 2, "bbb")
+    db.add_change(104, 1, "aaa")
+    change = db.get_current_patchset_by_number(104)
+    assert change["current_patchset"] == 2
+    assert change["commit_id"] == "bbb"
+
+    db.add_change(104, 3, "ccc")
+    change = db.get_current_patchset_by_number(104)
+    assert change["current_patchset"] == 3
+    assert change["commit_id"] == "ccc"
+
+
 def test_db_get_current_patchset__returns_latest_patchset_by_number(staged_db):
     db = staged_db
     change = db.get_current_patchset_by_number(101)
@@ -119,3 +294,82 @@ def test_db_get_current_patchset__returns_latest_patchset_by_number(staged_db):
 
     change = db.get_current_patchset_by_number(999)
     assert change is None
+
+
+def test_db_get_changes_by_commits__returns_changes(staged_db):
+    db = staged_db
+    db.add_change(104, 1, "ggg")
+    changes = db.get_changes_by_commits(["aaa", "fff", "zzz"])
+    assert sorted(changes) == ["aaa", "fff"]
+    assert changes["aaa"]["number"] == 101
+    assert changes["aaa"]["patchset"] == 1
+    assert changes["aaa"]["cherry_picked_from_number"] is None
+    assert changes["fff"]["number"] == 103
+    assert changes["fff"]["patchset"] == 3
+    assert changes["fff"]["change_id"] == "I103"
+    assert changes["fff"]["cherry_picked_from"] == "ggg"
+    assert changes["fff"]["cherry_picked_from_number"] == 104
+    assert db.get_changes_by_commits([]) == {}
+
+
+def test_db_get_cherry_pick_numbers_by_commits__returns_numbers(staged_db):
+    db = staged_db
+    db.add_change(104, 1, "hhh")
+    db.update_commit("hhh", "I104", "ggg", 1)
+    db.update_commit("ccc", "I102", "aaa", 1)
+    picks = db.get_cherry_pick_numbers_by_commits(["ggg", "aaa", "bbb"])
+    assert picks == {"ggg": [103, 104], "aaa": [102]}
+
+
+def test_db_keep_open__open_returns_resident_db(mock_modules):
+    resident = GitGerritDB.keep_open()
+    try:
+        with GitGerritDB.open() as db:
+            assert db is resident
+            db.add_change(101, 1, "aaa")
+        # Still open after the with block.
+        assert resident.get_change_commits() == {(101, 1): "aaa"}
+    finally:
+        GitGerritDB.release()
+    assert resident._conn is None
+    with GitGerritDB.open() as db:
+        assert db is not resident
+
+
+def test_db_search_change_infos__matches_terms_and_text(db):
+    db.add_change_infos(
+        [
+            {
+                "number": 1,
+                "branch": "master",
+                "status": "NEW",
+                "subject": "Fix 100%",
+                "updated": "2024-01-01",
+            },
+            {
+                "number": 2,
+                "branch": "master",
+                "status": "MERGED",
+                "subject": "Fix it",
+                "updated": "2024-01-02",
+            },
+            {
+                "number": 3,
+                "branch": "stable",
+                "status": "NEW",
+                "subject": "Add it",
+                "updated": "2024-01-03",
+            },
+        ]
+    )
+
+    def numbers(*args, **kwargs):
+        return [c["number"] for c in db.search_change_infos(*args, **kwargs)]
+
+    assert numbers([]) == [3, 2, 1]
+    assert numbers([("branch", ["master"])]) == [2, 1]
+    assert numbers([("status", ["NEW"]), ("branch", ["master"])]) == [1]
+    assert numbers([], ["fix"]) == [2, 1]
+    assert numbers([], ["100%"]) == [1]
+    assert numbers([], ["x_"]) == []
+    assert numbers([("status", ["NEW", "MERGED"])], limit=2) == [3, 2]
@@ -1,7 +1,13 @@
 import os
 import stat
+import subprocess
 import pytest
 import git_gerrit.git
+from git_gerrit.error import (
+    GitGerritConfigError,
+    GitGerritError,
+    GitGerritNotFoundError,
+)
 
 
 @pytest.fixture
@@ -14,6 +20,34 @@ def test_config__good_name_returns_value(git):
     assert git.config("host") == "gerrit.example.org"
 
 
+def test_config__loads_config_once(git):
+    assert git.config("project") == "mayhem"
+    assert git.config("port") == 29418
+    assert git.config("no-branch") is False
+    assert git.config("remote") == "origin"
+    assert git.git.config_loads == 1
+
+
+def test_config__missing_required_name_raises_exception(git, monkeypatch):
+    monkeypatch.setattr(git.git, "config", lambda *args: "gerrit.port\n1234\0")
+    with pytest.raises(GitGerritConfigError):
+        git.config("host")
+    assert git.config("port") == 1234
+
+
+def test_config__boolean_without_value_is_true(git, monkeypatch):
+    monkeypatch.setattr(git.git, "config", lambda *args: "gerrit.no-branch\0")
+    assert git.config("no-branch") is True
+
+
+def test_shared__returns_same_instance(mock_modules):
+    git = git_gerrit.git.Git.shared()
+    assert git_gerrit.git.Git.shared() is git
+    assert git.config("host") == "gerrit.example.org"
+    assert git.config("project") == "mayhem"
+    assert git.git.config_loads == 1
+
+
 def test_config__unknown_name_raises_exception(git):
     with pytest.raises(ValueError):
         git.config("bogus")
@@ -38,6 +72,25 @@ def test_fetch(git):
     assert mock_fetch[1] == "test-fetch-branch-name"
 
 
+def test_fetch__refspec_list(git):
+    git.fetch(["refs/changes/01/1/1:refs/changes/01/1/1", "refs/heads/a:a"])
+    with open("mock-fetch", "r") as f:
+        mock_fetch = f.read().splitlines()
+    assert mock_fetch == ["https://gerrit.example.org/mayhem"]
+    with open("mock-fetch-stdin", "r") as f:
+        mock_fetch_stdin = f.read().splitlines()
+    assert mock_fetch_stdin == [
+        "refs/changes/01/1/1:refs/changes/01/1/1",
+        "refs/heads/a:a",
+    ]
+
+
+def test_ls_remote(git):
+    refs = list(git.ls_remote(r"refs/changes/\d\d/\d+/\d+"))
+    assert len(refs) == 6
+    assert refs[0] == [f"{1:040}", "refs/changes/01/0001/1"]
+
+
 def test_checkout(git):
     git.checkout("test-checkout-branch-name")
     with open("mock-checkout", "r") as f:
@@ -67,6 +120,42 @@ def test_does_branch_exist__returns_false_branch_is_missing(git):
     assert git.does_branch_exist("branch-is-missing") is False
 
 
+def test_does_branch_exist__finds_loose_branch(git):
+    os.makedirs(".git/refs/heads/topic")
+    with open(".git/refs/heads/topic/loose", "w") as f:
+        f.write(f"{8:040}\n")
+    assert git.does_branch_exist("topic/loose") is True
+    assert git.does_branch_exist("topic") is False
+
+
+def test_does_branch_exist__falls_back_to_show_ref_with_reftable(git):
+    os.mkdir(".git/reftable")
+    assert git.does_branch_exist("branch-exists") is True
+    assert git.does_branch_exist("branch-is-missing") is False
+
+
+def test_show_refs__reads_packed_and_loose_refs(git):
+    os.makedirs(".git/refs/changes/02/0002")
+    with open(".git/refs/changes/02/0002/2", "w") as f:
+        f.write(f"{9:040}\n")
+    refs = list(git.show_refs(r"refs/changes/\d\d/\d+/\d+", prefix="refs/changes/"))
+    assert refs == [
+        [f"{1:040}", "refs/changes/01/0001/1"],
+        [f"{2:040}", "refs/changes/01/0001/2"],
+        [f"{3:040}", "refs/changes/01/0001/3"],
+        [f"{4:040}", "refs/changes/02/0002/1"],
+        [f"{9:040}", "refs/changes/02/0002/2"],
+    ]
+    assert list(git.show_refs(prefix="refs/tags/")) == [[f"{6:040}", "refs/tags/v1.0"]]
+
+
+def test_show_refs__falls_back_to_show_ref_with_reftable(git):
+    os.mkdir(".git/reftable")
+    refs = list(git.show_refs(r"refs/changes/\d\d/\d+/\d+", prefix="refs/changes/"))
+    assert len(refs) == 4
+    assert refs[3] == [f"{4:040}", "refs/changes/02/0002/1"]
+
+
 def test_download_hook(git):
     git.download_hook("commit-msg")
     assert os.path.exists(".git/hooks/commit-msg")
@@ -86,3 +175,61 @@ def test_write_hook(git):
 def test_change_id(git):
     got = git.change_id("0" * 40)
     assert got == "I68fd140aab7e65bec1ac537d19de89f9d32443c1"
+
+
+def test_parse_trailers(log_test_data):
+    message = "\n".join(log_test_data("%B"))
+    change_id, picked_from = git_gerrit.git.parse_trailers(message)
+    assert change_id == "Ibc6dab9f4a99d693ea03891ed7222fed9a07a85a"
+    assert picked_from == "75a3a91f5086c011e91bf638e2cc8c03ee373266"
+
+
+def test_parse_trailers__ignores_change_id_outside_trailers():
+    message = "Subject\n\nChange-Id: I0000000000\nmore text\n\nSigned-off-by: Bob\n"
+    assert git_gerrit.git.parse_trailers(message) == (None, None)
+
+
+def test_cat_file__reads_commit_messages(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    env = {
+        "GIT_AUTHOR_NAME": "Alice",
+        "GIT_AUTHOR_EMAIL": "alice@example.com",
+        "GIT_COMMITTER_NAME": "Alice",
+        "GIT_COMMITTER_EMAIL": "alice@example.com",
+    }
+    for name, value in env.items():
+        monkeypatch.setenv(name, value)
+    message = "Subject\n\nBody\n\nChange-Id: I0123456789abcdef\n"
+    subprocess.run(["git", "init", "-q"], check=True)
+    subprocess.run(["git", "commit", "-q", "--allow-empty", "-m", message], check=True)
+    subprocess.run(["git", "commit", "-q", "--allow-empty", "-m", "Two"], check=True)
+    head = subprocess.run(
+        ["git", "rev-parse", "HEAD~1"], check=True, capture_output=True, text=True
+    ).stdout.strip()
+
+    with git_gerrit.git.Git().cat_file() as reader:
+        assert reader.message(head) == message
+        assert reader.trailers(head) == ("I0123456789abcdef", None)
+        assert reader.message("HEAD").rstrip() == "Two"
+        with pytest.raises(GitGerritNotFoundError):
+            reader.read("0" * 40)
+        assert reader.trailers(head) == ("I0123456789abcdef", None)
+
+
+def test_log__reads_output_from_pipe(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    for name in ("AUTHOR", "COMMITTER"):
+        monkeypatch.setenv(f"GIT_{name}_NAME", "Alice")
+        monkeypatch.setenv(f"GIT_{name}_EMAIL", "alice@example.com")
+    subprocess.run(["git", "init", "-q"], check=True)
+    for subject in ("One", "Two", "Three"):
+        subprocess.run(
+            ["git", "commit", "-q", "--allow-empty", "-m", subject], check=True
+        )
+
+    git = git_gerrit.git.Git()
+    assert list(git.log(pretty="%s", reverse=True)) == ["One", "Two", "Three"]
+    assert list(git.log(pretty="%s", max_count=1)) == ["Three"]
+    assert next(git.log(pretty="%s")) == "Three"  # Stops git when closed.
+    with pytest.raises(GitGerritError):
+        list(git.log("no-such-branch"))
@@ -0,0 +1,208 @@
+import http.server
+import json
+import threading
+
+import pytest
+
+from git_gerrit import rest
+from git_gerrit.core import update, update_changes_rest
+from git_gerrit.db import GitGerritDB
+from git_gerrit.error import GitGerritError, GitGerritNotFoundError
+
+
+class GerritHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # Keep-alive
+    requests = []
+
+    def do_GET(self):
+        self.requests.append((self.path, self.headers.get("If-None-Match")))
+        if self.headers.get("If-None-Match") == '"v1"':
+            self.send_response(304)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        body = b')]}\'\n[{"_number": 12345}]'
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("ETag", '"v1"')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        data = json.loads(self.rfile.read(length) or b"null")
+        self.requests.append((self.path, data, self.headers.get("Authorization")))
+        if self.path == "/a/changes/13/abandon":
+            status = 409
+            body = b"change is abandoned"
+            content_type = "text/plain"
+        else:
+            status = 200
+            body = b")]}'\n{}"
+            content_type = "application/json"
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def gerrit_url(monkeypatch):
+    monkeypatch.setattr(rest, "_apis", {})
+    monkeypatch.setattr(GerritHandler, "requests", [])
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), GerritHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_port}"
+    rest.close()
+    server.shutdown()
+    server.server_close()
+    thread.join()
+
+
+def test_api__returns_shared_object(gerrit_url):
+    assert rest.api(gerrit_url) is rest.api(gerrit_url)
+
+
+def test_api__reuses_connections(gerrit_url):
+    for _ in range(3):
+        assert rest.api(gerrit_url).get("/changes/") == [{"_number": 12345}]
+    assert rest.stats() == {
+        "requests": 3,
+        "new_connections": 1,
+        "reused_connections": 2,
+    }
+
+
+def test_stats__counts_nothing_without_requests(gerrit_url):
+    rest.api(gerrit_url)
+    assert rest.stats() == {
+        "requests": 0,
+        "new_connections": 0,
+        "reused_connections": 0,
+    }
+
+
+def test_response_cache__uses_fresh_response(mock_sh, gerrit_url):
+    gerrit = rest.api(gerrit_url)
+    with rest.ResponseCache(ttl=60) as cache:
+        assert cache.get(gerrit, "/changes/1") == [{"_number": 12345}]
+        assert cache.get(gerrit, "/changes/1") == [{"_number": 12345}]
+        assert (cache.misses, cache.hits, cache.revalidated) == (1, 1, 0)
+    assert GerritHandler.requests == [("/changes/1", None)]
+
+
+def test_response_cache__revalidates_stale_response(mock_sh, gerrit_url):
+    gerrit = rest.api(gerrit_url)
+    with rest.ResponseCache(ttl=0) as cache:
+        assert cache.get(gerrit, "/changes/1") == [{"_number": 12345}]
+        assert cache.get(gerrit, "/changes/1") == [{"_number": 12345}]
+        assert (cache.misses, cache.hits, cache.revalidated) == (1, 0, 1)
+    assert GerritHandler.requests == [("/changes/1", None), ("/changes/1", '"v1"')]
+
+
+def test_response_cache__sends_requests_without_database(
+    monkeypatch, mock_sh, gerrit_url
+):
+    def no_repository(*args, **kwargs):
+        raise GitGerritNotFoundError("not a git repository")
+
+    monkeypatch.setattr(GitGerritDB, "__init__", no_repository)
+    gerrit = rest.api(gerrit_url)
+    with rest.ResponseCache(ttl=60) as cache:
+        assert cache.get(gerrit, "/changes/1") == [{"_number": 12345}]
+        assert cache.get(gerrit, "/changes/1") == [{"_number": 12345}]
+        assert cache.misses == 2
+    assert GerritHandler.requests == [("/changes/1", None), ("/changes/1", None)]
+
+
+def test_response_cache__evicts_least_recently_used(mock_sh, gerrit_url):
+    gerrit = rest.api(gerrit_url)
+    with rest.ResponseCache(ttl=60, size=2) as cache:
+        cache.get(gerrit, "/changes/1")
+        cache.get(gerrit, "/changes/2")
+        cache.get(gerrit, "/changes/1")
+        cache.get(gerrit, "/changes/3")
+    with GitGerritDB() as db:
+        assert db.get_response(gerrit.make_url("/changes/1"))
+        assert db.get_response(gerrit.make_url("/changes/2")) is None
+        assert db.get_response(gerrit.make_url("/changes/3"))
+
+
+@pytest.fixture
+def authenticated_gerrit(monkeypatch, tmp_path, gerrit_url):
+    """Send the REST API requests for the configured host to the local server."""
+    netrc = tmp_path / "netrc"
+    netrc.write_text("machine 127.0.0.1 login alice password secret\n")
+    monkeypatch.setenv("NETRC", str(netrc))
+    api = rest.api
+    monkeypatch.setattr(
+        rest, "api", lambda url, pool_size=rest.POOL_SIZE: api(gerrit_url, pool_size)
+    )
+    return netrc
+
+
+def test_update_changes_rest__yields_results_in_order(mock_sh, authenticated_gerrit):
+    changes = [
+        {"number": 11, "current_revision": "abc"},
+        {"number": 12},
+        {"number": 13},
+    ]
+    results = update_changes_rest(
+        changes,
+        message="nevermind",
+        code_review="-1",
+        abandon=True,
+        add_reviewers=["ty@example.com"],
+        jobs=2,
+    )
+    assert [(c["number"], error) for c, error in results] == [
+        (11, None),
+        (12, None),
+        (13, "change is abandoned"),
+    ]
+    requests = sorted(GerritHandler.requests, key=lambda r: r[0])
+    assert all(auth and auth.startswith("Basic ") for _, _, auth in requests)
+    assert [(path, data) for path, data, _ in requests if "/11/" in path] == [
+        ("/a/changes/11/abandon", {}),
+        ("/a/changes/11/reviewers", {"reviewer": "ty@example.com"}),
+        (
+            "/a/changes/11/revisions/abc/review",
+            {"labels": {"Code-Review": -1}, "message": "nevermind"},
+        ),
+    ]
+    assert ("/a/changes/12/revisions/current/review") in [r[0] for r in requests]
+
+
+def test_update_changes_rest__posts_message_with_status_change(
+    mock_sh, authenticated_gerrit
+):
+    update(12, rest=True, message="back again", restore=True)
+    assert [r[:2] for r in GerritHandler.requests] == [
+        ("/a/changes/12/restore", {"message": "back again"})
+    ]
+
+
+def test_update__rest_raises_exception_on_failure(mock_sh, authenticated_gerrit):
+    with pytest.raises(GitGerritError, match="change is abandoned"):
+        update(13, rest=True, abandon=True)
+
+
+def test_update_changes_rest__requires_credentials(mock_sh, authenticated_gerrit):
+    authenticated_gerrit.write_text("")
+    with pytest.raises(GitGerritError, match="No credentials"):
+        list(update_changes_rest([{"number": 11}], abandon=True))
+
+
+@pytest.mark.parametrize("votes", [{"code_review": "+x"}, {"verified": "yes"}])
+def test_update_changes_rest__rejects_invalid_votes(
+    votes, mock_sh, authenticated_gerrit
+):
+    with pytest.raises(GitGerritError, match="Invalid .* vote"):
+        list(update_changes_rest([{"number": 11}], **votes))
+    assert GerritHandler.requests == []
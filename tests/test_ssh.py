@@ -0,0 +1,128 @@
+import os
+import shutil
+import time
+
+import pytest
+import sh
+
+from git_gerrit import ssh
+
+
+class RecordingSsh:
+    def __init__(self, calls, fail_master=False):
+        self.calls = calls
+        self.fail_master = fail_master
+
+    def __call__(self, *args, **kwargs):
+        self.calls.append(args)
+        if "-M" in args:
+            if self.fail_master:
+                raise sh.ErrorReturnCode("ssh", b"", b"Permission denied")
+            # Create the control socket like the master connection does.
+            open(args[args.index("-S") + 1], "w").close()
+        if "-O" in args:
+            os.remove(args[args.index("-S") + 1])
+        return ""
+
+
+def master_call(control_path):
+    return (
+        "-f",
+        "-N",
+        "-M",
+        "-S",
+        control_path,
+        "-o",
+        f"ControlPersist={ssh.CONTROL_PERSIST}",
+        "-o",
+        f"ServerAliveInterval={ssh.SERVER_ALIVE_INTERVAL}",
+        "-p",
+        "29418",
+        "gerrit.example.org",
+    )
+
+
+@pytest.fixture
+def ssh_calls(monkeypatch):
+    calls = []
+    monkeypatch.setattr(ssh, "_sessions", {})
+    monkeypatch.setattr(sh, "Command", lambda name: RecordingSsh(calls))
+    return calls
+
+
+def test_session__returns_shared_object(ssh_calls):
+    assert ssh.session("gerrit.example.org", 29418) is ssh.session(
+        "gerrit.example.org", "29418"
+    )
+    ssh.close()
+    assert ssh_calls == []
+
+
+def test_session__multiplexes_commands_over_master(ssh_calls):
+    with ssh.SshSession("gerrit.example.org", 29418) as session:
+        session.run("gerrit", "version")
+        session.run("gerrit", "ls-projects")
+        control_path = ssh_calls[0][4]
+        assert os.path.dirname(control_path) == session._dir
+    assert ssh_calls == [
+        master_call(control_path),
+        ("-S", control_path, "-p", "29418", "gerrit.example.org", "gerrit", "version"),
+        (
+            "-S",
+            control_path,
+            "-p",
+            "29418",
+            "gerrit.example.org",
+            "gerrit",
+            "ls-projects",
+        ),
+        ("-S", control_path, "-O", "exit", "gerrit.example.org"),
+    ]
+    assert not os.path.exists(os.path.dirname(control_path))
+
+
+def test_session__falls_back_to_separate_connections(monkeypatch, ssh_calls):
+    monkeypatch.setattr(sh, "Command", lambda name: RecordingSsh(ssh_calls, True))
+    with ssh.SshSession("gerrit.example.org", 29418) as session:
+        session.run("gerrit", "version")
+        session.run("gerrit", "version")
+        control_dir = os.path.dirname(ssh_calls[0][4])
+        assert not os.path.exists(control_dir)
+    assert ssh_calls[1:] == [
+        ("-p", "29418", "gerrit.example.org", "gerrit", "version"),
+        ("-p", "29418", "gerrit.example.org", "gerrit", "version"),
+    ]
+
+
+def test_session__restarts_master_when_socket_is_gone(ssh_calls):
+    with ssh.SshSession("gerrit.example.org", 29418) as session:
+        session.run("gerrit", "version")
+        first_dir = session._dir
+        shutil.rmtree(first_dir)  # e.g., removed by a tmp cleaner
+        session.run("gerrit", "version")
+        control_path = ssh_calls[2][4]
+        assert os.path.dirname(control_path) != first_dir
+    assert ssh_calls[2:] == [
+        master_call(control_path),
+        ("-S", control_path, "-p", "29418", "gerrit.example.org", "gerrit", "version"),
+        ("-S", control_path, "-O", "exit", "gerrit.example.org"),
+    ]
+
+
+def test_session__removes_stale_control_dirs(monkeypatch, tmp_path, ssh_calls):
+    monkeypatch.setattr(ssh.tempfile, "tempdir", str(tmp_path))
+    old = time.time() - ssh.STALE_DIR_AGE - 60
+    stale = tmp_path / "git-gerrit-ssh-stale"
+    stale.mkdir()
+    os.utime(stale, (old, old))
+    in_use = tmp_path / "git-gerrit-ssh-in-use"
+    in_use.mkdir()
+    (in_use / "master").touch()
+    os.utime(in_use, (old, old))
+    recent = tmp_path / "git-gerrit-ssh-recent"
+    recent.mkdir()
+    with ssh.SshSession("gerrit.example.org", 29418) as session:
+        session.run("gerrit", "version")
+    assert not stale.exists()
+    assert in_use.exists()
+    assert recent.exists()